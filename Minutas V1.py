@@ -4,19 +4,4088 @@ from datetime import datetime
 def validar_fecha_ddmmaaaa(texto):
     texto = texto.strip()
     patron = r"^(0[1-9]|[12][0-9]|3[01])/(0[1-9]|1[0-2])/(19|20)\d\d$"
-    return bool(re.match(patron, texto))
+    if not re.match(patron, texto):
+        return False
+    try:
+        datetime.strptime(texto, "%d/%m/%Y")
+    except ValueError:
+        return False
+    return True
+
+
+import tkinter as tk
+from tkinter import ttk, filedialog, messagebox, scrolledtext, simpledialog
+from docx import Document
+from docx.shared import Inches, Pt
+from docx.enum.text import WD_ALIGN_PARAGRAPH
+from docx.opc.oxml import serialize_part_xml
+from docx.opc.packuri import PackURI
+from docx.opc.part import Part
+from docx.oxml import parse_xml
+from docx.oxml.ns import nsdecls, qn
+from docx.text.paragraph import Paragraph
+import os
+import re
+from datetime import datetime
+import json
+import atexit
+import copy
+import argparse
+import csv
+import io
+import sqlite3
+import sys
+import marshal
+import hashlib
+import bisect
+import heapq
+import unicodedata
+import tempfile
+import shutil
+import zlib
+import difflib
+import platform
+import zipfile
+import xml.etree.ElementTree as ET
+import queue
+import random
+import threading
+import time
+import multiprocessing
+import multiprocessing.connection
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path, PurePosixPath
+from collections import Counter, OrderedDict, deque
+from functools import lru_cache
+
+
+# ===== MOTOR DE PLANTILLAS =====
+#
+# Sintaxis de marcadores en contenido_base:
+#   [[campo]]                         valor del campo
+#   [[campo|letras]]                  valor con formato (ver FORMATEADORES)
+#   [[#si campo]] ... [[/si]]         sección si el campo tiene valor
+#   [[#si campo=valor]] ... [[#sino]] ... [[/si]]   (también campo!=valor)
+#   [[#para item en lista]] ... [[item.subcampo]] ... [[/para]]
+# Dentro de un bloque #para están disponibles [[item._numero]] y [[item._ultimo]].
+#
+# Formato enriquecido (opcional, si el contenido empieza con [[#enriquecido]]):
+#   **negrita**   *cursiva*   ++subrayado++   (\* y \+ para escribirlos tal cual)
+#   al inicio de línea: "# ", "## ", "### " títulos y ">> " línea centrada
+#   una línea con solo "---" es un salto de página
+# El formato de texto termina al final de cada línea. Las marcas se resuelven
+# al compilar: renderizar solo recorre nodos NODO_ESTILO ya construidos.
+
+PATRON_MARCADOR = re.compile(r'\[\[(.*?)\]\]')
+PATRON_SI = re.compile(r'^#si\s+([^\s=!]+)\s*(?:(!?=)\s*(.*?))?\s*$')
+PATRON_PARA = re.compile(r'^#para\s+(\S+)\s+en\s+(\S+)\s*$')
+
+SIN_DATO = '[SIN DATO]'
+
+NODO_TEXTO = 0
+NODO_CAMPO = 1
+NODO_SI = 2
+NODO_PARA = 3
+NODO_ESTILO = 4
+
+DIRECTIVA_ENRIQUECIDO = '[[#enriquecido]]'
+NEGRITA = 1
+CURSIVA = 2
+SUBRAYADO = 4
+MARCAS_EN_LINEA = {'**': NEGRITA, '*': CURSIVA, '++': SUBRAYADO}
+PATRON_MARCA_EN_LINEA = re.compile(r'\\([*+\\])|\*\*|\+\+|\*')
+PATRON_INICIO_LINEA = re.compile(r'(#{1,3}) |(>>) |(---)[ \t]*$')
+
+
+class ErrorPlantilla(Exception):
+    """Error de sintaxis en los marcadores de una plantilla"""
+
+
+def _es_directiva(interior):
+    return interior.startswith('#') or interior in ('/si', '/para')
+
+
+def _posiciones_segmentos(contenido, inicios=None):
+    """Divide el contenido en texto y marcadores en una sola pasada.
+
+    Devuelve una tupla plana (es_marcador, inicio, fin, ...) con los tramos
+    de texto y el interior de cada marcador. Las directivas que ocupan una
+    línea completa se eliminan junto con su salto de línea para no dejar
+    líneas en blanco en la minuta. Con 'inicios' (la posición de cada '[['
+    según el índice guardado en la plantilla) no se busca con la expresión
+    regular."""
+    if inicios is None:
+        tramos = (coincidencia.span() for coincidencia in PATRON_MARCADOR.finditer(contenido))
+    else:
+        tramos = ((inicio, contenido.index(']]', inicio + 2) + 2) for inicio in inicios)
+    posiciones = []
+    posicion = 0
+    for inicio, fin in tramos:
+        inicio_interior, fin_interior = inicio + 2, fin - 2
+        if _es_directiva(contenido[inicio_interior:fin_interior].strip()):
+            inicio_linea = contenido.rfind('\n', 0, inicio) + 1
+            fin_linea = contenido.find('\n', fin)
+            if fin_linea == -1:
+                fin_linea = len(contenido)
+            if (inicio_linea >= posicion
+                    and not contenido[inicio_linea:inicio].strip()
+                    and not contenido[fin:fin_linea].strip()):
+                inicio = inicio_linea
+                fin = min(fin_linea + 1, len(contenido))
+        if inicio > posicion:
+            posiciones.extend((0, posicion, inicio))
+        posiciones.extend((1, inicio_interior, fin_interior))
+        posicion = fin
+    if posicion < len(contenido):
+        posiciones.extend((0, posicion, len(contenido)))
+    return tuple(posiciones)
+
+
+def _resolver_formatos(cadena):
+    funciones = []
+    for nombre in cadena.split('|'):
+        nombre = nombre.strip().lower()
+        if not nombre:
+            continue
+        if nombre not in FORMATEADORES:
+            raise ErrorPlantilla(f"Formato desconocido: '{nombre}'")
+        funciones.append(FORMATEADORES[nombre])
+    return tuple(funciones)
+
+
+def _nodo_campo(interior, formatos_campos=None):
+    """Nodo de campo con sus formateadores ya resueltos a funciones.
+
+    Los formatos del marcador ([[id|formato]]) reemplazan al formato
+    declarado en el campo."""
+    campo_id, separador, formatos = interior.partition('|')
+    if separador:
+        campo_id = campo_id.strip()
+    else:
+        formatos = (formatos_campos or {}).get(campo_id, '')
+    variable, _, subcampo = campo_id.partition('.')
+    return (NODO_CAMPO, campo_id, variable, subcampo, _resolver_formatos(formatos))
+
+
+def _construir_arbol(tokens, formatos_campos):
+    raiz = []
+    pila = []  # bloques abiertos; 'destino' es la lista que recibe los nodos
+    actual = raiz
+    for es_marcador, valor in tokens:
+        if not es_marcador:
+            actual.append((NODO_TEXTO, valor))
+            continue
+        if es_marcador == NODO_ESTILO:
+            actual.append((NODO_ESTILO,) + valor)
+            continue
+        directiva = valor.strip()
+        if not _es_directiva(directiva):
+            actual.append(_nodo_campo(valor, formatos_campos))
+            continue
+
+        si = PATRON_SI.match(directiva)
+        para = PATRON_PARA.match(directiva)
+        if si:
+            campo, operador, comparado = si.groups()
+            bloque = {'tipo': 'si', 'campo': campo, 'operador': operador or '',
+                      'valor': (comparado or '').strip(), 'entonces': [], 'sino': None}
+            bloque['destino'] = bloque['entonces']
+        elif para:
+            variable, lista = para.groups()
+            bloque = {'tipo': 'para', 'variable': variable, 'lista': lista, 'cuerpo': []}
+            bloque['destino'] = bloque['cuerpo']
+        elif directiva == '#sino':
+            if not pila or pila[-1]['tipo'] != 'si' or pila[-1]['sino'] is not None:
+                raise ErrorPlantilla("[[#sino]] sin un [[#si ...]] abierto")
+            pila[-1]['sino'] = pila[-1]['destino'] = actual = []
+            continue
+        elif directiva == '#enriquecido':
+            # Como en es_enriquecido, solo puede precederla espacio en blanco, que se descarta
+            if pila or any(nodo[0] != NODO_TEXTO or nodo[1].strip() for nodo in raiz):
+                raise ErrorPlantilla("[[#enriquecido]] debe ir al comienzo del contenido")
+            raiz.clear()
+            continue
+        elif directiva in ('/si', '/para'):
+            tipo = directiva[1:]
+            if not pila or pila[-1]['tipo'] != tipo:
+                raise ErrorPlantilla(f"[[{directiva}]] no corresponde a ningún bloque abierto")
+            bloque = pila.pop()
+            if tipo == 'si':
+                nodo = (NODO_SI, _nodo_campo(bloque['campo']), bloque['operador'],
+                        bloque['valor'].casefold(), tuple(bloque['entonces']),
+                        tuple(bloque['sino'] or ()))
+            else:
+                nodo = (NODO_PARA, bloque['variable'], bloque['lista'], tuple(bloque['cuerpo']))
+            actual = pila[-1]['destino'] if pila else raiz
+            actual.append(nodo)
+            continue
+        else:
+            raise ErrorPlantilla(f"Directiva desconocida: [[{directiva}]]")
+
+        pila.append(bloque)
+        actual = bloque['destino']
+
+    if pila:
+        raise ErrorPlantilla(f"Falta cerrar el bloque [[/{pila[-1]['tipo']}]]")
+    return tuple(raiz)
+
+
+def es_enriquecido(contenido):
+    return contenido.lstrip().startswith(DIRECTIVA_ENRIQUECIDO)
+
+
+def _tokens_enriquecidos(contenido):
+    """Como segmentos_de_contenido, pero el texto sale ya dividido por sus
+    marcas de formato: (NODO_ESTILO, (máscara, estilo de línea)) por marca"""
+    posiciones = posiciones_de_contenido(contenido)
+    for i in range(0, len(posiciones), 3):
+        inicio, fin = posiciones[i + 1], posiciones[i + 2]
+        if posiciones[i] == 1:
+            yield True, contenido[inicio:fin]
+            continue
+        pendiente = []
+        for numero, linea in enumerate(contenido[inicio:fin].split('\n')):
+            if numero:
+                pendiente.append('\n')
+            if numero or inicio == 0 or contenido[inicio - 1] == '\n':
+                prefijo = PATRON_INICIO_LINEA.match(linea)
+                if prefijo:
+                    if pendiente:
+                        yield False, ''.join(pendiente)
+                        pendiente = []
+                    titulo, centrado, _ = prefijo.groups()
+                    estilo = f"titulo{len(titulo)}" if titulo else 'centro' if centrado else 'salto'
+                    yield NODO_ESTILO, (0, estilo)
+                    linea = linea[prefijo.end():]
+            posicion = 0
+            for marca in PATRON_MARCA_EN_LINEA.finditer(linea):
+                pendiente.append(linea[posicion:marca.start()])
+                posicion = marca.end()
+                if marca.group(1):
+                    pendiente.append(marca.group(1))
+                    continue
+                if any(pendiente):
+                    yield False, ''.join(pendiente)
+                pendiente = []
+                yield NODO_ESTILO, (MARCAS_EN_LINEA[marca.group()], None)
+            pendiente.append(linea[posicion:])
+        if any(pendiente):
+            yield False, ''.join(pendiente)
+
+
+@lru_cache(maxsize=512)
+def compilar_contenido(contenido, formatos=()):
+    """Compila el contenido de una plantilla a un árbol de nodos (cacheado).
+
+    'formatos' son pares (campo_id, formato) declarados en los campos."""
+    if es_enriquecido(contenido):
+        return _construir_arbol(_tokens_enriquecidos(contenido), dict(formatos))
+    return _construir_arbol(segmentos_de_contenido(contenido), dict(formatos))
+
+
+# Posiciones de segmentos que vienen de la caché binaria de plantillas
+_POSICIONES_PRECALCULADAS = {}
+
+
+def posiciones_de_contenido(contenido):
+    posiciones = _POSICIONES_PRECALCULADAS.get(contenido)
+    if posiciones is None:
+        posiciones = _posiciones_segmentos(contenido)
+    return posiciones
+
+
+def segmentos_de_contenido(contenido):
+    """Lista de (es_marcador, texto) del contenido"""
+    posiciones = posiciones_de_contenido(contenido)
+    return [(posiciones[i] == 1, contenido[posiciones[i + 1]:posiciones[i + 2]])
+            for i in range(0, len(posiciones), 3)]
+
+
+def formatos_de_campos(campos):
+    """Pares (campo_id, formato) de los campos que declaran 'formato'"""
+    return tuple((campo['id'], campo['formato']) for campo in campos if campo.get('formato'))
+
+
+def _valor_en_ambito(nodo, datos, ambito):
+    campo_id, variable, subcampo = nodo[1], nodo[2], nodo[3]
+    if subcampo and variable in ambito:
+        return ambito[variable].get(subcampo)
+    return datos.get(campo_id)
+
+
+def _texto_valor(valor):
+    if valor is None:
+        return SIN_DATO
+    if isinstance(valor, list):
+        return ", ".join(" ".join(v for v in fila.values() if v) for fila in valor)
+    return valor
+
+
+def _evaluar_condicion(nodo, datos, ambito):
+    _, campo, operador, comparado, _, _ = nodo
+    valor = _valor_en_ambito(campo, datos, ambito)
+    if isinstance(valor, list):
+        texto = str(len(valor)) if valor else ''
+    else:
+        texto = (valor or '').strip()
+    if not operador:
+        return bool(texto)
+    igual = texto.casefold() == comparado
+    return igual if operador == '=' else not igual
+
+
+def _texto_campo(nodo, datos, ambito):
+    valor = _valor_en_ambito(nodo, datos, ambito)
+    if valor and nodo[4] and isinstance(valor, str):
+        for formatear in nodo[4]:
+            valor = formatear(valor)
+    return _texto_valor(valor)
+
+
+def _renderizar(nodos, datos, ambito, partes, estilos=None):
+    """Agrega a 'partes' el texto; con 'estilos', también (posición en partes, nodo de estilo)"""
+    for nodo in nodos:
+        tipo = nodo[0]
+        if tipo == NODO_TEXTO:
+            partes.append(nodo[1])
+        elif tipo == NODO_CAMPO:
+            partes.append(_texto_campo(nodo, datos, ambito))
+        elif tipo == NODO_SI:
+            rama = nodo[4] if _evaluar_condicion(nodo, datos, ambito) else nodo[5]
+            _renderizar(rama, datos, ambito, partes, estilos)
+        elif tipo == NODO_PARA:
+            _, variable, lista, cuerpo = nodo
+            filas = datos.get(lista)
+            if not isinstance(filas, list):
+                continue
+            total = len(filas)
+            for numero, fila in enumerate(filas, 1):
+                fila = dict(fila, _numero=str(numero), _ultimo='sí' if numero == total else '')
+                _renderizar(cuerpo, datos, dict(ambito, **{variable: fila}), partes, estilos)
+        elif estilos is not None:
+            estilos.append((len(partes), nodo))
+
+
+def renderizar_contenido(contenido, datos, formatos=()):
+    """Aplica los datos al contenido compilado de una plantilla"""
+    partes = []
+    _renderizar(compilar_contenido(contenido, formatos), datos, {}, partes)
+    return "".join(partes)
+
+
+def renderizar_enriquecido(contenido, datos, formatos=()):
+    """Líneas con formato: lista de (estilo de línea, [(texto, máscara), ...])"""
+    partes = []
+    estilos = []
+    _renderizar(compilar_contenido(contenido, formatos), datos, {}, partes, estilos)
+    estilos.append((len(partes), None))
+    lineas = []
+    tramos = []
+    estilo_linea = None
+    mascara = 0
+    siguiente = 0
+    for indice, texto in enumerate(partes + ['']):
+        while estilos[siguiente][0] == indice and estilos[siguiente][1] is not None:
+            _, cambio, estilo = estilos[siguiente][1]
+            mascara ^= cambio
+            estilo_linea = estilo or estilo_linea
+            siguiente += 1
+        for numero, trozo in enumerate(texto.split('\n')):
+            if numero:
+                lineas.append((estilo_linea, tramos))
+                tramos = []
+                estilo_linea = None
+                mascara = 0
+            if not trozo:
+                continue
+            if tramos and tramos[-1][1] == mascara:
+                tramos[-1] = (tramos[-1][0] + trozo, mascara)
+            else:
+                tramos.append((trozo, mascara))
+    lineas.append((estilo_linea, tramos))
+    return lineas
+
+
+def _raiz_campo(nodo, raices):
+    # Dentro de un #para, [[item.subcampo]] depende de la lista completa
+    if nodo[3] and nodo[2] in raices:
+        return raices[nodo[2]]
+    return nodo[1]
+
+
+def _renderizar_rastreando(nodos, datos, ambito, raices, contexto, partes):
+    """Como _renderizar, pero cada parte lleva los campos de los que depende"""
+    for nodo in nodos:
+        tipo = nodo[0]
+        if tipo == NODO_TEXTO:
+            partes.append((nodo[1], contexto, False))
+        elif tipo == NODO_CAMPO:
+            partes.append((_texto_campo(nodo, datos, ambito), contexto | {_raiz_campo(nodo, raices)}, True))
+        elif tipo == NODO_SI:
+            rama = nodo[4] if _evaluar_condicion(nodo, datos, ambito) else nodo[5]
+            _renderizar_rastreando(rama, datos, ambito, raices,
+                                   contexto | {_raiz_campo(nodo[1], raices)}, partes)
+        elif tipo == NODO_PARA:
+            _, variable, lista, cuerpo = nodo
+            filas = datos.get(lista)
+            if not isinstance(filas, list):
+                continue
+            total = len(filas)
+            for numero, fila in enumerate(filas, 1):
+                fila = dict(fila, _numero=str(numero), _ultimo='sí' if numero == total else '')
+                _renderizar_rastreando(cuerpo, datos, dict(ambito, **{variable: fila}),
+                                       dict(raices, **{variable: lista}), contexto | {lista}, partes)
+
+
+def renderizar_lineas(contenido, datos, formatos=()):
+    """Renderiza el contenido línea por línea: lista de (texto, campos de los que depende)"""
+    partes = []
+    _renderizar_rastreando(compilar_contenido(contenido, formatos), datos, {}, {}, frozenset(), partes)
+    lineas = []
+    texto_linea = []
+    dependencias = set()
+    for texto, contexto, es_campo in partes:
+        for i, trozo in enumerate(texto.split('\n')):
+            if i:
+                lineas.append(("".join(texto_linea), frozenset(dependencias)))
+                texto_linea = []
+                dependencias = set()
+            texto_linea.append(trozo)
+            # Un campo vacío también cuenta: al llenarse cambia su línea
+            if trozo or es_campo:
+                dependencias |= contexto
+    lineas.append(("".join(texto_linea), frozenset(dependencias)))
+    return lineas
+
+
+def ids_estructurales(contenido, formatos=()):
+    """Campos usados en #si y #para: al cambiar pueden cambiar qué líneas existen"""
+    encontrados = set()
+
+    def recorrer(nodos):
+        for nodo in nodos:
+            if nodo[0] == NODO_SI:
+                encontrados.add(nodo[1][2])
+                recorrer(nodo[4])
+                recorrer(nodo[5])
+            elif nodo[0] == NODO_PARA:
+                encontrados.add(nodo[2])
+                recorrer(nodo[3])
+
+    recorrer(compilar_contenido(contenido, formatos))
+    return encontrados
+
+
+# ===== FORMATOS DE VALORES =====
+#
+# Se resuelven a funciones al compilar la plantilla; cada una está memoizada
+# para que los valores repetidos en un lote se formateen una sola vez.
+
+_UNIDADES = ['', 'uno', 'dos', 'tres', 'cuatro', 'cinco', 'seis', 'siete', 'ocho', 'nueve',
+             'diez', 'once', 'doce', 'trece', 'catorce', 'quince', 'dieciséis', 'diecisiete',
+             'dieciocho', 'diecinueve', 'veinte', 'veintiuno', 'veintidós', 'veintitrés',
+             'veinticuatro', 'veinticinco', 'veintiséis', 'veintisiete', 'veintiocho', 'veintinueve']
+_DECENAS = ['', '', '', 'treinta', 'cuarenta', 'cincuenta', 'sesenta', 'setenta', 'ochenta', 'noventa']
+_CENTENAS = ['', 'ciento', 'doscientos', 'trescientos', 'cuatrocientos', 'quinientos',
+             'seiscientos', 'setecientos', 'ochocientos', 'novecientos']
+_MESES = ['enero', 'febrero', 'marzo', 'abril', 'mayo', 'junio', 'julio', 'agosto',
+          'septiembre', 'octubre', 'noviembre', 'diciembre']
+
+
+def _centenas_en_letras(n):
+    if n == 100:
+        return 'cien'
+    centenas, resto = divmod(n, 100)
+    partes = [_CENTENAS[centenas]] if centenas else []
+    if resto < 30:
+        partes.append(_UNIDADES[resto])
+    else:
+        decenas, unidades = divmod(resto, 10)
+        partes.append(_DECENAS[decenas] + (f" y {_UNIDADES[unidades]}" if unidades else ''))
+    return ' '.join(p for p in partes if p)
+
+
+def _apocopar(texto):
+    # "uno" delante de mil/millones: un, veintiún, treinta y un
+    if texto.endswith('veintiuno'):
+        return texto[:-3] + 'ún'
+    if texto.endswith('uno'):
+        return texto[:-1]
+    return texto
+
+
+def numero_en_letras(n):
+    """Escribe un entero no negativo en letras (español)"""
+    if n == 0:
+        return 'cero'
+    if n < 1000:
+        return _centenas_en_letras(n)
+    if n < 10 ** 6:
+        cabeza, resto = divmod(n, 1000)
+        prefijo = 'mil' if cabeza == 1 else f"{_apocopar(numero_en_letras(cabeza))} mil"
+    elif n < 10 ** 12:
+        cabeza, resto = divmod(n, 10 ** 6)
+        prefijo = 'un millón' if cabeza == 1 else f"{_apocopar(numero_en_letras(cabeza))} millones"
+    else:
+        cabeza, resto = divmod(n, 10 ** 12)
+        prefijo = 'un billón' if cabeza == 1 else f"{_apocopar(numero_en_letras(cabeza))} billones"
+    return f"{prefijo} {numero_en_letras(resto)}" if resto else prefijo
+
+
+def _interpretar_monto(texto):
+    """Convierte '1.500.000,50', '1,500,000.50' o '1500000' en (entero, centavos)"""
+    texto = texto.strip().replace(' ', '').lstrip('$')
+    if not re.fullmatch(r'\d+([.,]\d+)*', texto):
+        return None
+    ultimo = max(texto.rfind('.'), texto.rfind(','))
+    if ultimo == -1:
+        return int(texto), 0
+    separador = texto[ultimo]
+    decimales = texto[ultimo + 1:]
+    # Un único separador seguido de tres dígitos es separador de miles
+    if texto.count(separador) > 1 or (len(decimales) == 3 and texto.count('.') + texto.count(',') == 1):
+        return int(re.sub(r'[.,]', '', texto)), 0
+    entero = re.sub(r'[.,]', '', texto[:ultimo])
+    return int(entero or '0'), int(decimales[:2].ljust(2, '0'))
+
+
+@lru_cache(maxsize=4096)
+def formato_letras(valor):
+    monto = _interpretar_monto(valor)
+    if monto is None:
+        return valor
+    entero, centavos = monto
+    texto = numero_en_letras(entero)
+    return f"{texto} con {centavos:02d}/100" if centavos else texto
+
+
+@lru_cache(maxsize=4096)
+def formato_fecha_larga(valor):
+    if not validar_fecha_ddmmaaaa(valor):
+        return valor
+    dia, mes, anio = (int(parte) for parte in valor.strip().split('/'))
+    texto_dia = 'primero' if dia == 1 else numero_en_letras(dia)
+    return f"{texto_dia} de {_MESES[mes - 1]} de {numero_en_letras(anio)}"
+
+
+@lru_cache(maxsize=4096)
+def formato_mayusculas(valor):
+    return valor.upper()
+
+
+@lru_cache(maxsize=4096)
+def formato_minusculas(valor):
+    return valor.lower()
+
+
+@lru_cache(maxsize=4096)
+def formato_titulo(valor):
+    return ' '.join(palabra.capitalize() for palabra in valor.split(' '))
+
+
+FORMATEADORES = {
+    'letras': formato_letras,
+    'larga': formato_fecha_larga,
+    'mayusculas': formato_mayusculas,
+    'minusculas': formato_minusculas,
+    'titulo': formato_titulo,
+}
+
+# Resultados conocidos de los formatos: las herramientas de prueba los verifican,
+# porque el contraste entre motores no detecta un formateador roto en todos a la vez
+CASOS_FORMATOS = (
+    ('[[f|larga]]', {'f': '15/11/2025'}, 'quince de noviembre de dos mil veinticinco'),
+    ('[[f|larga]]', {'f': '01/01/2024'}, 'primero de enero de dos mil veinticuatro'),
+    ('[[m|letras]]', {'m': '1.500.000,50'}, 'un millón quinientos mil con 50/100'),
+    ('[[n|mayusculas]]', {'n': 'juan pérez'}, 'JUAN PÉREZ'),
+    ('[[n|titulo]]', {'n': 'juan pérez'}, 'Juan Pérez'),
+)
+
+
+def comprobar_formatos():
+    """Casos de CASOS_FORMATOS que no dan el resultado esperado, como los fallos del contraste"""
+    fallos = []
+    for contenido, datos, esperado in CASOS_FORMATOS:
+        try:
+            obtenido = renderizar_contenido(contenido, datos)
+        except Exception as e:  # Un formateador roto también es un fallo que informar
+            obtenido = f"{type(e).__name__}: {e}"
+        if obtenido != esperado:
+            fallos.append({'contenido': contenido, 'datos': datos,
+                           'esperado': esperado, 'obtenido': obtenido})
+    return fallos
+
+
+def _informar_fallo(fallo, informar):
+    informar(f"  ✖ {fallo['contenido']!r} con {fallo['datos']!r}\n"
+             f"      esperado {fallo['esperado']!r}\n      obtenido {fallo['obtenido']!r}")
+
+
+# ===== VALIDACIÓN DE CAMPOS =====
+#
+# Cada campo puede declarar 'validacion': {'tipo': ..., 'patron': ..., 'mensaje': ...}.
+# Los campos 'fecha' validan siempre el calendario y los 'seleccion' sus opciones.
+
+PATRONES_VALIDACION = {
+    'numero': (r'^-?(\d{1,3}([.,]\d{3})*|\d+)([.,]\d+)?$', "debe ser un número"),
+    'entero': (r'^-?\d+$', "debe ser un número entero"),
+    'cedula': (r'^\d{1,3}(\.?\d{3}){1,3}$', "no es un número de cédula válido"),
+    'nit': (r'^\d{6,10}-?\d$', "no es un NIT válido"),
+    'rfc': (r'^[A-ZÑ&]{3,4}\d{6}[A-Z0-9]{3}$', "no es un RFC válido"),
+    'curp': (r'^[A-Z][AEIOUX][A-Z]{2}\d{6}[HM][A-Z]{5}[A-Z0-9]\d$', "no es una CURP válida"),
+    'correo': (r'^[^@\s]+@[^@\s]+\.[^@\s]+$', "no es un correo electrónico válido"),
+}
+
+TIPOS_VALIDACION = [''] + list(PATRONES_VALIDACION) + ['regex']
+
+
+def _regla_patron(patron, mensaje):
+    comparar = re.compile(patron).fullmatch
+    return lambda valor: None if comparar(valor.strip()) else mensaje
+
+
+def _regla_fecha(valor):
+    return None if validar_fecha_ddmmaaaa(valor) else "no es una fecha válida (DD/MM/AAAA)"
+
+
+def _regla_opciones(opciones):
+    permitidas = frozenset(opciones)
+    return lambda valor: None if valor in permitidas else "no es una de las opciones disponibles"
+
+
+class _ReglaFilas:
+    """Valida cada fila de un grupo repetible con las reglas de sus subcampos"""
+    __slots__ = ('validadores',)
+
+    def __init__(self, validadores):
+        self.validadores = validadores
+
+    def __call__(self, filas):
+        if not isinstance(filas, list):
+            return None
+        for numero, fila in enumerate(filas, 1):
+            for nombre, mensaje in validar_registro(self.validadores, fila):
+                return f"fila {numero}, {nombre}: {mensaje}"
+        return None
+
+
+def subcampos_como_campos(campo):
+    return [Campo.desde_dict(dict(sub, nombre=sub.get('nombre', sub['id']))) for sub in campo.subcampos]
+
+
+def compilar_validadores(campos):
+    """Compila las reglas de validación de los campos de una plantilla.
+
+    Devuelve una tupla (campo_id, nombre, requerido, reglas) por campo; cada
+    regla recibe el valor y devuelve un mensaje de error o None. Un patrón
+    inválido se informa como ErrorPlantilla."""
+    compilados = []
+    for campo in campos:
+        reglas = []
+        if campo.tipo == 'grupo':
+            if campo.subcampos:
+                reglas.append(_ReglaFilas(compilar_validadores(subcampos_como_campos(campo))))
+            compilados.append((campo.id, campo.nombre, campo.requerido, tuple(reglas)))
+            continue
+        if campo.tipo == 'fecha':
+            reglas.append(_regla_fecha)
+        elif campo.tipo == 'seleccion' and campo.opciones:
+            reglas.append(_regla_opciones(campo.opciones))
+
+        validacion = campo.validacion or {}
+        tipo_validacion = validacion.get('tipo')
+        if tipo_validacion == 'regex' and validacion.get('patron'):
+            try:
+                reglas.append(_regla_patron(validacion['patron'],
+                                            validacion.get('mensaje') or "no tiene el formato esperado"))
+            except re.error as e:
+                raise ErrorPlantilla(f"El patrón de validación del campo '{campo.nombre}' no es válido: {e}") from None
+        elif tipo_validacion in PATRONES_VALIDACION:
+            patron, mensaje = PATRONES_VALIDACION[tipo_validacion]
+            reglas.append(_regla_patron(patron, validacion.get('mensaje') or mensaje))
+
+        compilados.append((campo.id, campo.nombre, campo.requerido, tuple(reglas)))
+    return tuple(compilados)
+
+
+def _validar_valor(reglas, requerido, valor):
+    if not valor or (isinstance(valor, str) and not valor.strip()):
+        return "es requerido" if requerido else None
+    if isinstance(valor, list):
+        # Las filas de un grupo solo las valida su propia regla
+        reglas = [regla for regla in reglas if isinstance(regla, _ReglaFilas)]
+    for regla in reglas:
+        mensaje = regla(valor)
+        if mensaje:
+            return mensaje
+    return None
+
+
+def validar_registro(validadores, datos):
+    """Valida un registro y devuelve una lista de (nombre_campo, mensaje)"""
+    errores = []
+    for campo_id, nombre, requerido, reglas in validadores:
+        mensaje = _validar_valor(reglas, requerido, datos.get(campo_id))
+        if mensaje:
+            errores.append((nombre, mensaje))
+    return errores
+
+
+def validar_lote(validadores, registros):
+    """Valida columna por columna un lote de registros.
+
+    Devuelve todos los errores como (numero_fila, nombre_campo, mensaje),
+    ordenados por fila; la fila 1 es el primer registro tras el encabezado."""
+    errores = []
+    for campo_id, nombre, requerido, reglas in validadores:
+        for numero, registro in enumerate(registros, 1):
+            mensaje = _validar_valor(reglas, requerido, registro.get(campo_id))
+            if mensaje:
+                errores.append((numero, nombre, mensaje))
+    errores.sort(key=lambda error: error[0])
+    return errores
+
+
+def leer_registros_csv(ruta, campos):
+    """Lee un CSV de registros para una plantilla.
+
+    Las columnas llevan el id de cada campo; los grupos repetibles usan una
+    columna por subcampo ('grupo.subcampo') con los valores separados por '|'."""
+    with open(ruta, 'r', encoding='utf-8-sig', newline='') as f:
+        encabezado = f.readline()
+        f.seek(0)
+        delimitador = max(",;\t", key=encabezado.count)
+        filas = list(csv.DictReader(f, delimiter=delimitador))
+
+    grupos = [campo for campo in campos if campo.tipo == 'grupo']
+    return [registro_desde_fila(fila, grupos) for fila in filas]
+
+
+def registro_desde_fila(fila, grupos):
+    """Convierte una fila plana (CSV o base de datos) en los datos de un registro.
+
+    Las columnas 'grupo.subcampo' con valores separados por '|' se arman
+    como la lista de filas del grupo repetible."""
+    registro = {clave.strip(): (valor or '') for clave, valor in fila.items() if clave}
+    for grupo in grupos:
+        columnas = {sub['id']: registro.pop(f"{grupo.id}.{sub['id']}", '').split('|')
+                    for sub in grupo.subcampos}
+        total = max((len(valores) for valores in columnas.values()), default=0)
+        filas_grupo = []
+        for i in range(total):
+            elemento = {sub_id: (valores[i].strip() if i < len(valores) else '')
+                        for sub_id, valores in columnas.items()}
+            if any(elemento.values()):
+                filas_grupo.append(elemento)
+        registro[grupo.id] = filas_grupo
+    return registro
+
+
+# ===== FUENTES DE DATOS =====
+#
+# Una plantilla puede declarar 'fuente_datos' para llenar el formulario y
+# los lotes desde una base SQLite local:
+#   {'base': 'clientes.sqlite',
+#    'consulta': 'SELECT ... WHERE caso = :caso', 'parametro': 'caso',
+#    'consulta_lote': 'SELECT ...', 'mapeo': {'columna': 'campo_id'}}
+# Las columnas sin mapeo se usan tal cual si se llaman como un campo (o
+# 'grupo.subcampo'). La base se abre en solo lectura y una ruta relativa
+# se toma desde la carpeta de plantillas.
+
+TAMANO_BLOQUE_FUENTE = 500
+BLOQUES_ADELANTADOS = 2
+
+
+class ErrorFuenteDatos(Exception):
+    """Configuración, base o consulta inválida en una fuente de datos"""
+
+
+def _valor_columna(valor):
+    if valor is None:
+        return ''
+    if isinstance(valor, float) and valor.is_integer():
+        return str(int(valor))
+    return str(valor)
+
+
+class FuenteDatosSQLite:
+    """Consulta la base SQLite declarada por una plantilla"""
+    def __init__(self, configuracion, carpeta_base='.'):
+        self.configuracion = configuracion
+        ruta = Path(configuracion.get('base', ''))
+        self.ruta = ruta if ruta.is_absolute() else Path(carpeta_base) / ruta
+        self.mapeo = configuracion.get('mapeo', {})
+
+    def conectar(self):
+        if not self.ruta.is_file():
+            raise ErrorFuenteDatos(f"No se encuentra la base de datos '{self.ruta}'")
+        return sqlite3.connect(f"{self.ruta.resolve().as_uri()}?mode=ro", uri=True)
+
+    def _claves(self, cursor):
+        return [self.mapeo.get(descripcion[0], descripcion[0]) for descripcion in cursor.description]
+
+    def registro(self, valor, campos):
+        """Datos del caso 'valor' listos para el formulario, o None si no existe"""
+        consulta = self.configuracion.get('consulta')
+        if not consulta:
+            raise ErrorFuenteDatos("La plantilla no define la consulta de un caso")
+        parametro = self.configuracion.get('parametro') or 'caso'
+        grupos = [campo for campo in campos if campo.tipo == 'grupo']
+        conexion = self.conectar()
+        try:
+            cursor = conexion.execute(consulta, {parametro: valor})
+            fila = cursor.fetchone()
+            if fila is None:
+                return None
+            claves = self._claves(cursor)
+        except sqlite3.Error as e:
+            raise ErrorFuenteDatos(f"Error en la consulta: {e}") from e
+        finally:
+            conexion.close()
+        return registro_desde_fila(dict(zip(claves, map(_valor_columna, fila))), grupos)
+
+    def contar_lote(self, parametros=None):
+        conexion = self.conectar()
+        try:
+            return conexion.execute(f"SELECT COUNT(*) FROM ({self._consulta_lote()})",
+                                    parametros or {}).fetchone()[0]
+        except sqlite3.Error as e:
+            raise ErrorFuenteDatos(f"Error en la consulta del lote: {e}") from e
+        finally:
+            conexion.close()
+
+    def _consulta_lote(self):
+        consulta = self.configuracion.get('consulta_lote')
+        if not consulta:
+            raise ErrorFuenteDatos("La plantilla no define la consulta del lote")
+        return consulta.strip().rstrip(';')
+
+    def bloques_lote(self, campos, parametros=None, tamano=TAMANO_BLOQUE_FUENTE):
+        """Genera los registros del lote en bloques de 'tamano'.
+
+        Un hilo lee los siguientes bloques con fetchmany mientras se procesa
+        el actual, sin cargar nunca el resultado completo en memoria."""
+        consulta = self._consulta_lote()
+        grupos = [campo for campo in campos if campo.tipo == 'grupo']
+        cola = queue.Queue(maxsize=BLOQUES_ADELANTADOS)
+        detener = threading.Event()
+
+        def entregar(elemento):
+            while not detener.is_set():
+                try:
+                    cola.put(elemento, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def leer():
+            try:
+                conexion = self.conectar()
+                try:
+                    cursor = conexion.execute(consulta, parametros or {})
+                    claves = self._claves(cursor)
+                    while not detener.is_set():
+                        filas = cursor.fetchmany(tamano)
+                        if not filas:
+                            break
+                        entregar([registro_desde_fila(dict(zip(claves, map(_valor_columna, fila))), grupos)
+                                  for fila in filas])
+                finally:
+                    conexion.close()
+                entregar(None)
+            except Exception as e:
+                entregar(e)
+
+        hilo = threading.Thread(target=leer, daemon=True)
+        hilo.start()
+        try:
+            while True:
+                bloque = cola.get()
+                if bloque is None:
+                    return
+                if isinstance(bloque, sqlite3.Error):
+                    raise ErrorFuenteDatos(f"Error en la consulta del lote: {bloque}") from bloque
+                if isinstance(bloque, Exception):
+                    raise bloque
+                yield bloque
+        finally:
+            detener.set()
+            hilo.join()
+
+
+# ===== SALIDA DE LOTES =====
+#
+# Los lotes entregan cada documento a una salida a medida que se generan.
+# SalidaCarpeta guarda un .docx por registro; SalidaZip los escribe desde
+# memoria directamente dentro de uno o varios ZIP (partes limitadas por
+# cantidad de documentos o por tamaño). Ambas dejan un manifiesto CSV con
+# registro -> archivo -> versión de plantilla.
+
+ARCHIVO_MANIFIESTO_LOTE = "manifiesto.csv"
+MAXIMO_DOCUMENTOS_POR_ZIP = 1000
+MAXIMO_BYTES_POR_ZIP = 500 * 1024 * 1024
+COLUMNAS_MANIFIESTO_LOTE = ['registro', 'archivo', 'paquete', 'plantilla', 'version']
+
+
+class SalidaLote:
+    """Base de las salidas de lote: lleva el manifiesto de lo generado"""
+    def __init__(self, plantilla=None):
+        self.plantilla = plantilla
+        self.filas_manifiesto = []
+        self.total = 0
+
+    def fila_manifiesto(self, numero, nombre, paquete=''):
+        fila = [numero, nombre, paquete,
+                getattr(self.plantilla, 'nombre', ''), getattr(self.plantilla, 'version', '') or '']
+        self.filas_manifiesto.append(fila)
+        self.total += 1
+        return fila
+
+    @staticmethod
+    def csv_manifiesto(filas):
+        salida = io.StringIO()
+        escritor = csv.writer(salida)
+        escritor.writerow(COLUMNAS_MANIFIESTO_LOTE)
+        escritor.writerows(filas)
+        return salida.getvalue().encode('utf-8-sig')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cerrar()
+        return False
+
+
+class SalidaCarpeta(SalidaLote):
+    def __init__(self, carpeta, plantilla=None):
+        super().__init__(plantilla)
+        self.carpeta = Path(carpeta)
+        self.carpeta.mkdir(parents=True, exist_ok=True)
+
+    def agregar(self, numero, nombre, doc):
+        doc.save(self.carpeta / nombre)
+        self.fila_manifiesto(numero, nombre)
+        return self.carpeta / nombre
+
+    def cerrar(self):
+        (self.carpeta / ARCHIVO_MANIFIESTO_LOTE).write_bytes(self.csv_manifiesto(self.filas_manifiesto))
+
+    def descripcion(self):
+        return str(self.carpeta)
+
+
+class SalidaZip(SalidaLote):
+    """Escribe los documentos en ZIP, partiéndolo si se indica un límite.
+
+    Sin límites se crea solo <ruta>.zip; con límites, <ruta>_001.zip,
+    <ruta>_002.zip, ... Cada parte lleva su propio manifiesto y junto a
+    ellas queda <ruta>_manifiesto.csv con el lote completo."""
+    def __init__(self, ruta, plantilla=None, maximo_documentos=None, maximo_bytes=None):
+        super().__init__(plantilla)
+        ruta = Path(ruta)
+        self.base = ruta.with_suffix('') if ruta.suffix.lower() == '.zip' else ruta
+        self.maximo_documentos = maximo_documentos
+        self.maximo_bytes = maximo_bytes
+        self.partes = []
+        self.archivo = None
+
+    def _abrir_parte(self):
+        self._cerrar_parte()
+        if self.maximo_documentos or self.maximo_bytes:
+            ruta = self.base.with_name(f"{self.base.name}_{len(self.partes) + 1:03d}.zip")
+        else:
+            ruta = self.base.with_suffix('.zip')
+        # Un DOCX ya viene comprimido: volver a comprimirlo solo gasta CPU
+        self.archivo = zipfile.ZipFile(ruta, 'w', compression=zipfile.ZIP_STORED)
+        self.partes.append(ruta)
+        self.filas_parte = []
+        self.bytes_parte = 0
+
+    def _cerrar_parte(self):
+        if self.archivo is not None:
+            self.archivo.writestr(ARCHIVO_MANIFIESTO_LOTE, self.csv_manifiesto(self.filas_parte))
+            self.archivo.close()
+            self.archivo = None
+
+    def agregar(self, numero, nombre, doc):
+        memoria = io.BytesIO()
+        doc.save(memoria)
+        datos = memoria.getbuffer()
+        if self.archivo is None:
+            self._abrir_parte()
+        elif self.filas_parte and (
+                (self.maximo_documentos and len(self.filas_parte) >= self.maximo_documentos)
+                or (self.maximo_bytes and self.bytes_parte + len(datos) > self.maximo_bytes)):
+            self._abrir_parte()
+        info = zipfile.ZipInfo(nombre, date_time=time.localtime()[:6])
+        info.external_attr = 0o644 << 16
+        self.archivo.writestr(info, datos)
+        self.bytes_parte += len(datos)
+        self.filas_parte.append(self.fila_manifiesto(numero, nombre, self.partes[-1].name))
+        return f"{self.partes[-1]}!{nombre}"
+
+    def cerrar(self):
+        self._cerrar_parte()
+        if len(self.partes) > 1:
+            ruta_manifiesto = self.base.with_name(f"{self.base.name}_{ARCHIVO_MANIFIESTO_LOTE}")
+            ruta_manifiesto.write_bytes(self.csv_manifiesto(self.filas_manifiesto))
+
+    def descripcion(self):
+        if len(self.partes) == 1:
+            return str(self.partes[0])
+        return f"{len(self.partes)} archivos ZIP en {self.base.parent}"
+
+
+# ===== DOCUMENTO WORD =====
+
+def aplicar_formato_apa(doc):
+    sections = doc.sections
+    for section in sections:
+        section.top_margin = Inches(1)
+        section.bottom_margin = Inches(1)
+        section.left_margin = Inches(1)
+        section.right_margin = Inches(1)
+
+    style = doc.styles['Normal']
+    font = style.font
+    font.name = 'Times New Roman'
+    font.size = Pt(12)
+
+    paragraph_format = style.paragraph_format
+    paragraph_format.line_spacing = 2.0
+
+
+def construir_documento_word(contenido, plantilla=None, datos=None):
+    """Documento en memoria con la minuta; no depende de la interfaz gráfica"""
+    doc = Document()
+    aplicar_formato_apa(doc)
+    if plantilla is not None:
+        # Deja constancia de la versión de plantilla que originó la minuta
+        propiedades = doc.core_properties
+        propiedades.subject = plantilla.nombre
+        propiedades.version = str(plantilla.version or '')
+        propiedades.identifier = plantilla.huella
+        propiedades.comments = f"Generada con la plantilla '{plantilla.nombre}' versión {plantilla.version or 'sin registrar'}"
+
+    if plantilla is not None and datos is not None and es_enriquecido(plantilla.contenido_base):
+        # Sin mapa de regeneración: corregir un campo rehace el documento completo
+        agregar_lineas_enriquecidas(doc, renderizar_enriquecido(plantilla.contenido_base, datos,
+                                                                plantilla.formatos))
+        return doc
+    for linea in contenido.split('\n'):
+        if linea.strip():
+            doc.add_paragraph(linea)
+    if plantilla is not None and datos is not None:
+        lineas = renderizar_lineas(plantilla.contenido_base, datos, plantilla.formatos)
+        incrustar_mapa(doc, mapa_minuta(plantilla, datos, lineas))
+    return doc
+
+
+# ----- Formato enriquecido -----
+#
+# El XML de cada estilo se construye una sola vez por proceso; cada párrafo o
+# tramo recibe una copia en vez de pasar por la API de estilos de python-docx.
+ESTILOS_TITULO = {'titulo1': 'Heading1', 'titulo2': 'Heading2', 'titulo3': 'Heading3'}
+
+
+@lru_cache(maxsize=None)
+def tramo_modelo(mascara):
+    """<w:r> con las propiedades de la máscara y un <w:t> vacío para el texto"""
+    propiedades = ''.join(etiqueta for bit, etiqueta in ((NEGRITA, '<w:b/>'), (CURSIVA, '<w:i/>'),
+                                                         (SUBRAYADO, '<w:u w:val="single"/>'))
+                          if mascara & bit)
+    if propiedades:
+        propiedades = f'<w:rPr>{propiedades}</w:rPr>'
+    return parse_xml(f'<w:r {nsdecls("w")}>{propiedades}<w:t xml:space="preserve"/></w:r>')
+
+
+@lru_cache(maxsize=None)
+def propiedades_parrafo(estilo):
+    if estilo == 'centro':
+        interior = '<w:jc w:val="center"/>'
+    else:
+        interior = f'<w:pStyle w:val="{ESTILOS_TITULO[estilo]}"/>'
+    return parse_xml(f'<w:pPr {nsdecls("w")}>{interior}</w:pPr>')
+
+
+def agregar_lineas_enriquecidas(doc, lineas):
+    """Agrega al documento las líneas de renderizar_enriquecido (las vacías se omiten)"""
+    for estilo, tramos in lineas:
+        if estilo == 'salto':
+            doc.add_page_break()
+            continue
+        if not any(texto.strip() for texto, _ in tramos):
+            continue
+        parrafo = doc.add_paragraph()
+        if estilo:
+            parrafo._p.insert(0, copy.deepcopy(propiedades_parrafo(estilo)))
+        for texto, mascara in tramos:
+            if '\t' in texto:
+                # add_run convierte los tabuladores en <w:tab/>
+                tramo = parrafo.add_run(texto)
+                if mascara:
+                    tramo._r.insert(0, copy.deepcopy(tramo_modelo(mascara)[0]))
+                continue
+            tramo = copy.deepcopy(tramo_modelo(mascara))
+            tramo[-1].text = texto
+            parrafo._p.append(tramo)
+
+
+# ===== REGENERACIÓN INCREMENTAL DE MINUTAS =====
+
+# Cada minuta generada lleva dentro del .docx un mapa de qué campos alimentan
+# cada párrafo y la huella del texto que se escribió; al corregir un campo solo
+# se reescriben esos párrafos, y nunca uno que se haya retocado en Word.
+VERSION_MAPA = 2
+PARTE_MAPA = '/minudoc/mapa.json'
+TIPO_MAPA = 'application/vnd.minudoc.mapa+json'
+RELACION_MAPA = 'http://minudoc.local/relaciones/mapa'
+DOCUMENTO_WORD = 'word/document.xml'
+
+
+def huella_contenido_plantilla(plantilla):
+    serializado = json.dumps([plantilla.contenido_base, list(plantilla.formatos)], ensure_ascii=False)
+    return hashlib.sha256(serializado.encode('utf-8')).hexdigest()[:32]
+
+
+def huellas_campos(datos):
+    return {campo_id: hashlib.sha256(json.dumps(valor, sort_keys=True, ensure_ascii=False)
+                                     .encode('utf-8')).hexdigest()[:16]
+            for campo_id, valor in datos.items()}
+
+
+def huella_texto(texto):
+    return hashlib.sha256(texto.encode('utf-8')).hexdigest()[:16]
+
+
+def mapa_minuta(plantilla, datos, lineas):
+    """Mapa párrafo → campos para las líneas no vacías (las que se vuelven párrafos)"""
+    emitidas = [i for i, (texto, _) in enumerate(lineas) if texto.strip()]
+    return {
+        'version': VERSION_MAPA,
+        'plantilla': plantilla.nombre,
+        'huella_plantilla': huella_contenido_plantilla(plantilla),
+        'campos': huellas_campos(datos),
+        'total_lineas': len(lineas),
+        'lineas': emitidas,
+        'parrafos': [sorted(lineas[i][1]) for i in emitidas],
+        'textos': [huella_texto(lineas[i][0]) for i in emitidas],
+    }
+
+
+def incrustar_mapa(doc, mapa):
+    parte = Part(PackURI(PARTE_MAPA), TIPO_MAPA,
+                 json.dumps(mapa, ensure_ascii=False).encode('utf-8'), doc.part.package)
+    doc.part.relate_to(parte, RELACION_MAPA)
+
+
+def leer_mapa_minuta(ruta):
+    try:
+        with zipfile.ZipFile(ruta) as archivo:
+            return json.loads(archivo.read(PARTE_MAPA.lstrip('/')))
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+        return None
+
+
+def parrafos_editados(ruta):
+    """Números (desde 1) de los párrafos cuyo texto ya no es el que escribió MinuDoc"""
+    mapa = leer_mapa_minuta(ruta)
+    if not mapa or mapa.get('version') != VERSION_MAPA:
+        return []
+    try:
+        with zipfile.ZipFile(ruta) as archivo:
+            parrafos = parse_xml(archivo.read(DOCUMENTO_WORD)).body.findall(qn('w:p'))
+    except (OSError, KeyError, zipfile.BadZipFile):
+        return []
+    if len(parrafos) != len(mapa['textos']):
+        # Se agregaron o quitaron párrafos: todo el documento cuenta como retocado
+        return list(range(1, len(parrafos) + 1))
+    return [posicion + 1 for posicion, (parrafo, huella) in enumerate(zip(parrafos, mapa['textos']))
+            if huella_texto(Paragraph(parrafo, None).text) != huella]
+
+
+def regenerar_minuta(ruta, plantilla, datos):
+    """Reescribe en el .docx existente solo los párrafos cuyos campos cambiaron.
+
+    Devuelve cuántos párrafos reescribió, o None si hace falta regenerar el
+    documento completo (sin mapa, otra plantilla, cambió la estructura o algún
+    párrafo por reescribir se editó a mano; parrafos_editados dice cuáles)."""
+    mapa = leer_mapa_minuta(ruta)
+    if not mapa or mapa.get('version') != VERSION_MAPA:
+        return None
+    if mapa['huella_plantilla'] != huella_contenido_plantilla(plantilla):
+        return None
+    huellas = huellas_campos(datos)
+    anteriores = mapa['campos']
+    cambiados = {campo_id for campo_id in huellas.keys() | anteriores.keys()
+                 if huellas.get(campo_id) != anteriores.get(campo_id)}
+    if not cambiados:
+        return 0
+    # Un #si o #para que cambia puede agregar o quitar líneas enteras
+    if cambiados & ids_estructurales(plantilla.contenido_base, plantilla.formatos):
+        return None
+    lineas = renderizar_lineas(plantilla.contenido_base, datos, plantilla.formatos)
+    nuevo_mapa = mapa_minuta(plantilla, datos, lineas)
+    if nuevo_mapa['total_lineas'] != mapa['total_lineas'] or nuevo_mapa['lineas'] != mapa['lineas']:
+        return None
+
+    with zipfile.ZipFile(ruta) as archivo:
+        documento = parse_xml(archivo.read(DOCUMENTO_WORD))
+        parrafos = documento.body.findall(qn('w:p'))
+        if len(parrafos) != len(mapa['lineas']):
+            return None
+        por_reescribir = [posicion for posicion in range(len(parrafos))
+                          if cambiados.intersection(mapa['parrafos'][posicion])]
+        # Un párrafo retocado en Word no se pisa en silencio
+        if any(huella_texto(Paragraph(parrafos[posicion], None).text) != mapa['textos'][posicion]
+               for posicion in por_reescribir):
+            return None
+        reescritos = 0
+        for posicion in por_reescribir:
+            indice = nuevo_mapa['lineas'][posicion]
+            parrafo = Paragraph(parrafos[posicion], None)
+            # Conserva el formato del primer tramo si se retocó en Word
+            propiedades = parrafo.runs[0]._r.rPr if parrafo.runs else None
+            parrafo.clear()
+            tramo = parrafo.add_run(lineas[indice][0])
+            if propiedades is not None:
+                tramo._r.insert(0, copy.deepcopy(propiedades))
+            reescritos += 1
+
+        reemplazos = {DOCUMENTO_WORD: serialize_part_xml(documento),
+                      PARTE_MAPA.lstrip('/'): json.dumps(nuevo_mapa, ensure_ascii=False).encode('utf-8')}
+        memoria = io.BytesIO()
+        with zipfile.ZipFile(memoria, 'w') as salida:
+            # Los demás miembros se copian tal cual, con su compresión original
+            for info in archivo.infolist():
+                salida.writestr(info, reemplazos.get(info.filename) or archivo.read(info.filename))
+    _escribir_bytes_atomico(ruta, memoria.getvalue())
+    return reescritos
+
+
+# ===== COMPARACIÓN DE MINUTAS =====
+#
+# Compara dos minutas primero por párrafos y luego, dentro de cada par de
+# párrafos distintos, por palabras. Ambos niveles usan el diff de Myers en
+# espacio lineal (bisección por la serpiente media), así que la memoria crece
+# con el largo de los documentos y no con su producto. Los resultados salen
+# de un generador: la vista previa y el Word con marcas los consumen a medida
+# que se producen.
+
+LIMITE_COMPARACION = 1.0  # segundos; al agotarse, el tramo restante se marca como reemplazado
+SIMILITUD_MINIMA = 0.5    # por debajo, un par de párrafos se muestra como borrado e insertado
+AUTOR_REVISION = 'MinuDoc'
+PATRON_PALABRAS = re.compile(r'\w+|\s+|[^\w\s]')
+ETIQUETA_PARRAFO = qn('w:p')
+ETIQUETAS_TEXTO_PARRAFO = {qn('w:t'): None, qn('w:tab'): '\t'}
+
+
+def parrafos_docx(ruta):
+    """Texto de cada párrafo no vacío de un .docx, leído en flujo sin cargar el documento"""
+    with zipfile.ZipFile(ruta) as archivo, archivo.open(DOCUMENTO_WORD) as documento:
+        partes = []
+        for evento, elemento in ET.iterparse(documento, events=('end',)):
+            if elemento.tag in ETIQUETAS_TEXTO_PARRAFO:
+                partes.append(ETIQUETAS_TEXTO_PARRAFO[elemento.tag] or elemento.text or '')
+            elif elemento.tag == ETIQUETA_PARRAFO:
+                texto = ''.join(partes)
+                partes = []
+                elemento.clear()
+                if texto.strip():
+                    yield texto
+
+
+def parrafos_de_texto(texto):
+    """Párrafos de una minuta en texto, tal como los escribe construir_documento_word"""
+    return (linea for linea in texto.split('\n') if linea.strip())
+
+
+def _biseccion(a, b, a0, a1, b0, b1, plazo):
+    """Punto (x, y) por donde pasa un camino de edición mínimo entre a[a0:a1] y
+    b[b0:b1], o None si no tienen nada en común o se agotó el plazo"""
+    n, m = a1 - a0, b1 - b0
+    maximo = (n + m + 1) // 2
+    desplazamiento = maximo
+    largo = 2 * maximo + 2
+    adelante = [-1] * largo
+    atras = [-1] * largo
+    adelante[desplazamiento + 1] = 0
+    atras[desplazamiento + 1] = 0
+    delta = n - m
+    impar = delta % 2 != 0
+    # Diagonales que ya salieron del rectángulo y no hace falta seguir
+    inicio_adelante = fin_adelante = inicio_atras = fin_atras = 0
+    for d in range(maximo):
+        if time.monotonic() > plazo:
+            return None
+        for k in range(-d + inicio_adelante, d + 1 - fin_adelante, 2):
+            indice = desplazamiento + k
+            if k == -d or (k != d and adelante[indice - 1] < adelante[indice + 1]):
+                x = adelante[indice + 1]
+            else:
+                x = adelante[indice - 1] + 1
+            y = x - k
+            while x < n and y < m and a[a0 + x] == b[b0 + y]:
+                x += 1
+                y += 1
+            adelante[indice] = x
+            if x > n:
+                fin_adelante += 2
+            elif y > m:
+                inicio_adelante += 2
+            elif impar:
+                opuesto = desplazamiento + delta - k
+                if 0 <= opuesto < largo and atras[opuesto] != -1 and x >= n - atras[opuesto]:
+                    return x, y
+        for k in range(-d + inicio_atras, d + 1 - fin_atras, 2):
+            indice = desplazamiento + k
+            if k == -d or (k != d and atras[indice - 1] < atras[indice + 1]):
+                x = atras[indice + 1]
+            else:
+                x = atras[indice - 1] + 1
+            y = x - k
+            while x < n and y < m and a[a1 - 1 - x] == b[b1 - 1 - y]:
+                x += 1
+                y += 1
+            atras[indice] = x
+            if x > n:
+                fin_atras += 2
+            elif y > m:
+                inicio_atras += 2
+            elif not impar:
+                opuesto = desplazamiento + delta - k
+                if 0 <= opuesto < largo and adelante[opuesto] != -1:
+                    x_adelante = adelante[opuesto]
+                    if x_adelante >= n - x:
+                        return x_adelante, desplazamiento + x_adelante - opuesto
+    return None
+
+
+def _agregar_operacion(operaciones, etiqueta, a0, a1, b0, b1):
+    # Une con la anterior: dos iguales seguidas, o borrado + inserción = reemplazo
+    if operaciones:
+        anterior = operaciones[-1]
+        if anterior[0] == etiqueta or (anterior[0] != 'equal' and etiqueta != 'equal'):
+            operaciones[-1] = (etiqueta if anterior[0] == etiqueta else 'replace',
+                               anterior[1], a1, anterior[3], b1)
+            return
+    operaciones.append((etiqueta, a0, a1, b0, b1))
+
+
+def operaciones_diferencia(a, b, plazo=None):
+    """Como SequenceMatcher.get_opcodes, pero con el diff mínimo de Myers"""
+    if plazo is None:
+        plazo = time.monotonic() + LIMITE_COMPARACION
+    operaciones = []
+    # Pila de tramos por comparar (etiqueta None) y de operaciones ya resueltas
+    pendientes = [(None, 0, len(a), 0, len(b))]
+    while pendientes:
+        etiqueta, a0, a1, b0, b1 = pendientes.pop()
+        if etiqueta:
+            _agregar_operacion(operaciones, etiqueta, a0, a1, b0, b1)
+            continue
+        comun = 0
+        while a0 + comun < a1 and b0 + comun < b1 and a[a0 + comun] == b[b0 + comun]:
+            comun += 1
+        if comun:
+            _agregar_operacion(operaciones, 'equal', a0, a0 + comun, b0, b0 + comun)
+            a0 += comun
+            b0 += comun
+        comun = 0
+        while a1 - comun > a0 and b1 - comun > b0 and a[a1 - comun - 1] == b[b1 - comun - 1]:
+            comun += 1
+        if comun:
+            pendientes.append(('equal', a1 - comun, a1, b1 - comun, b1))
+            a1 -= comun
+            b1 -= comun
+        if a0 == a1 and b0 == b1:
+            continue
+        if a0 == a1 or b0 == b1:
+            pendientes.append(('insert' if a0 == a1 else 'delete', a0, a1, b0, b1))
+            continue
+        # Sin nada en común la bisección recorrería todas las diagonales para nada
+        medio = None
+        if not set(a[a0:a1]).isdisjoint(b[b0:b1]):
+            medio = _biseccion(a, b, a0, a1, b0, b1, plazo)
+        if medio is None:
+            pendientes.append(('replace', a0, a1, b0, b1))
+            continue
+        x, y = medio
+        pendientes.append((None, a0 + x, a1, b0 + y, b1))
+        pendientes.append((None, a0, a0 + x, b0, b0 + y))
+    return operaciones
+
+
+def comparar_palabras(anterior, nuevo):
+    """Segmentos (tipo, texto) de dos párrafos, o None si se parecen demasiado poco"""
+    a = PATRON_PALABRAS.findall(anterior)
+    b = PATRON_PALABRAS.findall(nuevo)
+    minimo = SIMILITUD_MINIMA * (len(anterior) + len(nuevo))
+    # Cota de lo que puede quedar igual: las palabras comunes, cada una tantas veces como aparece en ambos
+    comunes = Counter(a) & Counter(b)
+    if 2 * sum(len(palabra) * veces for palabra, veces in comunes.items()) < minimo:
+        return None
+    segmentos = []
+    iguales = 0
+    for etiqueta, a0, a1, b0, b1 in operaciones_diferencia(a, b):
+        if etiqueta == 'equal':
+            texto = ''.join(a[a0:a1])
+            iguales += len(texto)
+            segmentos.append(('igual', texto))
+            continue
+        if a1 > a0:
+            segmentos.append(('borrado', ''.join(a[a0:a1])))
+        if b1 > b0:
+            segmentos.append(('insertado', ''.join(b[b0:b1])))
+    if 2 * iguales < minimo:
+        return None
+    return segmentos
+
+
+def comparar_parrafos(anteriores, nuevos, plazo=None):
+    """Compara dos listas de párrafos y produce en orden (tipo, contenido).
+
+    tipo es 'igual', 'borrado' o 'insertado' con el texto del párrafo, o
+    'cambiado' con la lista de segmentos (tipo, texto) palabra por palabra."""
+    # Cada párrafo distinto se reduce a un entero: las comparaciones del diff son baratas
+    codigos = {}
+    a = [codigos.setdefault(parrafo, len(codigos)) for parrafo in anteriores]
+    b = [codigos.setdefault(parrafo, len(codigos)) for parrafo in nuevos]
+    codigos = None
+    for etiqueta, a0, a1, b0, b1 in operaciones_diferencia(a, b, plazo):
+        if etiqueta == 'equal':
+            for i in range(a0, a1):
+                yield 'igual', anteriores[i]
+            continue
+        pares = min(a1 - a0, b1 - b0)
+        for k in range(pares):
+            segmentos = comparar_palabras(anteriores[a0 + k], nuevos[b0 + k])
+            if segmentos is None:
+                yield 'borrado', anteriores[a0 + k]
+                yield 'insertado', nuevos[b0 + k]
+            else:
+                yield 'cambiado', segmentos
+        for i in range(a0 + pares, a1):
+            yield 'borrado', anteriores[i]
+        for j in range(b0 + pares, b1):
+            yield 'insertado', nuevos[j]
+
+
+def contar_cambios(resultados, resumen):
+    """Deja pasar los resultados de comparar_parrafos contando párrafos y palabras en 'resumen'"""
+    for tipo, contenido in resultados:
+        resumen[tipo] = resumen.get(tipo, 0) + 1
+        segmentos = contenido if tipo == 'cambiado' else ((tipo, contenido),)
+        for subtipo, texto in segmentos:
+            if subtipo != 'igual':
+                clave = f"palabras_{subtipo}"
+                resumen[clave] = resumen.get(clave, 0) + sum(1 for _ in re.finditer(r'\w+', texto))
+        yield tipo, contenido
+
+
+@lru_cache(maxsize=None)
+def _modelo_revision(tipo):
+    """<w:ins>/<w:del> con un tramo vacío, y la marca de párrafo correspondiente"""
+    etiqueta = 'ins' if tipo == 'insertado' else 'del'
+    texto = 't' if tipo == 'insertado' else 'delText'
+    tramo = parse_xml(f'<w:{etiqueta} {nsdecls("w")} w:author="{AUTOR_REVISION}">'
+                      f'<w:r><w:{texto} xml:space="preserve"/></w:r></w:{etiqueta}>')
+    marca = parse_xml(f'<w:pPr {nsdecls("w")}><w:rPr><w:{etiqueta} w:author="{AUTOR_REVISION}"/>'
+                      f'</w:rPr></w:pPr>')
+    return tramo, marca
+
+
+def documento_comparacion(resultados):
+    """Documento Word con los cambios como revisiones (control de cambios)"""
+    doc = Document()
+    aplicar_formato_apa(doc)
+    fecha = datetime.now().isoformat(timespec='seconds')
+    numero = 0
+
+    def revision(modelo):
+        nonlocal numero
+        numero += 1
+        elemento = copy.deepcopy(modelo)
+        revisado = elemento if elemento.tag != qn('w:pPr') else elemento[0][0]
+        revisado.set(qn('w:id'), str(numero))
+        revisado.set(qn('w:date'), fecha)
+        return elemento
+
+    for tipo, contenido in resultados:
+        parrafo = doc.add_paragraph()
+        if tipo == 'igual':
+            parrafo.add_run(contenido)
+            continue
+        if tipo != 'cambiado':
+            # El párrafo entero se insertó o se borró, incluida su marca de fin
+            parrafo._p.insert(0, revision(_modelo_revision(tipo)[1]))
+            contenido = ((tipo, contenido),)
+        for subtipo, texto in contenido:
+            if subtipo == 'igual':
+                parrafo.add_run(texto)
+                continue
+            elemento = revision(_modelo_revision(subtipo)[0])
+            elemento[0][0].text = texto
+            parrafo._p.append(elemento)
+    return doc
+
+
+# ===== ARCHIVOS Y PAQUETES DE PLANTILLAS =====
+
+EXTENSION_PAQUETE = ".minupack"
+VERSION_PAQUETE = 1
+TIPOS_CAMPO = ('texto', 'textarea', 'seleccion', 'fecha', 'grupo')
+MINIMO_PARA_PARALELO = 20
+
+
+def escribir_json_atomico(ruta, datos):
+    """Escribe un JSON en un archivo temporal y lo renombra sobre el destino"""
+    ruta = Path(ruta)
+    descriptor, temporal = tempfile.mkstemp(prefix=f".{ruta.stem}.", suffix=".tmp", dir=ruta.parent)
+    try:
+        with os.fdopen(descriptor, 'w', encoding='utf-8') as f:
+            json.dump(datos, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporal, ruta)
+    except BaseException:
+        if os.path.exists(temporal):
+            os.unlink(temporal)
+        raise
+
+
+# ----- Guardado seguro en carpetas compartidas -----
+#
+# Cada escritura toma un bloqueo consultivo (<archivo>.lock creado con
+# O_EXCL, que funciona también en recursos de red), compara la huella del
+# archivo con la que se cargó y reemplaza el archivo con un rename atómico.
+# El JSON y el registro del historial se preparan antes de tomar el bloqueo
+# para retenerlo lo mínimo: dentro solo se comprueba la huella y se escribe.
+
+ESPERA_BLOQUEO = 10.0
+CADUCIDAD_BLOQUEO = 30.0
+
+
+class ErrorBloqueo(Exception):
+    """No se pudo obtener el bloqueo de una plantilla a tiempo"""
+
+
+class ConflictoPlantilla(Exception):
+    """La plantilla cambió en disco desde que se cargó"""
+    def __init__(self, ruta, huella_actual):
+        super().__init__(f"La plantilla '{Path(ruta).stem}' fue modificada por otro usuario")
+        self.ruta = Path(ruta)
+        self.huella_actual = huella_actual
+
+
+def _leer_ficha(ruta):
+    try:
+        with open(ruta, 'r', encoding='utf-8') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+class BloqueoArchivo:
+    """Bloqueo consultivo basado en un archivo <ruta>.lock.
+
+    El archivo guarda una ficha única de quien lo tomó y, mientras se tiene,
+    un hilo le renueva la fecha de modificación para que un guardado lento no
+    parezca abandonado. Quitarlo, sea el dueño al salir o quien lo encuentre
+    caducado, exige además <ruta>.lock.romper (también O_EXCL): con él tomado
+    se vuelve a leer la ficha y solo se borra si sigue siendo la esperada, así
+    nunca se quita un bloqueo que otro tomó entretanto."""
+    def __init__(self, ruta, espera=ESPERA_BLOQUEO):
+        self.ruta_bloqueo = Path(f"{ruta}.lock")
+        self.ruta_romper = Path(f"{ruta}.lock.romper")
+        self.espera = espera
+        self.ficha = None
+        self._soltar = None
+
+    def __enter__(self):
+        limite = time.monotonic() + self.espera
+        pausa = 0.005
+        ficha = f"{os.getpid()}@{platform.node()} {os.urandom(8).hex()} {datetime.now().isoformat()}"
+        while True:
+            try:
+                descriptor = os.open(self.ruta_bloqueo, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                with os.fdopen(descriptor, 'w', encoding='utf-8') as f:
+                    f.write(ficha)
+                self.ficha = ficha
+                self._soltar = threading.Event()
+                threading.Thread(target=self._renovar, args=(ficha, self._soltar), daemon=True).start()
+                return self
+            except FileExistsError:
+                if self._romper_caducado():
+                    continue
+                if time.monotonic() >= limite:
+                    raise ErrorBloqueo(f"La plantilla está siendo guardada por otro usuario ({self.ruta_bloqueo.stem})")
+                time.sleep(pausa)
+                pausa = min(pausa * 2, 0.2)
+
+    def _renovar(self, ficha, soltar):
+        # Mantiene fresco el bloqueo mientras siga siendo nuestro
+        while not soltar.wait(CADUCIDAD_BLOQUEO / 3):
+            if _leer_ficha(self.ruta_bloqueo) != ficha:
+                return
+            try:
+                os.utime(self.ruta_bloqueo)
+            except OSError:
+                return
+
+    @staticmethod
+    def _caducado(ruta):
+        """True si 'ruta' lleva más de CADUCIDAD_BLOQUEO sin tocarse, None si no existe"""
+        try:
+            return time.time() - ruta.stat().st_mtime > CADUCIDAD_BLOQUEO
+        except FileNotFoundError:
+            return None
+
+    def _romper_caducado(self):
+        """Quita el bloqueo si lo abandonó un proceso caído; True si hay que reintentar ya"""
+        caducado = self._caducado(self.ruta_bloqueo)
+        if caducado is None:
+            return True
+        if not caducado:
+            return False
+        ficha = _leer_ficha(self.ruta_bloqueo)
+        if ficha is not None:
+            self._quitar(ficha, solo_caducado=True)
+        return True
+
+    def _quitar(self, ficha, solo_caducado=False):
+        """Borra el bloqueo solo si sigue teniendo 'ficha' (y sigue caducado, si se pide)"""
+        limite = time.monotonic() + self.espera
+        while True:
+            try:
+                os.close(os.open(self.ruta_romper, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                # Solo se retiene un instante; uno viejo es de un proceso que murió quitando
+                if self._caducado(self.ruta_romper):
+                    try:
+                        os.unlink(self.ruta_romper)
+                    except FileNotFoundError:
+                        pass
+                    continue
+                if time.monotonic() >= limite:
+                    return  # Se reintenta en la próxima espera
+                time.sleep(0.005)
+        try:
+            if _leer_ficha(self.ruta_bloqueo) == ficha and (not solo_caducado or self._caducado(self.ruta_bloqueo)):
+                os.unlink(self.ruta_bloqueo)
+        except FileNotFoundError:
+            pass
+        finally:
+            os.unlink(self.ruta_romper)
+
+    def __exit__(self, *exc):
+        if self._soltar is not None:
+            self._soltar.set()
+            self._soltar = None
+        # Si el bloqueo caducó y otro lo tomó, _quitar no toca el ajeno
+        if self.ficha is not None:
+            self._quitar(self.ficha)
+        self.ficha = None
+        return False
+
+
+def huella_archivo(ruta):
+    """sha256 del archivo, o None si no existe"""
+    try:
+        with open(ruta, 'rb') as f:
+            return _sha256(f.read())
+    except FileNotFoundError:
+        return None
+
+
+def _reemplazar(origen, destino, intentos=5):
+    # En Windows el reemplazo falla si otro proceso tiene el archivo abierto
+    for intento in range(intentos):
+        try:
+            os.replace(origen, destino)
+            return
+        except PermissionError:
+            if intento == intentos - 1:
+                raise
+            time.sleep(0.05 * (intento + 1))
+
+
+def _serializar_plantilla(plantilla):
+    if isinstance(plantilla.get('contenido_base'), str):
+        # El índice de marcadores siempre se guarda junto al texto que describe
+        plantilla = dict(plantilla, indice_marcadores=indice_de_plantilla(plantilla))
+    return json.dumps(plantilla, ensure_ascii=False, indent=2).encode('utf-8')
+
+
+def _escribir_bytes_atomico(ruta, datos):
+    ruta = Path(ruta)
+    descriptor, temporal = tempfile.mkstemp(prefix=f".{ruta.stem}.", suffix=".tmp", dir=ruta.parent)
+    try:
+        with os.fdopen(descriptor, 'wb') as f:
+            f.write(datos)
+            f.flush()
+            os.fsync(f.fileno())
+        _reemplazar(temporal, ruta)
+    finally:
+        if os.path.exists(temporal):
+            os.unlink(temporal)
+
+
+def guardar_plantilla_segura(ruta, plantilla, huella_esperada=None, forzar=False, historial=True):
+    """Guarda una plantilla de forma atómica y con control de concurrencia.
+
+    'huella_esperada' es la huella con que se cargó (None para una plantilla
+    nueva). Si el archivo cambió mientras tanto se lanza ConflictoPlantilla,
+    salvo que se indique 'forzar'. Con 'historial' el guardado queda
+    registrado como una nueva versión. Devuelve la nueva huella."""
+    ruta = Path(ruta)
+    while True:
+        preparada = preparar_version(ruta, plantilla) if historial else None
+        datos = preparada['datos'] if historial else _serializar_plantilla(plantilla)
+        with BloqueoArchivo(ruta):
+            actual = huella_archivo(ruta)
+            if not forzar and actual != huella_esperada:
+                raise ConflictoPlantilla(ruta, actual)
+            if historial and not confirmar_version(ruta, preparada, actual):
+                continue  # Otro guardado se adelantó: se prepara de nuevo fuera del bloqueo
+            _escribir_bytes_atomico(ruta, datos)
+        return _sha256(datos)
+
+
+def eliminar_plantilla_segura(ruta, huella_esperada=None, forzar=False):
+    ruta = Path(ruta)
+    with BloqueoArchivo(ruta):
+        actual = huella_archivo(ruta)
+        if actual is None:
+            return
+        if not forzar and actual != huella_esperada:
+            raise ConflictoPlantilla(ruta, actual)
+        ruta.unlink()
+    ruta_cache = ruta.parent / CARPETA_CACHE / f"{ruta.stem}.bin"
+    if ruta_cache.exists():
+        ruta_cache.unlink()
+    # El historial se conserva: una plantilla eliminada se puede recuperar
+
+
+def fusionar_plantillas(base, propia, ajena):
+    """Fusión a tres bandas de una plantilla editada en paralelo.
+
+    Los campos se unen por id (prevalecen los propios). El contenido se toma
+    del lado que lo modificó respecto de la base; si ambos lo modificaron se
+    conserva el propio y se informa en el segundo valor devuelto."""
+    fusion = dict(ajena)
+    fusion.update({clave: valor for clave, valor in propia.items()
+                   if valor != base.get(clave) or clave not in ajena})
+
+    ids_propios = {campo['id'] for campo in propia.get('campos_personalizados', [])}
+    ids_eliminados = {campo['id'] for campo in base.get('campos_personalizados', [])} - ids_propios
+    fusion['campos_personalizados'] = list(propia.get('campos_personalizados', [])) + [
+        campo for campo in ajena.get('campos_personalizados', [])
+        if campo['id'] not in ids_propios and campo['id'] not in ids_eliminados
+    ]
+
+    contenido_base = base.get('contenido_base', '')
+    contenido_propio = propia.get('contenido_base', '')
+    contenido_ajeno = ajena.get('contenido_base', '')
+    conflicto_contenido = False
+    if contenido_propio == contenido_base:
+        fusion['contenido_base'] = contenido_ajeno
+    else:
+        fusion['contenido_base'] = contenido_propio
+        conflicto_contenido = contenido_ajeno not in (contenido_base, contenido_propio)
+    return fusion, conflicto_contenido
+
+
+# ----- Historial de versiones -----
+#
+# Cada plantilla tiene en .historial/ un archivo de registros (<n>.hist) al
+# que solo se agregan datos, y un índice (<n>.indice) con la posición de cada
+# versión para listarlas sin leer el historial. Cada registro guarda los
+# metadatos y, cada INTERVALO_INSTANTANEAS versiones, el contenido completo;
+# el resto solo guarda las líneas que cambiaron respecto de la versión
+# anterior. La versión vigente sigue siendo el JSON de la plantilla.
+
+CARPETA_HISTORIAL = ".historial"
+INTERVALO_INSTANTANEAS = 16
+
+
+def rutas_historial(ruta):
+    ruta = Path(ruta)
+    carpeta = ruta.parent / CARPETA_HISTORIAL
+    return carpeta / f"{ruta.stem}.hist", carpeta / f"{ruta.stem}.indice"
+
+
+def leer_indice_historial(ruta):
+    """Versiones registradas de una plantilla, de la más antigua a la más nueva"""
+    _, ruta_indice = rutas_historial(ruta)
+    try:
+        with open(ruta_indice, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+
+
+def diferencia_lineas(anteriores, nuevas):
+    """Delta compacto [[inicio, fin, líneas nuevas], ...] entre dos listas de líneas"""
+    return [[i1, i2, nuevas[j1:j2]]
+            for etiqueta, i1, i2, j1, j2 in operaciones_diferencia(anteriores, nuevas) if etiqueta != 'equal']
+
+
+def aplicar_diferencia_lineas(lineas, delta):
+    lineas = list(lineas)
+    # De atrás hacia adelante para que los índices sigan siendo válidos
+    for inicio, fin, nuevas in reversed(delta):
+        lineas[inicio:fin] = nuevas
+    return lineas
+
+
+def _leer_registro(archivo, entrada):
+    archivo.seek(entrada['posicion'])
+    return json.loads(zlib.decompress(archivo.read(entrada['longitud'])).decode('utf-8'))
+
+
+def reconstruir_version(ruta, version):
+    """Devuelve el dict de la plantilla tal como quedó en 'version'"""
+    indice = leer_indice_historial(ruta)
+    posicion = next((i for i, entrada in enumerate(indice) if entrada['version'] == version), None)
+    if posicion is None:
+        raise KeyError(f"La versión {version} no existe")
+    inicio = posicion
+    while not indice[inicio]['completa']:
+        inicio -= 1
+
+    ruta_hist, _ = rutas_historial(ruta)
+    with open(ruta_hist, 'rb') as archivo:
+        lineas = []
+        for entrada in indice[inicio:posicion + 1]:
+            registro = _leer_registro(archivo, entrada)
+            if entrada['completa']:
+                lineas = registro['contenido'].splitlines(True)
+            else:
+                lineas = aplicar_diferencia_lineas(lineas, registro['delta'])
+    plantilla = registro['meta']
+    plantilla['contenido_base'] = ''.join(lineas)
+    return plantilla
+
+
+def _preparar_registro(plantilla, datos, anterior, desde_completa):
+    """Registro comprimido de una versión y su entrada de índice (sin posición)"""
+    contenido = plantilla.get('contenido_base', '')
+    meta = {clave: valor for clave, valor in plantilla.items() if clave != 'contenido_base'}
+    completa = anterior is None or desde_completa + 1 >= INTERVALO_INSTANTANEAS
+
+    if completa:
+        registro = {'meta': meta, 'contenido': contenido}
+        cambios = len(contenido.splitlines())
+    else:
+        delta = diferencia_lineas(anterior.splitlines(True), contenido.splitlines(True))
+        registro = {'meta': meta, 'delta': delta}
+        cambios = sum(max(fin - inicio, len(nuevas)) for inicio, fin, nuevas in delta)
+    comprimido = zlib.compress(json.dumps(registro, ensure_ascii=False).encode('utf-8'))
+    return comprimido, {'version': plantilla['version'], 'fecha': plantilla.get('fecha_modificacion', ''),
+                        'huella': _sha256(datos), 'completa': completa,
+                        'lineas_cambiadas': cambios, 'tamano': len(contenido)}
+
+
+def preparar_version(ruta, plantilla):
+    """Numera la plantilla como nueva versión y prepara sus registros de historial.
+
+    No necesita el bloqueo, porque calcular el delta puede tardar: lo
+    preparado solo vale si el archivo y el índice siguen como se leyeron,
+    y eso lo comprueba confirmar_version ya con el bloqueo tomado."""
+    ruta = Path(ruta)
+    indice = leer_indice_historial(ruta)
+    try:
+        datos_actuales = ruta.read_bytes()
+    except FileNotFoundError:
+        datos_actuales = None
+    huella_actual = _sha256(datos_actuales) if datos_actuales is not None else None
+
+    registros = []
+    anterior = None
+    desde_completa = 0
+    if indice:
+        if huella_actual == indice[-1]['huella']:
+            anterior = json.loads(datos_actuales.decode('utf-8')).get('contenido_base', '')
+        else:
+            # El JSON se cambió por fuera del historial: se reconstruye la última versión
+            anterior = reconstruir_version(ruta, indice[-1]['version']).get('contenido_base', '')
+        for entrada in reversed(indice):
+            if entrada['completa']:
+                break
+            desde_completa += 1
+    elif datos_actuales is not None:
+        # Plantilla anterior al historial: su estado actual queda como versión 1
+        previa = json.loads(datos_actuales.decode('utf-8'))
+        previa['version'] = 1
+        registros.append(_preparar_registro(previa, datos_actuales, None, 0))
+        anterior = previa.get('contenido_base', '')
+
+    plantilla = dict(plantilla)
+    plantilla['version'] = indice[-1]['version'] + 1 if indice else len(registros) + 1
+    plantilla['fecha_modificacion'] = datetime.now().isoformat(timespec='seconds')
+    datos = _serializar_plantilla(plantilla)
+    registros.append(_preparar_registro(plantilla, datos, anterior, desde_completa))
+    return {'huella': huella_actual, 'versiones': len(indice),
+            'ultima': indice[-1]['huella'] if indice else None,
+            'registros': registros, 'datos': datos}
+
+
+def confirmar_version(ruta, preparada, huella_actual):
+    """Agrega al historial lo preparado por preparar_version.
+
+    Debe llamarse con el bloqueo de la plantilla tomado. Devuelve False, sin
+    escribir nada, si la plantilla o su historial cambiaron desde entonces."""
+    indice = leer_indice_historial(ruta)
+    if (huella_actual != preparada['huella'] or len(indice) != preparada['versiones']
+            or (indice[-1]['huella'] if indice else None) != preparada['ultima']):
+        return False
+    ruta_hist, ruta_indice = rutas_historial(ruta)
+    ruta_hist.parent.mkdir(exist_ok=True)
+    with open(ruta_hist, 'ab') as f:
+        for comprimido, entrada in preparada['registros']:
+            indice.append(dict(entrada, posicion=f.tell(), longitud=len(comprimido)))
+            f.write(comprimido)
+        f.flush()
+        os.fsync(f.fileno())
+    escribir_json_atomico(ruta_indice, indice)
+    return True
+
+
+def diferencias_versiones(ruta, version_a, version_b):
+    """Líneas de un diff unificado entre dos versiones, con los cambios de campos al inicio"""
+    a = reconstruir_version(ruta, version_a)
+    b = reconstruir_version(ruta, version_b)
+    ids_a = {campo['id']: campo for campo in a.get('campos_personalizados', [])}
+    ids_b = {campo['id']: campo for campo in b.get('campos_personalizados', [])}
+    lineas = [f"+ campo {id_campo}" for id_campo in ids_b if id_campo not in ids_a]
+    lineas += [f"- campo {id_campo}" for id_campo in ids_a if id_campo not in ids_b]
+    lineas += [f"~ campo {id_campo}" for id_campo in ids_a
+               if id_campo in ids_b and ids_a[id_campo] != ids_b[id_campo]]
+    lineas += difflib.unified_diff(a.get('contenido_base', '').splitlines(),
+                                   b.get('contenido_base', '').splitlines(),
+                                   f"versión {version_a}", f"versión {version_b}", lineterm='')
+    return lineas
+
+
+# ----- Prueba de concurrencia -----
+#
+# Varios procesos guardan a la vez la misma plantilla con el ciclo de la
+# interfaz: cargar, agregar una línea, guardar y, ante un conflicto, volver
+# a cargar. Al final no debe faltar ninguna línea, el historial debe tener
+# una versión por guardado y no deben quedar bloqueos ni temporales. Se
+# empieza con un bloqueo caducado, que el primer proceso debe romper.
+
+def _martillar_plantilla(argumentos):
+    ruta, proceso, guardados, inicio = argumentos
+    time.sleep(max(0.0, inicio - time.time()))
+    conflictos = esperas = 0
+    for numero in range(guardados):
+        while True:
+            datos = Path(ruta).read_bytes()
+            plantilla = json.loads(datos.decode('utf-8'))
+            plantilla['contenido_base'] += f"proceso {proceso} guardado {numero}\n"
+            try:
+                guardar_plantilla_segura(ruta, plantilla, _sha256(datos))
+                break
+            except ConflictoPlantilla:
+                conflictos += 1
+            except ErrorBloqueo:
+                esperas += 1
+    return conflictos, esperas
+
+
+def probar_concurrencia(carpeta, procesos=4, guardados=50, informar=print):
+    """Martilla una plantilla desde varios procesos; devuelve 0 si todo quedó consistente"""
+    carpeta = Path(tempfile.mkdtemp(prefix="concurrencia_", dir=carpeta))
+    ruta = carpeta / "prueba.json"
+    guardar_plantilla_segura(ruta, {'nombre': 'prueba', 'contenido_base': '', 'campos_personalizados': []})
+    ruta_bloqueo = Path(f"{ruta}.lock")
+    ruta_bloqueo.write_text("proceso caído", encoding='utf-8')
+    antiguo = time.time() - 2 * CADUCIDAD_BLOQUEO
+    os.utime(ruta_bloqueo, (antiguo, antiguo))
+
+    # Todos empiezan a la vez, cuando ya arrancaron los procesos
+    inicio = time.time() + 2.0
+    contexto = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=procesos, mp_context=contexto) as ejecutor:
+        resultados = list(ejecutor.map(_martillar_plantilla,
+                                       [(str(ruta), proceso, guardados, inicio) for proceso in range(procesos)]))
+    duracion = max(time.time() - inicio, 1e-6)
+    conflictos = sum(c for c, _ in resultados)
+    esperas = sum(e for _, e in resultados)
+    total = procesos * guardados
+
+    problemas = []
+    plantilla = json.loads(ruta.read_bytes().decode('utf-8'))
+    lineas = plantilla['contenido_base'].splitlines()
+    esperadas = {f"proceso {p} guardado {n}" for p in range(procesos) for n in range(guardados)}
+    if len(lineas) != total or set(lineas) != esperadas:
+        problemas.append(f"se perdieron o duplicaron guardados: {len(set(lineas) & esperadas)} de {total}")
+    indice = leer_indice_historial(ruta)
+    if [entrada['version'] for entrada in indice] != list(range(1, total + 2)):
+        problemas.append(f"el historial tiene {len(indice)} versiones, no {total + 1} consecutivas")
+    elif reconstruir_version(ruta, indice[-1]['version'])['contenido_base'] != plantilla['contenido_base']:
+        problemas.append("la última versión del historial no coincide con la plantilla")
+    sobrantes = [p.name for p in carpeta.iterdir() if p.is_file() and p.name != ruta.name]
+    if sobrantes:
+        problemas.append(f"quedaron archivos sueltos: {', '.join(sorted(sobrantes))}")
+
+    informar(f"{procesos} procesos, {total} guardados en {duracion:.1f} s ({total / duracion:.0f} por segundo), "
+             f"{conflictos} conflictos resueltos recargando, {esperas} esperas de bloqueo agotadas")
+    for problema in problemas:
+        informar(f"ERROR: {problema}")
+    if problemas:
+        informar(f"Se conservan los archivos en {carpeta}")
+        return 1
+    shutil.rmtree(carpeta, ignore_errors=True)
+    return 0
+
+
+CARACTERES_NO_PERMITIDOS = '/\\:*?"<>|'
+
+
+def nombre_archivo_valido(nombre):
+    """Si el nombre puede usarse como archivo sin salir de su carpeta"""
+    return (isinstance(nombre, str) and bool(nombre.strip()) and nombre not in ('.', '..')
+            and not any(c in CARACTERES_NO_PERMITIDOS or ord(c) < 32 for c in nombre))
+
+
+def validar_estructura_plantilla(plantilla):
+    """Devuelve la lista de problemas estructurales de una plantilla"""
+    if not isinstance(plantilla, dict):
+        return ["no es un objeto JSON"]
+    errores = []
+    if not isinstance(plantilla.get('nombre'), str) or not plantilla['nombre'].strip():
+        errores.append("falta el nombre")
+    elif not nombre_archivo_valido(plantilla['nombre']):
+        errores.append("el nombre contiene caracteres no permitidos")
+    if not isinstance(plantilla.get('contenido_base', ''), str):
+        errores.append("contenido_base no es texto")
+    campos = plantilla.get('campos_personalizados', [])
+    if not isinstance(campos, list):
+        return errores + ["campos_personalizados no es una lista"]
+    for i, campo in enumerate(campos, 1):
+        if not isinstance(campo, dict) or not campo.get('id') or not campo.get('nombre'):
+            errores.append(f"el campo {i} no tiene id o nombre")
+        elif campo.get('tipo') not in TIPOS_CAMPO:
+            errores.append(f"el campo '{campo['id']}' tiene un tipo desconocido")
+    if not errores:
+        try:
+            compilar_validadores([Campo.desde_dict(campo) for campo in campos])
+        except ErrorPlantilla as e:
+            errores.append(str(e))
+        except (KeyError, TypeError, AttributeError):
+            errores.append("la validación de un campo o los subcampos de un grupo no son válidos")
+    if not errores:
+        try:
+            compilar_contenido(plantilla.get('contenido_base', ''), formatos_de_campos(campos))
+        except ErrorPlantilla as e:
+            errores.append(str(e))
+    return errores
+
+
+def _sha256(datos):
+    return hashlib.sha256(datos).hexdigest()
+
+
+def exportar_paquete(ruta_destino, plantillas):
+    """Empaqueta plantillas (nombre -> plantilla) con sus recursos y sumas de control"""
+    ruta_destino = Path(ruta_destino)
+    manifiesto = {
+        'formato': 'minudoc-paquete',
+        'version': VERSION_PAQUETE,
+        'creado': datetime.now().isoformat(),
+        'plantillas': [],
+    }
+    descriptor, temporal = tempfile.mkstemp(suffix=".tmp", dir=ruta_destino.parent)
+    os.close(descriptor)
+    try:
+        with zipfile.ZipFile(temporal, 'w', compression=zipfile.ZIP_DEFLATED) as paquete:
+            for nombre, plantilla in plantillas.items():
+                datos = json.dumps(plantilla, ensure_ascii=False, indent=2).encode('utf-8')
+                entrada = {'nombre': nombre, 'archivo': f"plantillas/{nombre}.json",
+                           'sha256': _sha256(datos), 'recursos': {}}
+                paquete.writestr(entrada['archivo'], datos)
+
+                # La minuta de origen viaja como recurso de la plantilla
+                origen = plantilla.get('documento_origen')
+                if origen and os.path.isfile(origen):
+                    with open(origen, 'rb') as f:
+                        contenido = f.read()
+                    archivo_recurso = f"recursos/{nombre}/{Path(origen).name}"
+                    paquete.writestr(archivo_recurso, contenido, compress_type=zipfile.ZIP_STORED)
+                    entrada['recursos'][archivo_recurso] = _sha256(contenido)
+
+                manifiesto['plantillas'].append(entrada)
+            paquete.writestr("manifest.json", json.dumps(manifiesto, ensure_ascii=False, indent=2))
+        os.replace(temporal, ruta_destino)
+    except BaseException:
+        if os.path.exists(temporal):
+            os.unlink(temporal)
+        raise
+    return len(manifiesto['plantillas'])
+
+
+def _validar_entrada_paquete(argumentos):
+    """Verifica la suma de control y la estructura de una plantilla del paquete"""
+    nombre, datos, sha_esperado = argumentos
+    if _sha256(datos) != sha_esperado:
+        return nombre, None, "la suma de control no coincide"
+    try:
+        plantilla = json.loads(datos.decode('utf-8'))
+    except (UnicodeDecodeError, ValueError) as e:
+        return nombre, None, f"JSON inválido: {e}"
+    errores = validar_estructura_plantilla(plantilla)
+    if not errores and plantilla['nombre'] != nombre:
+        errores.append(f"el manifiesto la llama '{nombre}' pero la plantilla se llama '{plantilla['nombre']}'")
+    if errores:
+        return nombre, None, "; ".join(errores)
+    return nombre, plantilla, None
+
+
+def leer_paquete(ruta):
+    """Lee y valida en paralelo las plantillas de un paquete.
+
+    Devuelve (plantillas_validas, errores, recursos) donde plantillas_validas
+    es una lista de (nombre, plantilla) y recursos mapea nombre -> {archivo: bytes}."""
+    with zipfile.ZipFile(ruta) as paquete:
+        manifiesto = json.loads(paquete.read("manifest.json").decode('utf-8'))
+        if manifiesto.get('formato') != 'minudoc-paquete' or manifiesto.get('version', 0) > VERSION_PAQUETE:
+            raise ValueError("El archivo no es un paquete de plantillas compatible")
+
+        tareas = []
+        recursos = {}
+        errores = []
+        for posicion, entrada in enumerate(manifiesto.get('plantillas', []), 1):
+            if not isinstance(entrada, dict):
+                errores.append((f"entrada {posicion}", "el manifiesto no describe esta plantilla"))
+                continue
+            nombre = entrada.get('nombre')
+            # El nombre decide dónde se escribe: uno como "../x" saldría de la carpeta
+            if not nombre_archivo_valido(nombre):
+                errores.append((str(nombre), "el nombre del manifiesto no es un nombre de archivo válido"))
+                continue
+            # Una entrada dañada se informa sin abortar la importación de las demás
+            try:
+                archivo, sha = entrada['archivo'], entrada['sha256']
+                archivos_recursos = list(entrada.get('recursos', {}).items())
+            except KeyError as e:
+                errores.append((nombre, f"al manifiesto le falta {e}"))
+                continue
+            except (TypeError, AttributeError):
+                errores.append((nombre, "los recursos del manifiesto están dañados"))
+                continue
+            try:
+                tareas.append((nombre, paquete.read(archivo), sha))
+            except (KeyError, TypeError):
+                errores.append((nombre, f"falta {archivo} en el paquete"))
+                continue
+            except zipfile.BadZipFile:
+                errores.append((nombre, f"{archivo} está dañado dentro del paquete"))
+                continue
+            for archivo, sha in archivos_recursos:
+                nombre_recurso = PurePosixPath(str(archivo)).name
+                if not nombre_archivo_valido(nombre_recurso):
+                    errores.append((nombre, f"el recurso {archivo} no tiene un nombre válido"))
+                    continue
+                try:
+                    contenido = paquete.read(archivo)
+                except (KeyError, TypeError):
+                    errores.append((nombre, f"falta el recurso {nombre_recurso} en el paquete"))
+                    continue
+                except zipfile.BadZipFile:
+                    errores.append((nombre, f"el recurso {nombre_recurso} está dañado"))
+                    continue
+                if _sha256(contenido) != sha:
+                    errores.append((nombre, f"el recurso {nombre_recurso} está dañado"))
+                    continue
+                recursos.setdefault(nombre, {})[nombre_recurso] = contenido
+
+    if len(tareas) >= MINIMO_PARA_PARALELO:
+        contexto = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=min(os.cpu_count() or 1, 8), mp_context=contexto) as ejecutor:
+            resultados = list(ejecutor.map(_validar_entrada_paquete, tareas, chunksize=16))
+    else:
+        resultados = [_validar_entrada_paquete(tarea) for tarea in tareas]
+
+    validas = []
+    for nombre, plantilla, error in resultados:
+        if error:
+            errores.append((nombre, error))
+        else:
+            validas.append((nombre, plantilla))
+    return validas, errores, recursos
+
+
+def instalar_plantillas(carpeta, plantillas, recursos, existentes, politica):
+    """Escribe las plantillas importadas aplicando una política de colisión.
+
+    'politica' es 'omitir', 'sobrescribir' o 'renombrar'. Cada plantilla se
+    escribe en un temporal y se renombra, de modo que un fallo a mitad no
+    deja archivos a medio escribir, y queda registrada en su historial.
+    Devuelve (instaladas, omitidas)."""
+    carpeta = Path(carpeta)
+    ocupados = set(existentes)
+    pendientes = []
+    omitidas = []
+    for nombre, plantilla in plantillas:
+        if not nombre_archivo_valido(nombre):
+            raise ValueError(f"Nombre de plantilla no válido: {nombre!r}")
+        original = nombre
+        if nombre in ocupados:
+            if politica == 'omitir':
+                omitidas.append(nombre)
+                continue
+            if politica == 'renombrar':
+                sufijo = 2
+                while f"{nombre} ({sufijo})" in ocupados:
+                    sufijo += 1
+                nombre = f"{nombre} ({sufijo})"
+                plantilla = dict(plantilla, nombre=nombre)
+        ocupados.add(nombre)
+
+        archivos_recurso = recursos.get(original, {})
+        if archivos_recurso:
+            carpeta_recursos = carpeta / "recursos" / nombre
+            carpeta_recursos.mkdir(parents=True, exist_ok=True)
+            for archivo, contenido in archivos_recurso.items():
+                _escribir_bytes_atomico(carpeta_recursos / archivo, contenido)
+                plantilla = dict(plantilla, documento_origen=str(carpeta_recursos / archivo))
+        pendientes.append((nombre, plantilla))
+
+    # Serializar todo antes de escribir, para no dejar el lote a medias por
+    # una plantilla inválida
+    for _, plantilla in pendientes:
+        _serializar_plantilla(plantilla)
+    for nombre, plantilla in pendientes:
+        guardar_plantilla_segura(carpeta / f"{nombre}.json", plantilla, forzar=True)
+    return [nombre for nombre, _ in pendientes], omitidas
+
+
+# ===== CACHÉ BINARIA DE PLANTILLAS =====
+#
+# Junto a cada <nombre>.json se guarda .cache/<nombre>.bin con la plantilla y
+# las posiciones de sus segmentos ya tokenizados en formato marshal. El JSON sigue siendo la
+# fuente de verdad: la caché se descarta si cambia su fecha o tamaño.
+
+VERSION_CACHE = 2
+CARPETA_CACHE = ".cache"
+
+
+def _firma_cache(estado):
+    return (VERSION_CACHE, sys.version_info[:2], estado.st_mtime_ns, estado.st_size)
+
+
+def leer_cache_plantilla(archivo, firma):
+    """(plantilla, huella) de la caché binaria si corresponde a 'firma', o None"""
+    archivo = Path(archivo)
+    ruta_cache = archivo.parent / CARPETA_CACHE / f"{archivo.stem}.bin"
+    try:
+        with open(ruta_cache, 'rb') as f:
+            registro = marshal.loads(f.read())  # marshal.load(f) lee en bloques pequeños
+        if tuple(registro['firma']) == tuple(firma):
+            plantilla = registro['plantilla']
+            _POSICIONES_PRECALCULADAS[plantilla.get('contenido_base', '')] = registro['posiciones']
+            return plantilla, registro['huella']
+    except (OSError, EOFError, ValueError, TypeError, KeyError, AttributeError):
+        pass
+    return None
+
+
+def cargar_plantilla_con_cache(archivo):
+    """Carga una plantilla usando su caché binaria si sigue vigente.
+
+    Devuelve (plantilla, huella), donde la huella es el sha256 del JSON y
+    sirve para detectar si otro usuario lo modificó antes de guardar."""
+    archivo = Path(archivo)
+    estado = archivo.stat()
+    firma = _firma_cache(estado)
+    ruta_cache = archivo.parent / CARPETA_CACHE / f"{archivo.stem}.bin"
+
+    desde_cache = leer_cache_plantilla(archivo, firma)
+    if desde_cache is not None:
+        return desde_cache
+
+    with open(archivo, 'rb') as f:
+        datos = f.read()
+    plantilla = json.loads(datos.decode('utf-8'))
+    huella = _sha256(datos)
+
+    contenido = plantilla.get('contenido_base', '') if isinstance(plantilla, dict) else ''
+    if not isinstance(contenido, str):
+        posiciones = ()
+    elif indice_vigente(plantilla.get('indice_marcadores'), contenido):
+        posiciones = posiciones_desde_indice(contenido, plantilla['indice_marcadores'])
+    else:
+        posiciones = posiciones_de_contenido(contenido)
+    temporal = None
+    try:
+        registro = marshal.dumps({'firma': firma, 'plantilla': plantilla, 'posiciones': posiciones,
+                                  'huella': huella})
+        ruta_cache.parent.mkdir(exist_ok=True)
+        descriptor, temporal = tempfile.mkstemp(suffix=".tmp", dir=ruta_cache.parent)
+        with os.fdopen(descriptor, 'wb') as f:
+            f.write(registro)
+        os.replace(temporal, ruta_cache)
+    except (OSError, ValueError):
+        pass  # Carpeta de solo lectura: se trabaja sin caché
+    finally:
+        # Si la escritura o el reemplazo fallaron, el temporal no debe quedar en .cache
+        if temporal is not None and os.path.exists(temporal):
+            try:
+                os.unlink(temporal)
+            except OSError:
+                pass
+    if posiciones:
+        _POSICIONES_PRECALCULADAS[contenido] = posiciones
+    return plantilla, huella
+
+
+# ===== MODELO DE PLANTILLAS =====
+#
+# Al guardar, cada plantilla lleva un 'indice_marcadores' calculado en una
+# sola pasada sobre el texto:
+#   huella      sha256 (16 hex) del contenido_base al que corresponde
+#   campos      id -> posiciones de sus marcadores, separadas por espacios
+#   subcampos   lista de un #para -> subcampos usados ([[item.subcampo]])
+#   marcadores  posición de cada '[[' del texto, en orden
+# Mientras la huella coincida, cargar, generar y revisar la plantilla usan
+# el índice en vez de volver a recorrer el texto.
+
+VERSION_INDICE_MARCADORES = 1
+
+
+def _huella_texto(contenido):
+    return hashlib.sha256(contenido.encode('utf-8')).hexdigest()[:16]
+
+
+def calcular_indice_marcadores(contenido):
+    campos = {}
+    subcampos = {}
+    marcadores = []
+    bloques_para = []  # (variable, lista) de los #para abiertos
+
+    def anotar(referencia, posicion):
+        variable, punto, subcampo = referencia.partition('.')
+        for abierta, lista in reversed(bloques_para):
+            if punto and variable == abierta:
+                if subcampo not in subcampos.setdefault(lista, []):
+                    subcampos[lista].append(subcampo)
+                return
+        campos.setdefault(referencia, []).append(posicion)
+
+    posiciones = posiciones_de_contenido(contenido)
+    for i in range(0, len(posiciones), 3):
+        if posiciones[i] != 1:
+            continue
+        inicio = posiciones[i + 1] - 2
+        marcadores.append(inicio)
+        texto = contenido[posiciones[i + 1]:posiciones[i + 2]]
+        directiva = texto.strip()
+        si = PATRON_SI.match(directiva)
+        para = PATRON_PARA.match(directiva)
+        if si:
+            anotar(si.group(1), inicio)
+        elif para:
+            anotar(para.group(2), inicio)
+            bloques_para.append(para.groups())
+        elif directiva == '/para':
+            if bloques_para:
+                bloques_para.pop()
+        elif not _es_directiva(directiva):
+            campo_id, separador, _ = texto.partition('|')
+            anotar(campo_id.strip() if separador else campo_id, inicio)
+
+    return {
+        'version': VERSION_INDICE_MARCADORES,
+        'huella': _huella_texto(contenido),
+        'campos': {campo_id: ' '.join(map(str, lista)) for campo_id, lista in campos.items()},
+        'subcampos': subcampos,
+        'marcadores': ' '.join(map(str, marcadores)),
+    }
+
+
+def indice_vigente(indice, contenido):
+    """True si el índice guardado corresponde a este contenido"""
+    return (isinstance(indice, dict) and indice.get('version') == VERSION_INDICE_MARCADORES
+            and indice.get('huella') == _huella_texto(contenido))
+
+
+def indice_de_plantilla(plantilla):
+    """Índice guardado en el dict de la plantilla, o recién calculado si ya no vale"""
+    contenido = plantilla.get('contenido_base', '')
+    indice = plantilla.get('indice_marcadores')
+    return indice if indice_vigente(indice, contenido) else calcular_indice_marcadores(contenido)
+
+
+def posiciones_desde_indice(contenido, indice):
+    return _posiciones_segmentos(contenido, [int(inicio) for inicio in indice['marcadores'].split()])
+
+
+def revisar_plantilla(plantilla, indice=None):
+    """Problemas entre los marcadores y los campos de una plantilla (dict).
+
+    Devuelve una lista de (grave, mensaje); lo grave cambia la minuta
+    generada (por ejemplo, marcadores que saldrán como [SIN DATO])."""
+    contenido = plantilla.get('contenido_base', '')
+    campos = plantilla.get('campos_personalizados', [])
+    problemas = []
+    try:
+        compilar_contenido(contenido, formatos_de_campos(campos))
+    except ErrorPlantilla as e:
+        problemas.append((True, f"Error en las secciones: {e}"))
+    if indice is None:
+        indice = indice_de_plantilla(plantilla)
+
+    por_id = {}
+    for campo in campos:
+        if campo['id'] in por_id:
+            problemas.append((True, f"Hay dos campos con el id '{campo['id']}'"))
+        por_id[campo['id']] = campo
+
+    for campo_id, posiciones in indice['campos'].items():
+        if campo_id not in por_id:
+            veces = len(posiciones.split())
+            problemas.append((True, f"[[{campo_id}]] no corresponde a ningún campo "
+                                    f"({veces} {'vez' if veces == 1 else 'veces'}; se generará {SIN_DATO})"))
+    for lista, usados in indice['subcampos'].items():
+        campo = por_id.get(lista)
+        if campo is None:
+            continue
+        declarados = {sub['id'] for sub in campo.get('subcampos', [])}
+        for subcampo in usados:
+            if not subcampo.startswith('_') and subcampo not in declarados:
+                problemas.append((True, f"El grupo '{lista}' no tiene el subcampo '{subcampo}'"))
+    for campo in campos:
+        if campo['id'] not in indice['campos']:
+            problemas.append((False, f"El campo '{campo['nombre']}' ([[{campo['id']}]]) no aparece en el texto"))
+    return problemas
+
+
+def revisar_archivo_plantilla(ruta):
+    """(ruta, problemas) de un archivo de plantilla; se ejecuta en procesos de trabajo"""
+    try:
+        with open(ruta, 'r', encoding='utf-8') as f:
+            return ruta, revisar_plantilla(json.load(f))
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+        return ruta, [(True, f"No se pudo leer la plantilla: {e}")]
+
+
+def revisar_biblioteca(carpeta_plantillas, procesos=None, avisos=False, informar=print):
+    """Revisa todas las plantillas de la carpeta; devuelve 1 si alguna tiene errores"""
+    archivos = sorted(str(ruta) for ruta in Path(carpeta_plantillas).glob("*.json"))
+    if len(archivos) >= MINIMO_PARA_PARALELO and procesos != 1:
+        contexto = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=procesos or os.cpu_count() or 1, mp_context=contexto) as ejecutor:
+            resultados = list(ejecutor.map(revisar_archivo_plantilla, archivos, chunksize=16))
+    else:
+        resultados = [revisar_archivo_plantilla(ruta) for ruta in archivos]
+
+    con_errores = 0
+    for ruta, problemas in resultados:
+        graves = [mensaje for grave, mensaje in problemas if grave]
+        mostrar = [(grave, mensaje) for grave, mensaje in problemas if grave or avisos]
+        con_errores += bool(graves)
+        if mostrar:
+            informar(Path(ruta).stem)
+            for grave, mensaje in mostrar:
+                informar(f"  {'✖' if grave else '·'} {mensaje}")
+    informar(f"{len(archivos)} plantillas revisadas; {con_errores} con errores")
+    return 1 if con_errores else 0
+
+
+class Campo:
+    """Campo personalizado de una plantilla"""
+    __slots__ = ('id', 'nombre', 'tipo', 'descripcion', 'requerido',
+                 'opciones', 'subcampos', 'validacion', 'formato', 'extras')
+
+    CLAVES = ('id', 'nombre', 'tipo', 'descripcion', 'requerido',
+              'opciones', 'subcampos', 'validacion', 'formato')
+
+    def __init__(self, id, nombre, tipo='texto', descripcion='', requerido=False,
+                 opciones=(), subcampos=(), validacion=None, formato='', extras=None):
+        self.id = sys.intern(id)
+        self.nombre = nombre
+        self.tipo = sys.intern(tipo or 'texto')
+        self.descripcion = descripcion
+        self.requerido = bool(requerido)
+        self.opciones = tuple(opciones)
+        self.subcampos = tuple(subcampos)
+        self.validacion = validacion
+        self.formato = formato
+        self.extras = extras or {}
+
+    @classmethod
+    def desde_dict(cls, datos):
+        extras = {clave: valor for clave, valor in datos.items() if clave not in cls.CLAVES}
+        return cls(datos['id'], datos['nombre'], datos.get('tipo', 'texto'),
+                   datos.get('descripcion', ''), datos.get('requerido', False),
+                   datos.get('opciones', ()), datos.get('subcampos', ()),
+                   datos.get('validacion'), datos.get('formato', ''), extras)
+
+    def a_dict(self):
+        datos = {
+            'id': self.id,
+            'nombre': self.nombre,
+            'tipo': self.tipo,
+            'descripcion': self.descripcion,
+            'requerido': self.requerido
+        }
+        if self.opciones:
+            datos['opciones'] = list(self.opciones)
+        if self.subcampos:
+            datos['subcampos'] = [dict(sub) for sub in self.subcampos]
+        if self.validacion:
+            datos['validacion'] = dict(self.validacion)
+        if self.formato:
+            datos['formato'] = self.formato
+        datos.update(self.extras)
+        return datos
+
+
+class Plantilla:
+    """Plantilla cargada con sus tablas de búsqueda precalculadas"""
+    __slots__ = ('nombre', 'descripcion', 'tipo', 'fecha_creacion', 'documento_origen',
+                 'contenido_base', 'campos', 'campos_por_id', 'requeridos', 'marcadores',
+                 'formatos', 'extras', 'huella', 'version', 'fecha_modificacion', 'fuente_datos',
+                 'indice_marcadores', '_validadores')
+
+    CLAVES = ('nombre', 'descripcion', 'tipo', 'fecha_creacion', 'campos_personalizados',
+              'contenido_base', 'documento_origen', 'version', 'fecha_modificacion', 'fuente_datos',
+              'indice_marcadores')
+
+    def __init__(self, nombre, descripcion='', tipo='General', fecha_creacion='',
+                 documento_origen='', contenido_base='', campos=(), extras=None, huella='',
+                 version=0, fecha_modificacion='', fuente_datos=None, indice_marcadores=None):
+        self.nombre = nombre
+        self.descripcion = descripcion
+        self.tipo = sys.intern(tipo)
+        self.fecha_creacion = fecha_creacion
+        self.documento_origen = documento_origen
+        self.contenido_base = contenido_base
+        self.campos = tuple(campos)
+        self.campos_por_id = {campo.id: campo for campo in self.campos}
+        self.requeridos = frozenset(campo.id for campo in self.campos if campo.requerido)
+        if not indice_vigente(indice_marcadores, contenido_base):
+            indice_marcadores = calcular_indice_marcadores(contenido_base)
+        self.indice_marcadores = indice_marcadores
+        self.marcadores = frozenset(indice_marcadores['campos'])
+        self.formatos = tuple((campo.id, campo.formato) for campo in self.campos if campo.formato)
+        self.extras = extras or {}
+        self.huella = huella
+        self.version = version
+        self.fecha_modificacion = fecha_modificacion
+        self.fuente_datos = fuente_datos
+        self._validadores = None
+
+    @classmethod
+    def desde_dict(cls, datos, nombre=None, huella=''):
+        extras = {clave: valor for clave, valor in datos.items() if clave not in cls.CLAVES}
+        return cls(datos.get('nombre') or nombre or '', datos.get('descripcion', ''),
+                   datos.get('tipo', 'General'), datos.get('fecha_creacion', ''),
+                   datos.get('documento_origen', ''), datos.get('contenido_base', ''),
+                   [Campo.desde_dict(campo) for campo in datos.get('campos_personalizados', [])],
+                   extras, huella, datos.get('version', 0), datos.get('fecha_modificacion', ''),
+                   datos.get('fuente_datos'), datos.get('indice_marcadores'))
+
+    def a_dict(self):
+        datos = {
+            'nombre': self.nombre,
+            'descripcion': self.descripcion,
+            'tipo': self.tipo,
+            'fecha_creacion': self.fecha_creacion,
+            'campos_personalizados': [campo.a_dict() for campo in self.campos],
+            'contenido_base': self.contenido_base,
+            'documento_origen': self.documento_origen
+        }
+        if self.version:
+            datos['version'] = self.version
+            datos['fecha_modificacion'] = self.fecha_modificacion
+        if self.fuente_datos:
+            datos['fuente_datos'] = self.fuente_datos
+        datos['indice_marcadores'] = self.indice_marcadores
+        datos.update(self.extras)
+        return datos
+
+    def validadores(self):
+        if self._validadores is None:
+            self._validadores = compilar_validadores(self.campos)
+        return self._validadores
+
+
+# ===== BÚSQUEDA DE PLANTILLAS =====
+
+def normalizar_busqueda(texto):
+    """Minúsculas y sin tildes, para comparar nombres al buscar"""
+    descompuesto = unicodedata.normalize('NFKD', texto.casefold())
+    return ''.join(c for c in descompuesto if not unicodedata.combining(c))
+
+
+LIMITE_SELECTOR_PLANTILLAS = 200
+
+
+class IndiceBusqueda:
+    """Índice incremental de nombres de plantillas por prefijo, subcadena y tipo.
+
+    Cada nombre normalizado se indexa por todas sus subcadenas de 1 a 3
+    caracteres; una consulta más larga intersecta los conjuntos de sus
+    trigramas y confirma los pocos candidatos que quedan."""
+    N = 3
+
+    def __init__(self):
+        self.normalizados = {}      # nombre -> nombre normalizado
+        self.tipos = {}             # nombre -> tipo
+        self.ordenados = []         # (normalizado, nombre), para búsqueda por prefijo
+        self.gramas = {}            # subcadena -> set(nombres)
+        self.por_tipo = {}          # tipo -> set(nombres)
+
+    def _gramas_de(self, normalizado):
+        return {normalizado[i:i + n] for n in range(1, self.N + 1)
+                for i in range(len(normalizado) - n + 1)}
+
+    def agregar(self, nombre, tipo):
+        if nombre in self.normalizados:
+            if self.tipos[nombre] == tipo:
+                return
+            self.quitar(nombre)
+        normalizado = normalizar_busqueda(nombre)
+        self.normalizados[nombre] = normalizado
+        self.tipos[nombre] = tipo
+        bisect.insort(self.ordenados, (normalizado, nombre))
+        for grama in self._gramas_de(normalizado):
+            self.gramas.setdefault(grama, set()).add(nombre)
+        self.por_tipo.setdefault(tipo, set()).add(nombre)
+
+    def quitar(self, nombre):
+        normalizado = self.normalizados.pop(nombre, None)
+        if normalizado is None:
+            return
+        tipo = self.tipos.pop(nombre)
+        posicion = bisect.bisect_left(self.ordenados, (normalizado, nombre))
+        del self.ordenados[posicion]
+        for grama in self._gramas_de(normalizado):
+            conjunto = self.gramas[grama]
+            conjunto.discard(nombre)
+            if not conjunto:
+                del self.gramas[grama]
+        self.por_tipo[tipo].discard(nombre)
+
+    def sincronizar(self, tipos_por_nombre):
+        """Actualiza el índice solo con las plantillas nuevas, cambiadas o borradas"""
+        for nombre in [n for n in self.normalizados if n not in tipos_por_nombre]:
+            self.quitar(nombre)
+        for nombre, tipo in tipos_por_nombre.items():
+            self.agregar(nombre, tipo)
+
+    def buscar(self, consulta='', tipo=''):
+        """Nombres que contienen la consulta; primero los que empiezan por ella"""
+        consulta = normalizar_busqueda(consulta.strip())
+        if not consulta:
+            candidatos = None
+        elif len(consulta) <= self.N:
+            candidatos = self.gramas.get(consulta, set())
+        else:
+            conjuntos = sorted((self.gramas.get(consulta[i:i + self.N], set())
+                                for i in range(len(consulta) - self.N + 1)), key=len)
+            candidatos = set(conjuntos[0]).intersection(*conjuntos[1:])
+            candidatos = {n for n in candidatos if consulta in self.normalizados[n]}
+
+        if tipo:
+            filtro_tipo = self.por_tipo.get(tipo, set())
+            candidatos = filtro_tipo if candidatos is None else candidatos & filtro_tipo
+
+        if candidatos is None:
+            return [nombre for _, nombre in self.ordenados]
+
+        # Los que empiezan por la consulta salen en orden del rango de bisect
+        inicio = bisect.bisect_left(self.ordenados, (consulta,))
+        fin = bisect.bisect_left(self.ordenados, (consulta + '\uffff',))
+        prefijos = [nombre for _, nombre in self.ordenados[inicio:fin] if nombre in candidatos]
+        vistos = set(prefijos)
+        resto = sorted((self.normalizados[n], n) for n in candidatos if n not in vistos)
+        return prefijos + [nombre for _, nombre in resto]
+
+    def tipos_disponibles(self):
+        return sorted(tipo for tipo, nombres in self.por_tipo.items() if nombres)
+
+    def estado(self):
+        """Tablas del índice, para guardarlas en la sesión"""
+        return (self.normalizados, self.tipos, self.ordenados, self.gramas, self.por_tipo)
+
+    @classmethod
+    def desde_estado(cls, estado):
+        indice = cls()
+        indice.normalizados, indice.tipos, indice.ordenados, indice.gramas, indice.por_tipo = estado
+        return indice
+
+
+# ===== SIMILITUD ENTRE PLANTILLAS =====
+#
+# Cada contenido se resume en una firma MinHash de BITS_FIRMA valores
+# calculada con una sola permutación: el hash de cada tejado (secuencia de
+# LARGO_TEJADO palabras) cae en una casilla y la casilla guarda el menor.
+# La firma se parte en bandas; dos plantillas son candidatas a duplicado si
+# comparten alguna banda completa (LSH), de modo que solo se comparan los
+# pares que probablemente se parecen en vez de todos contra todos.
+
+LARGO_TEJADO = 5
+BITS_FIRMA = 128
+FILAS_POR_BANDA = 8
+UMBRAL_CASI_DUPLICADOS = 0.7
+UMBRAL_AVISO_DUPLICADO = 0.95
+LIMITE_SIMILITUD = 0.25  # segundos para comparar las líneas al buscar duplicados
+_MASCARA_HASH = (1 << 64) - 1
+_VACIO = _MASCARA_HASH
+
+
+def firma_minhash(contenido):
+    """Firma MinHash del texto, sin tener en cuenta mayúsculas ni marcadores"""
+    palabras = re.sub(r'\[\[[^\]]*\]\]', ' § ', contenido.casefold()).split()
+    if not palabras:
+        return None
+    if len(palabras) < LARGO_TEJADO:
+        tejados = {hash(tuple(palabras)) & _MASCARA_HASH}
+    else:
+        tejados = {hash(tejado) & _MASCARA_HASH
+                   for tejado in zip(*(palabras[i:] for i in range(LARGO_TEJADO)))}
+
+    # Al recorrer de mayor a menor, en cada casilla queda el menor valor
+    minimos = {h % BITS_FIRMA: h // BITS_FIRMA for h in sorted(tejados, reverse=True)}
+    if len(minimos) == BITS_FIRMA:
+        return tuple(minimos[casilla] for casilla in range(BITS_FIRMA))
+
+    # Casillas vacías (textos cortos): se copian de la siguiente ocupada
+    firma = [minimos.get(casilla, _VACIO) for casilla in range(BITS_FIRMA)]
+    for casilla in range(BITS_FIRMA):
+        salto = 1
+        while firma[casilla] == _VACIO:
+            vecina = minimos.get((casilla + salto) % BITS_FIRMA)
+            if vecina is not None:
+                firma[casilla] = vecina + salto
+            salto += 1
+    return tuple(firma)
+
+
+def similitud_firmas(a, b):
+    """Estimación de la similitud de Jaccard entre dos contenidos"""
+    return sum(1 for x, y in zip(a, b) if x == y) / BITS_FIRMA
+
+
+def similitud_textos(a, b, plazo=None):
+    """Proporción de líneas idénticas entre dos contenidos (0 a 1).
+
+    Las líneas se comparan por su hash con el diff de Myers acotado por
+    'plazo': si se agota, lo que falta por comparar cuenta como distinto."""
+    lineas_a = [hash(linea) for linea in a.splitlines()]
+    lineas_b = [hash(linea) for linea in b.splitlines()]
+    total = len(lineas_a) + len(lineas_b)
+    if not total:
+        return 1.0
+    # Cota superior barata: las líneas en común sin importar el orden
+    cota = 2 * sum((Counter(lineas_a) & Counter(lineas_b)).values()) / total
+    if cota < UMBRAL_AVISO_DUPLICADO * 0.9:
+        return cota
+    if plazo is None:
+        plazo = time.monotonic() + LIMITE_SIMILITUD
+    iguales = sum(i2 - i1 for etiqueta, i1, i2, _, _ in operaciones_diferencia(lineas_a, lineas_b, plazo)
+                  if etiqueta == 'equal')
+    return 2 * iguales / total
+
+
+class IndiceSimilitud:
+    """Índice LSH incremental de las firmas de contenido de las plantillas"""
+    def __init__(self):
+        self.firmas = {}        # nombre -> (huella, firma)
+        self.contenidos = {}    # nombre -> contenido_base
+        self.cubetas = {}       # (banda, valores) -> set(nombres)
+
+    def _bandas(self, firma):
+        for inicio in range(0, BITS_FIRMA, FILAS_POR_BANDA):
+            yield (inicio, firma[inicio:inicio + FILAS_POR_BANDA])
+
+    def agregar(self, nombre, contenido, huella=''):
+        actual = self.firmas.get(nombre)
+        if actual is not None:
+            if huella and actual[0] == huella:
+                return
+            self.quitar(nombre)
+        firma = firma_minhash(contenido)
+        if firma is None:
+            return
+        self.firmas[nombre] = (huella, firma)
+        self.contenidos[nombre] = contenido
+        for banda in self._bandas(firma):
+            self.cubetas.setdefault(banda, set()).add(nombre)
+
+    def quitar(self, nombre):
+        actual = self.firmas.pop(nombre, None)
+        self.contenidos.pop(nombre, None)
+        if actual is None:
+            return
+        for banda in self._bandas(actual[1]):
+            cubeta = self.cubetas[banda]
+            cubeta.discard(nombre)
+            if not cubeta:
+                del self.cubetas[banda]
+
+    def sincronizar(self, plantillas):
+        """Recalcula solo las firmas de las plantillas nuevas o modificadas"""
+        for nombre in [n for n in self.firmas if n not in plantillas]:
+            self.quitar(nombre)
+        for nombre, plantilla in plantillas.items():
+            self.agregar(nombre, plantilla.contenido_base, plantilla.huella)
+
+    def candidatos(self, firma):
+        encontrados = set()
+        for banda in self._bandas(firma):
+            encontrados.update(self.cubetas.get(banda, ()))
+        return encontrados
+
+    def similares(self, contenido, umbral=UMBRAL_AVISO_DUPLICADO, excluir=None):
+        """Plantillas cuyo texto coincide al menos en 'umbral', de mayor a menor"""
+        firma = firma_minhash(contenido)
+        if firma is None:
+            return []
+        # Un solo plazo para todos los candidatos, que se comparan empezando
+        # por los de firma más parecida: se llama al guardar, en la interfaz
+        plazo = time.monotonic() + LIMITE_SIMILITUD
+        candidatos = sorted(self.candidatos(firma) - {excluir},
+                            key=lambda nombre: -similitud_firmas(firma, self.firmas[nombre][1]))
+        resultado = []
+        for nombre in candidatos:
+            similitud = similitud_textos(contenido, self.contenidos[nombre], plazo)
+            if similitud >= umbral:
+                resultado.append((nombre, similitud))
+        return sorted(resultado, key=lambda par: -par[1])
+
+    def grupos(self, umbral=UMBRAL_CASI_DUPLICADOS, comparaciones_por_cubeta=8):
+        """Grupos de plantillas casi duplicadas, de mayor a menor tamaño.
+
+        Solo se comparan plantillas que comparten una cubeta, y cada una
+        contra las primeras de la cubeta: en cubetas muy pobladas basta con
+        unirla a alguna de ellas para que quede en el grupo."""
+        padres = {}
+
+        def raiz(nombre):
+            padres.setdefault(nombre, nombre)
+            while padres[nombre] != nombre:
+                padres[nombre] = padres[padres[nombre]]
+                nombre = padres[nombre]
+            return nombre
+
+        for cubeta in self.cubetas.values():
+            if len(cubeta) < 2:
+                continue
+            miembros = sorted(cubeta)
+            for i, nombre in enumerate(miembros):
+                firma = self.firmas[nombre][1]
+                for otro in miembros[:min(i, comparaciones_por_cubeta)]:
+                    a, b = raiz(nombre), raiz(otro)
+                    if a != b and similitud_firmas(firma, self.firmas[otro][1]) >= umbral:
+                        padres[a] = b
+
+        por_raiz = {}
+        for nombre in padres:
+            por_raiz.setdefault(raiz(nombre), []).append(nombre)
+        return sorted((sorted(grupo) for grupo in por_raiz.values() if len(grupo) > 1),
+                      key=lambda grupo: (-len(grupo), grupo[0]))
+
+
+# ===== DIARIO DE AUTOGUARDADO DEL EDITOR =====
+#
+# Cada operación del editor se agrega como una línea JSON en
+# datos_minudoc/diarios/<clave>.diario, en el equipo de cada usuario y no en
+# la carpeta de plantillas, que puede ser compartida: el diario tiene el texto
+# de la minuta y es trabajo sin guardar de quien lo escribe. Un hilo en
+# segundo plano escribe las líneas y,
+# cada LIMITE_OPERACIONES_DIARIO operaciones, compacta el archivo en una
+# sola instantánea. Los cambios de texto se registran como el tramo
+# reemplazado (inicio, fin, texto nuevo), no como el documento completo.
+
+CARPETA_DIARIOS = "diarios"
+LIMITE_OPERACIONES_DIARIO = 200
+RETARDO_DIARIO_MS = 800
+ESPERA_CIERRE_DIARIO = 0.2  # segundos que se espera al hilo del diario al cerrar el editor
+_BLOQUE_COMPARACION = 4096
+
+
+def _largo_prefijo_comun(a, b):
+    limite = min(len(a), len(b))
+    i = 0
+    while i < limite and a[i:i + _BLOQUE_COMPARACION] == b[i:i + _BLOQUE_COMPARACION]:
+        i += _BLOQUE_COMPARACION
+    i = min(i, limite)
+    fin_bloque = min(i + _BLOQUE_COMPARACION, limite)
+    while i < fin_bloque and a[i] == b[i]:
+        i += 1
+    return i
+
+
+def _largo_sufijo_comun(a, b, limite):
+    j = 0
+    while (j + _BLOQUE_COMPARACION <= limite
+           and a[len(a) - j - _BLOQUE_COMPARACION:len(a) - j] == b[len(b) - j - _BLOQUE_COMPARACION:len(b) - j]):
+        j += _BLOQUE_COMPARACION
+    while j < limite and a[len(a) - j - 1] == b[len(b) - j - 1]:
+        j += 1
+    return j
+
+
+def diferencia_texto(anterior, nuevo):
+    """Operación mínima (inicio, fin, texto) que convierte 'anterior' en 'nuevo'"""
+    if anterior == nuevo:
+        return None
+    prefijo = _largo_prefijo_comun(anterior, nuevo)
+    sufijo = _largo_sufijo_comun(anterior, nuevo, min(len(anterior), len(nuevo)) - prefijo)
+    return {'op': 'texto', 'i': prefijo, 'f': len(anterior) - sufijo,
+            't': nuevo[prefijo:len(nuevo) - sufijo]}
+
+
+def aplicar_operacion_diario(estado, operacion):
+    tipo = operacion['op']
+    if tipo == 'instantanea':
+        estado.clear()
+        estado.update(texto=operacion['texto'], campos=operacion['campos'],
+                      mapeo=operacion['mapeo'], info=operacion['info'])
+    elif tipo == 'texto':
+        texto = estado['texto']
+        estado['texto'] = texto[:operacion['i']] + operacion['t'] + texto[operacion['f']:]
+    elif tipo == 'campo_nuevo':
+        estado['campos'].insert(operacion.get('indice', len(estado['campos'])), operacion['campo'])
+        if operacion.get('texto_original') is not None:
+            estado['mapeo'][operacion['campo']['id']] = {
+                'texto_original': operacion['texto_original'],
+                'marcador': f"[[{operacion['campo']['id']}]]"
+            }
+    elif tipo == 'campo_editado':
+        estado['campos'][operacion['indice']] = operacion['campo']
+    elif tipo == 'campo_eliminado':
+        campo = estado['campos'].pop(operacion['indice'])
+        estado['mapeo'].pop(campo['id'], None)
+    elif tipo == 'info':
+        estado['info'] = operacion['info']
+
+
+class DiarioEditor:
+    """Diario de operaciones del editor de plantillas, escrito en segundo plano"""
+    def __init__(self, ruta, estado_inicial):
+        self.ruta = Path(ruta)
+        self.ruta.parent.mkdir(parents=True, exist_ok=True)
+        self.estado = json.loads(json.dumps(estado_inicial))
+        self.operaciones_registradas = 0
+        self.descartar = False
+        self.cola = queue.Queue()
+        self.hilo = threading.Thread(target=self._escribir, daemon=True)
+        self.hilo.start()
+
+    def registrar(self, operacion):
+        self.operaciones_registradas += 1
+        self.cola.put(dict(operacion, ts=round(time.time(), 3)))
+
+    def _escribir(self):
+        self._compactar()
+        archivo = open(self.ruta, 'a', encoding='utf-8')
+        pendientes = 0
+        try:
+            while True:
+                lote = [self.cola.get()]
+                while True:
+                    try:
+                        lote.append(self.cola.get_nowait())
+                    except queue.Empty:
+                        break
+                for operacion in lote:
+                    if operacion is None:
+                        return
+                    aplicar_operacion_diario(self.estado, operacion)
+                    archivo.write(json.dumps(operacion, ensure_ascii=False) + "\n")
+                    pendientes += 1
+                archivo.flush()
+                os.fsync(archivo.fileno())
+
+                if pendientes >= LIMITE_OPERACIONES_DIARIO:
+                    archivo.close()
+                    self._compactar()
+                    archivo = open(self.ruta, 'a', encoding='utf-8')
+                    pendientes = 0
+        finally:
+            archivo.close()
+            # Se borra aquí, después de la última escritura, para que no lo vuelva a crear
+            if self.descartar and self.ruta.exists():
+                self.ruta.unlink()
+
+    def _compactar(self):
+        instantanea = dict(self.estado, op='instantanea', ts=round(time.time(), 3))
+        _escribir_bytes_atomico(self.ruta, (json.dumps(instantanea, ensure_ascii=False) + "\n").encode('utf-8'))
+
+    def cerrar(self, descartar=False):
+        """Termina el diario sin bloquear la interfaz: el hilo escribe lo pendiente y
+        termina solo. Con 'descartar' borra el archivo al terminar."""
+        self.descartar = descartar
+        self.cola.put(None)
+        self.hilo.join(timeout=ESPERA_CIERRE_DIARIO)
+
+    @staticmethod
+    def recuperar(ruta):
+        """Reconstruye el estado del editor a partir de un diario, o None"""
+        estado = {}
+        ultima = None
+        try:
+            with open(ruta, 'r', encoding='utf-8') as f:
+                for linea in f:
+                    try:
+                        operacion = json.loads(linea)
+                    except ValueError:
+                        break  # Última línea cortada por un cierre inesperado
+                    aplicar_operacion_diario(estado, operacion)
+                    ultima = operacion.get('ts')
+        except OSError:
+            return None
+        if 'texto' not in estado:
+            return None
+        estado['fecha'] = ultima
+        return estado
+
+    @staticmethod
+    def ruta_para(carpeta_plantillas, clave, carpeta=None):
+        """Diario local de una plantilla o minuta; la carpeta de plantillas entra en la clave"""
+        clave = f"{Path(carpeta_plantillas).resolve()}|{clave}"
+        nombre = hashlib.sha1(clave.encode('utf-8')).hexdigest()[:16]
+        return Path(carpeta or CARPETA_DATOS) / CARPETA_DIARIOS / f"{nombre}.diario"
+
+
+# ===== DESHACER EN EL EDITOR =====
+#
+# Cada cambio del editor se guarda como (descripción, tramos, campos):
+#   tramos: (posición, texto anterior, texto nuevo) aplicados en ese orden
+#   campos: (índice, campo anterior, campo nuevo, mapeo anterior, mapeo nuevo);
+#           None en el anterior es un alta y None en el nuevo, una baja
+# Así deshacer cuesta lo que mide el tramo, no una copia del documento.
+
+MAXIMO_DESHACER = 500
+MAXIMO_CARACTERES_DESHACER = 2_000_000
+
+
+def _peso_cambio(cambio):
+    _, tramos, campos = cambio
+    return sum(len(anterior) + len(nuevo) for _, anterior, nuevo in tramos) + 100 * len(campos)
+
+
+class HistorialDeshacer:
+    """Pilas de deshacer/rehacer acotadas por cantidad de pasos y de caracteres"""
+    def __init__(self, maximo=MAXIMO_DESHACER, maximo_caracteres=MAXIMO_CARACTERES_DESHACER):
+        self.maximo = maximo
+        self.maximo_caracteres = maximo_caracteres
+        self.pasos = deque()
+        self.deshechos = []
+        self.caracteres = 0
+
+    def _apilar(self, cambio):
+        self.pasos.append(cambio)
+        self.caracteres += _peso_cambio(cambio)
+        # Se descartan los pasos más antiguos, pero nunca el último
+        while len(self.pasos) > 1 and (len(self.pasos) > self.maximo
+                                       or self.caracteres > self.maximo_caracteres):
+            self.caracteres -= _peso_cambio(self.pasos.popleft())
+
+    def registrar(self, descripcion, tramos=(), campos=()):
+        if tramos or campos:
+            self._apilar((descripcion, tuple(tramos), tuple(campos)))
+            self.deshechos.clear()
+
+    def deshacer(self):
+        if not self.pasos:
+            return None
+        cambio = self.pasos.pop()
+        self.caracteres -= _peso_cambio(cambio)
+        self.deshechos.append(cambio)
+        return cambio
+
+    def rehacer(self):
+        if not self.deshechos:
+            return None
+        cambio = self.deshechos.pop()
+        self._apilar(cambio)
+        return cambio
+
+    def limpiar(self):
+        self.pasos.clear()
+        self.deshechos.clear()
+        self.caracteres = 0
+
+
+# ===== CONFIGURACIÓN LOCAL =====
+#
+# Preferencias de este equipo en datos_minudoc/configuracion.json. Todo lo
+# que guarda datos de uso (como la auditoría) está desactivado por defecto.
+
+CARPETA_DATOS = Path("datos_minudoc")
+ARCHIVO_CONFIGURACION = "configuracion.json"
+CONFIGURACION_INICIAL = {'auditoria': False, 'autocompletado': False}
+
+
+def leer_configuracion(carpeta=CARPETA_DATOS):
+    configuracion = dict(CONFIGURACION_INICIAL)
+    try:
+        with open(Path(carpeta) / ARCHIVO_CONFIGURACION, 'r', encoding='utf-8') as f:
+            configuracion.update(json.load(f))
+    except (FileNotFoundError, ValueError):
+        pass
+    return configuracion
+
+
+def guardar_configuracion(configuracion, carpeta=CARPETA_DATOS):
+    Path(carpeta).mkdir(parents=True, exist_ok=True)
+    escribir_json_atomico(Path(carpeta) / ARCHIVO_CONFIGURACION, configuracion)
+
+
+# ===== SESIÓN DE TRABAJO =====
+#
+# Al cerrar, la aplicación guarda en datos_minudoc/sesion.bin (marshal) lo
+# necesario para reabrir al instante: el nombre de cada plantilla ya leída
+# con la firma de su archivo, que es también la clave de su caché binaria,
+# el índice de búsqueda y el estado de la ventana. Las plantillas no se
+# copian en la sesión: al abrir se toman de la caché de cada una sin mirar
+# la carpeta y, cuando la ventana ya está a la vista, se comparan las firmas
+# con la carpeta y se vuelven a leer solo las plantillas que cambiaron.
+# Los valores del formulario solo se guardan con "Recordar valores".
+
+ARCHIVO_SESION = "sesion.bin"
+VERSION_SESION = 2
+
+
+def guardar_sesion(sesion, carpeta=CARPETA_DATOS):
+    Path(carpeta).mkdir(parents=True, exist_ok=True)
+    sesion = dict(sesion, version=VERSION_SESION, python=sys.version_info[:2])
+    _escribir_bytes_atomico(Path(carpeta) / ARCHIVO_SESION, marshal.dumps(sesion))
+
+
+def leer_sesion(carpeta=CARPETA_DATOS):
+    """Sesión guardada, o None si no hay o es de otra versión"""
+    try:
+        with open(Path(carpeta) / ARCHIVO_SESION, 'rb') as f:
+            sesion = marshal.loads(f.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if (not isinstance(sesion, dict) or sesion.get('version') != VERSION_SESION
+            or tuple(sesion.get('python', ())) != sys.version_info[:2]):
+        return None
+    return sesion
+
+
+def borrar_sesion(carpeta=CARPETA_DATOS):
+    try:
+        (Path(carpeta) / ARCHIVO_SESION).unlink()
+    except FileNotFoundError:
+        pass
+
+
+# ===== AUDITORÍA DE GENERACIÓN =====
+#
+# Registro opcional de cada minuta generada, solo de agregado, en
+# segmentos JSONL (segmento_000001.jsonl, ...) que rotan al llegar a
+# TAMANO_SEGMENTO_AUDITORIA. Al cerrar un segmento se guarda su resumen
+# (rango de fechas y plantillas) en indice.json, y las consultas saltan
+# los segmentos cuyo resumen no coincide. No se guardan los valores de los
+# campos, solo su huella. La escritura la hace un hilo en segundo plano:
+# registrar un evento solo lo pone en una cola.
+
+CARPETA_AUDITORIA = "auditoria"
+TAMANO_SEGMENTO_AUDITORIA = 8 * 1024 * 1024
+_PATRON_SEGMENTO = "segmento_{:06d}.jsonl"
+
+
+def huella_datos(datos):
+    serializado = json.dumps(datos, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(serializado.encode('utf-8')).hexdigest()[:32]
+
+
+def _segmentos_auditoria(carpeta):
+    return sorted(Path(carpeta).glob("segmento_*.jsonl"))
+
+
+def _resumir_segmento(ruta):
+    resumen = {'desde': None, 'hasta': None, 'plantillas': {}, 'registros': 0}
+    with open(ruta, 'r', encoding='utf-8') as f:
+        for linea in f:
+            try:
+                evento = json.loads(linea)
+            except ValueError:
+                continue    # Línea truncada por un cierre abrupto
+            fecha = evento['ts']
+            resumen['desde'] = min(resumen['desde'] or fecha, fecha)
+            resumen['hasta'] = max(resumen['hasta'] or fecha, fecha)
+            resumen['plantillas'][evento['plantilla']] = resumen['plantillas'].get(evento['plantilla'], 0) + 1
+            resumen['registros'] += 1
+    return resumen
+
+
+def _leer_indice_auditoria(carpeta):
+    try:
+        with open(Path(carpeta) / "indice.json", 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {'segmentos': {}}
+
+
+class RegistroAuditoria:
+    """Escritor en segundo plano del registro de auditoría"""
+    def __init__(self, carpeta=CARPETA_DATOS / CARPETA_AUDITORIA, tamano_segmento=TAMANO_SEGMENTO_AUDITORIA):
+        self.carpeta = Path(carpeta)
+        self.carpeta.mkdir(parents=True, exist_ok=True)
+        self.tamano_segmento = tamano_segmento
+        self.cola = queue.Queue()
+        self.hilo = threading.Thread(target=self._escribir, daemon=True)
+        self.hilo.start()
+
+    def registrar(self, plantilla, datos, salida, duracion, modo='individual', registro=None):
+        """Encola una generación; la huella de los datos se calcula en el hilo"""
+        self.cola.put((datetime.now().isoformat(timespec='seconds'), plantilla.nombre, plantilla.version,
+                       plantilla.huella, datos, str(salida), duracion, modo, registro))
+
+    def cerrar(self):
+        self.cola.put(None)
+        self.hilo.join()
+
+    def _ruta_actual(self):
+        segmentos = _segmentos_auditoria(self.carpeta)
+        if not segmentos:
+            return self.carpeta / _PATRON_SEGMENTO.format(1)
+        ultimo = segmentos[-1]
+        if ultimo.stat().st_size < self.tamano_segmento:
+            return ultimo
+        return self._rotar(ultimo)
+
+    def _rotar(self, ruta):
+        """Cierra el segmento 'ruta' guardando su resumen y devuelve el siguiente"""
+        indice = _leer_indice_auditoria(self.carpeta)
+        indice['segmentos'][ruta.name] = _resumir_segmento(ruta)
+        escribir_json_atomico(self.carpeta / "indice.json", indice)
+        numero = int(ruta.stem.split('_')[1]) + 1
+        return self.carpeta / _PATRON_SEGMENTO.format(numero)
+
+    def _escribir(self):
+        ruta = self._ruta_actual()
+        terminar = False
+        while not terminar:
+            pendientes = [self.cola.get()]
+            # Se escribe de una vez todo lo que se haya acumulado
+            while True:
+                try:
+                    pendientes.append(self.cola.get_nowait())
+                except queue.Empty:
+                    break
+            lineas = []
+            for evento in pendientes:
+                if evento is None:
+                    terminar = True
+                    continue
+                fecha, nombre, version, huella, datos, salida, duracion, modo, registro = evento
+                linea = {'ts': fecha, 'plantilla': nombre, 'version': version, 'huella': huella[:16],
+                         'datos': huella_datos(datos), 'salida': salida, 'ms': round(duracion * 1000, 1),
+                         'modo': modo}
+                if registro is not None:
+                    linea['registro'] = registro
+                lineas.append(json.dumps(linea, ensure_ascii=False, separators=(',', ':')) + "\n")
+            if not lineas:
+                continue
+            try:
+                with open(ruta, 'a', encoding='utf-8') as f:
+                    f.write("".join(lineas))
+                    f.flush()
+                    os.fsync(f.fileno())
+                if ruta.stat().st_size >= self.tamano_segmento:
+                    ruta = self._rotar(ruta)
+            except OSError as e:
+                print(f"No se pudo escribir la auditoría: {e}")
+
+
+def consultar_auditoria(carpeta=CARPETA_DATOS / CARPETA_AUDITORIA, plantilla=None, desde=None, hasta=None):
+    """Eventos de auditoría filtrados por plantilla y fechas.
+
+    'desde' y 'hasta' son prefijos de fecha ISO inclusivos: '2026-10'
+    abarca todo octubre y '2026-10-15' todo ese día."""
+    carpeta = Path(carpeta)
+    resumenes = _leer_indice_auditoria(carpeta)['segmentos']
+
+    def en_rango(fecha):
+        return (not desde or fecha[:len(desde)] >= desde) and (not hasta or fecha[:len(hasta)] <= hasta)
+
+    for ruta in _segmentos_auditoria(carpeta):
+        resumen = resumenes.get(ruta.name)
+        if resumen and resumen['registros']:
+            if plantilla and plantilla not in resumen['plantillas']:
+                continue
+            if (desde and resumen['hasta'][:len(desde)] < desde) or (hasta and resumen['desde'][:len(hasta)] > hasta):
+                continue
+        with open(ruta, 'r', encoding='utf-8') as f:
+            for linea in f:
+                try:
+                    evento = json.loads(linea)
+                except ValueError:
+                    continue
+                if (not plantilla or evento['plantilla'] == plantilla) and en_rango(evento['ts']):
+                    yield evento
+
+
+# ===== AUTOCOMPLETADO DE VALORES =====
+#
+# Solo se activa con la casilla "Recordar valores": guarda los valores
+# escritos en cada campo (por id, compartidos entre plantillas) para
+# sugerirlos al escribir. Se puede borrar todo con "Olvidar valores".
+
+ARCHIVO_AUTOCOMPLETADO = "autocompletado.json"
+MAXIMO_VALORES_AUTOCOMPLETADO = 5000
+LIMITE_SUGERENCIAS = 8
+
+
+class HistorialValores:
+    """Valores usados por campo, con índice de prefijos y desalojo LRU.
+
+    'recientes' guarda (campo_id, valor) -> usos en orden de uso, así el
+    primero es siempre el que se desaloja. Cada campo tiene además una lista
+    ordenada de (valor normalizado, valor) para buscar prefijos con bisect."""
+
+    def __init__(self, carpeta=CARPETA_DATOS, maximo=MAXIMO_VALORES_AUTOCOMPLETADO):
+        self.ruta = Path(carpeta) / ARCHIVO_AUTOCOMPLETADO
+        self.maximo = maximo
+        self.recientes = OrderedDict()
+        self.indices = {}
+        try:
+            with open(self.ruta, 'r', encoding='utf-8') as f:
+                guardado = json.load(f)
+        except (FileNotFoundError, ValueError):
+            guardado = {}
+        for campo_id, valor, usos in guardado.get('valores', []):
+            self._agregar(campo_id, valor, usos)
+
+    def __len__(self):
+        return len(self.recientes)
+
+    def _agregar(self, campo_id, valor, usos):
+        clave = (campo_id, valor)
+        if clave in self.recientes:
+            self.recientes[clave] += usos
+            self.recientes.move_to_end(clave)
+            return
+        self.recientes[clave] = usos
+        bisect.insort(self.indices.setdefault(campo_id, []), (normalizar_busqueda(valor), valor))
+        while len(self.recientes) > self.maximo:
+            self._quitar(*self.recientes.popitem(last=False)[0])
+
+    def _quitar(self, campo_id, valor):
+        indice = self.indices[campo_id]
+        posicion = bisect.bisect_left(indice, (normalizar_busqueda(valor), valor))
+        del indice[posicion]
+        if not indice:
+            del self.indices[campo_id]
+
+    def registrar(self, datos):
+        """Anota los valores de texto de una minuta generada y guarda el archivo"""
+        for campo_id, valor in datos.items():
+            if isinstance(valor, str) and valor.strip() and '\n' not in valor:
+                self._agregar(campo_id, valor.strip(), 1)
+        self.guardar()
+
+    def sugerencias(self, campo_id, prefijo, limite=LIMITE_SUGERENCIAS):
+        """Valores del campo que empiezan por 'prefijo', los más usados primero"""
+        indice = self.indices.get(campo_id)
+        if not indice:
+            return []
+        prefijo = normalizar_busqueda(prefijo.strip())
+        inicio = bisect.bisect_left(indice, (prefijo,))
+        fin = bisect.bisect_left(indice, (prefijo + '\uffff',), inicio)
+        candidatos = (valor for _, valor in indice[inicio:fin])
+        return heapq.nlargest(limite, candidatos, key=lambda valor: self.recientes[(campo_id, valor)])
+
+    def purgar(self, campo_id=None):
+        """Olvida los valores de un campo, o todos; devuelve cuántos borró"""
+        if campo_id is None:
+            borrados = len(self.recientes)
+            self.recientes.clear()
+            self.indices.clear()
+        else:
+            borrados = len(self.indices.pop(campo_id, ()))
+            for clave in [clave for clave in self.recientes if clave[0] == campo_id]:
+                del self.recientes[clave]
+        self.guardar()
+        return borrados
+
+    def guardar(self):
+        if not self.recientes:
+            # Sin valores no queda archivo con datos de uso
+            if self.ruta.exists():
+                self.ruta.unlink()
+            return
+        self.ruta.parent.mkdir(parents=True, exist_ok=True)
+        escribir_json_atomico(self.ruta, {'version': 1, 'valores': [
+            [campo_id, valor, usos] for (campo_id, valor), usos in self.recientes.items()]})
+
+
+# ===== CONVERSIÓN MASIVA DE MINUTAS =====
+#
+# Convierte una carpeta de minutas DOCX en borradores de plantilla sin
+# interfaz. Cada minuta se reduce a un esqueleto: el texto con los valores
+# detectados (fechas, montos, números, correos y nombres) reemplazados por
+# su tipo. Las minutas con el mismo esqueleto comparten redacción y se
+# agrupan en una sola plantilla; en cada grupo los valores que cambian de
+# una minuta a otra pasan a ser campos y los que se repiten en todas
+# quedan como texto fijo.
+
+CARPETA_BORRADORES = "borradores"
+ARCHIVO_PUNTO_CONTROL = ".conversion.json"
+INTERVALO_PUNTO_CONTROL = 100
+
+_PATRON_MESES = "enero|febrero|marzo|abril|mayo|junio|julio|agosto|septiembre|setiembre|octubre|noviembre|diciembre"
+
+# El orden de las alternativas define la prioridad cuando dos patrones se solapan
+PATRON_DETECCION = re.compile(
+    r"(?P<correo>[\w.+-]+@[\w-]+(?:\.[\w-]+)+)"
+    r"|(?P<fecha>\b\d{1,2}/\d{1,2}/\d{4}\b)"
+    rf"|(?P<fecha_larga>\b\d{{1,2}} (?i:de (?:{_PATRON_MESES}) del? (?:año )?)\d{{4}}\b)"
+    r"|(?P<monto>(?:(?<=\$)|(?<=\$ ))\d{1,3}(?:\.\d{3})*(?:,\d{1,2})?)"
+    r"|(?P<nit>\b\d{6,10}-\d\b)"
+    r"|(?P<cedula>\b\d{1,3}(?:\.\d{3}){1,3}\b)"
+    r"|(?P<numero>\b\d{5,}\b)"
+    r"|(?P<nombre>\b[A-ZÁÉÍÓÚÑ]{2,}(?:\s+[A-ZÁÉÍÓÚÑ]{2,})+\b"
+    r"|\b[A-ZÁÉÍÓÚÑ][a-záéíóúñ]+(?:\s+(?:de\s+|del\s+|la\s+)?[A-ZÁÉÍÓÚÑ][a-záéíóúñ]+)+\b)"
+)
 
+# Tipo detectado -> (nombre del campo, tipo de campo, validación, formato)
+CAMPOS_DETECTADOS = {
+    'correo': ("Correo", 'texto', 'correo', ''),
+    'fecha': ("Fecha", 'fecha', None, ''),
+    'fecha_larga': ("Fecha", 'texto', None, ''),
+    'monto': ("Monto", 'texto', 'numero', ''),
+    'nit': ("NIT", 'texto', 'nit', ''),
+    'cedula': ("Cédula", 'texto', 'cedula', ''),
+    'numero': ("Número", 'texto', 'entero', ''),
+    'nombre': ("Nombre", 'texto', None, ''),
+}
+
+
+def extraer_texto_docx(ruta):
+    """Texto de una minuta DOCX, un párrafo por bloque como en el editor"""
+    doc = Document(ruta)
+    return "".join(parrafo.text + "\n\n" for parrafo in doc.paragraphs if parrafo.text.strip())
+
+
+def detectar_valores(texto):
+    """Lista de (inicio, fin, tipo, valor) de los valores variables del texto"""
+    return [(m.start(), m.end(), m.lastgroup, m.group()) for m in PATRON_DETECCION.finditer(texto)]
+
+
+def esqueleto_minuta(texto, valores):
+    """Huella de la redacción de una minuta, sin sus valores variables"""
+    partes = []
+    anterior = 0
+    for inicio, fin, tipo, _ in valores:
+        partes.append(texto[anterior:inicio])
+        partes.append(f"\x00{tipo}\x00")
+        anterior = fin
+    partes.append(texto[anterior:])
+    normalizado = " ".join("".join(partes).split())
+    return hashlib.sha1(normalizado.encode('utf-8')).hexdigest()
+
+
+def analizar_minuta(ruta):
+    """Extrae y analiza una minuta; se ejecuta en los procesos de trabajo"""
+    try:
+        texto = extraer_texto_docx(ruta)
+        valores = detectar_valores(texto)
+        return ruta, esqueleto_minuta(texto, valores), [[tipo, valor] for _, _, tipo, valor in valores], None
+    except Exception as e:
+        return ruta, None, None, str(e)
+
+
+def _firma_archivo(ruta):
+    estado = os.stat(ruta)
+    return f"{estado.st_mtime_ns}:{estado.st_size}"
+
+
+def construir_borrador(texto, valores, grupo_valores, numero, documentos):
+    """Plantilla borrador para un grupo de minutas con el mismo esqueleto.
+
+    'valores' son los valores detectados en la minuta representativa y
+    'grupo_valores' los valores de cada minuta del grupo, en el mismo orden."""
+    campos = []
+    campo_por_firma = {}
+    contadores = {}
+    reemplazos = []
+    for posicion, (inicio, fin, tipo, _) in enumerate(valores):
+        firma = tuple(valores_minuta[posicion][1] for valores_minuta in grupo_valores)
+        if len(grupo_valores) > 1 and len(set(firma)) == 1:
+            continue    # Igual en todas las minutas: es parte del texto fijo
+        # Posiciones que varían siempre juntas son el mismo dato repetido
+        if firma not in campo_por_firma:
+            contadores[tipo] = contadores.get(tipo, 0) + 1
+            nombre, tipo_campo, validacion, formato = CAMPOS_DETECTADOS[tipo]
+            campo = {'id': f"{tipo}_{contadores[tipo]}", 'nombre': f"{nombre} {contadores[tipo]}",
+                     'tipo': tipo_campo, 'descripcion': f"Ejemplo: {firma[0]}", 'requerido': True}
+            if validacion:
+                campo['validacion'] = {'tipo': validacion}
+            if formato:
+                campo['formato'] = formato
+            campos.append(campo)
+            campo_por_firma[firma] = campo['id']
+        reemplazos.append((inicio, fin, campo_por_firma[firma]))
+
+    partes = []
+    anterior = 0
+    for inicio, fin, campo_id in reemplazos:
+        partes.append(texto[anterior:inicio])
+        partes.append(f"[[{campo_id}]]")
+        anterior = fin
+    partes.append(texto[anterior:])
+
+    contenido = "".join(partes).strip()
+    # El título sale de la primera línea ya sin datos de las partes
+    titulo = re.sub(r'\[\[[^\]]*\]\]', '…', contenido.split('\n', 1)[0])[:60]
+    nombre = re.sub(r'[\\/:*?"<>|]', '', f"Borrador {numero:04d} - {titulo}").strip()
+    return {
+        'nombre': nombre,
+        'descripcion': f"Borrador generado a partir de {len(documentos)} minuta(s); revise los campos antes de usarlo",
+        'tipo': 'General',
+        'fecha_creacion': datetime.now().isoformat(),
+        'campos_personalizados': campos,
+        'contenido_base': contenido,
+        'documento_origen': documentos[0],
+        'documentos_agrupados': documentos,
+    }
+
+
+def convertir_carpeta_minutas(carpeta, carpeta_plantillas, procesos=None, reiniciar=False,
+                              minimo_grupo=1, informar=print):
+    """Convierte todas las minutas DOCX de 'carpeta' en borradores de plantilla.
+
+    El avance se guarda en un punto de control dentro de la carpeta de
+    borradores; si la conversión se interrumpe, al repetirla solo se
+    analizan las minutas nuevas o modificadas. Devuelve la lista de
+    borradores escritos."""
+    carpeta = Path(carpeta)
+    destino = Path(carpeta_plantillas) / CARPETA_BORRADORES
+    destino.mkdir(parents=True, exist_ok=True)
+    ruta_control = destino / ARCHIVO_PUNTO_CONTROL
+
+    control = {'carpeta': str(carpeta.resolve()), 'minutas': {}}
+    if not reiniciar and ruta_control.exists():
+        with open(ruta_control, 'r', encoding='utf-8') as f:
+            previo = json.load(f)
+        if previo.get('carpeta') == control['carpeta']:
+            control = previo
+    minutas = control['minutas']
+
+    archivos = sorted(str(ruta) for ruta in carpeta.rglob("*.docx") if not ruta.name.startswith("~$"))
+    pendientes = [ruta for ruta in archivos
+                  if ruta not in minutas or minutas[ruta].get('firma') != _firma_archivo(ruta)]
+    total = len(archivos)
+    hechas = total - len(pendientes)
+    informar(f"{total} minutas encontradas, {hechas} ya analizadas, {len(pendientes)} pendientes")
+
+    inicio = time.monotonic()
+    errores = 0
+
+    def registrar(resultado, procesadas):
+        nonlocal errores
+        ruta, clave, valores, error = resultado
+        minutas[ruta] = {'firma': _firma_archivo(ruta), 'esqueleto': clave, 'valores': valores, 'error': error}
+        if error:
+            errores += 1
+        if procesadas % INTERVALO_PUNTO_CONTROL == 0 or procesadas == len(pendientes):
+            escribir_json_atomico(ruta_control, control)
+            ritmo = procesadas / max(time.monotonic() - inicio, 1e-6)
+            informar(f"[{hechas + procesadas}/{total}] {100 * (hechas + procesadas) / max(total, 1):5.1f}% "
+                     f"· {ritmo:.1f} minutas/s · {errores} con error")
+
+    if len(pendientes) >= MINIMO_PARA_PARALELO and procesos != 1:
+        contexto = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=procesos or os.cpu_count() or 1, mp_context=contexto) as ejecutor:
+            for procesadas, resultado in enumerate(ejecutor.map(analizar_minuta, pendientes, chunksize=8), 1):
+                registrar(resultado, procesadas)
+    else:
+        for procesadas, ruta in enumerate(pendientes, 1):
+            registrar(analizar_minuta(ruta), procesadas)
+
+    grupos = {}
+    for ruta in archivos:
+        datos = minutas.get(ruta)
+        if datos and not datos['error']:
+            grupos.setdefault(datos['esqueleto'], []).append(ruta)
+
+    escritos = []
+    ordenados = sorted(grupos.values(), key=lambda rutas: (-len(rutas), rutas[0]))
+    for numero, rutas in enumerate(ordenados, 1):
+        if len(rutas) < minimo_grupo:
+            continue
+        texto = extraer_texto_docx(rutas[0])
+        borrador = construir_borrador(texto, detectar_valores(texto),
+                                      [minutas[ruta]['valores'] for ruta in rutas], numero, rutas)
+        ruta_borrador = destino / f"{borrador['nombre']}.json"
+        escribir_json_atomico(ruta_borrador, borrador)
+        escritos.append(ruta_borrador)
+
+    informar(f"{len(grupos)} grupos de redacción; {len(escritos)} borradores escritos en {destino}")
+    if errores:
+        for ruta in archivos:
+            if minutas.get(ruta, {}).get('error'):
+                informar(f"  ✖ {ruta}: {minutas[ruta]['error']}")
+    return escritos
+
+
+# ===== CONTRASTE DE MOTORES DE RENDERIZADO =====
+#
+# Genera plantillas y datos aleatorios (marcadores pegados o repetidos,
+# corchetes sueltos, unicode, valores que contienen [[...]]) y compara cada
+# motor registrado con renderizar_contenido, que es la referencia. Una
+# diferencia solo se acepta si la explica una diferencia conocida del motor;
+# las demás se reducen al caso mínimo y se guardan para reproducirlas.
+#
+# Para contrastar un motor nuevo basta con registrarlo:
+#   registrar_motor('nombre', funcion(contenido, datos, formatos) -> texto,
+#                   sintaxis='completa' | 'simple', diferencias=[(nombre, predicado)])
+
+SINTAXIS_SIMPLE = 'simple'        # solo [[campo]]
+SINTAXIS_COMPLETA = 'completa'    # además formatos, #si/#sino y #para
+
+MOTORES_RENDERIZADO = {}
+
+
+def registrar_motor(nombre, funcion, sintaxis=SINTAXIS_COMPLETA, diferencias=()):
+    """'diferencias' son pares (descripción, predicado(contenido, datos)) que
+    explican una salida distinta de la referencia"""
+    MOTORES_RENDERIZADO[nombre] = {'funcion': funcion, 'sintaxis': sintaxis,
+                                   'diferencias': tuple(diferencias)}
+
+
+def renderizar_legado(contenido, datos, formatos=()):
+    """El aplicar_plantilla original: reemplazo de texto y luego [SIN DATO]"""
+    for campo_id, valor in datos.items():
+        contenido = contenido.replace(f"[[{campo_id}]]", valor)
+    return re.sub(r'\[\[.*?\]\]', SIN_DATO, contenido)
+
+
+def renderizar_por_lineas(contenido, datos, formatos=()):
+    return '\n'.join(texto for texto, _ in renderizar_lineas(contenido, datos, formatos))
+
+
+def _valores_con_corchetes(contenido, datos):
+    # El reemplazo sucesivo vuelve a procesar lo que ya se sustituyó
+    return any('[' in valor or ']' in valor for valor in datos.values())
+
+
+def _marcador_con_corchetes(contenido, datos):
+    # En '[[[id]]' o '[[texto [[id]]' el motor compilado toma desde el primer
+    # '[[' hasta el primer ']]' como un solo marcador
+    return any('[' in coincidencia.group(1) for coincidencia in PATRON_MARCADOR.finditer(contenido))
+
+
+registrar_motor('legado', renderizar_legado, SINTAXIS_SIMPLE, [
+    ("valores con corchetes", _valores_con_corchetes),
+    ("'[[' sin cerrar antes de un marcador", _marcador_con_corchetes),
+])
+registrar_motor('lineas', renderizar_por_lineas)
+
+
+_IDS_PRUEBA = ('nombre', 'año', 'ciudad_1', 'ñandú', 'NIT', 'x', 'campo.sub', 'dato largo')
+_TEXTOS_PRUEBA = ('', ' ', 'de ', 'la señora ', 'Bogotá D.C.', '\n', '\n\n', '[', ']', '[[', ']]', '[ ]',
+                  'ÁÉÍÓÚ ñ ü', '💼 ', '$1\\g<0>', '\t', 'cláusula 1.', '«texto»', '  ')
+_VALORES_PRUEBA = ('', 'Ana', 'José Ñúñez', '0', '1500', '2024-03-05', 'Ünïcode ✓', 'línea 1\nlínea 2',
+                   '[[nombre]]', '[[otro]]', '[[', ']]', '[x]', '$1 \\1', 'sí', 'no', '  ')
+
+
+def _texto_prueba(aleatorio):
+    return ''.join(aleatorio.choice(_TEXTOS_PRUEBA) for _ in range(aleatorio.randint(0, 3)))
+
+
+def _valor_prueba(aleatorio):
+    if aleatorio.random() < 0.2:
+        return ''.join(aleatorio.choice(_VALORES_PRUEBA) for _ in range(2))
+    return aleatorio.choice(_VALORES_PRUEBA)
+
+
+def _piezas_prueba(aleatorio, sintaxis, profundidad=0, variable=None):
+    piezas = []
+    for _ in range(aleatorio.randint(1, 8)):
+        opcion = aleatorio.random()
+        if opcion < 0.35:
+            piezas.append(_texto_prueba(aleatorio))
+        elif sintaxis == SINTAXIS_SIMPLE or opcion < 0.7 or profundidad >= 2:
+            if variable and aleatorio.random() < 0.4:
+                campo_id = f"{variable}.{aleatorio.choice(('a', 'b', '_numero', '_ultimo'))}"
+            else:
+                campo_id = aleatorio.choice(_IDS_PRUEBA)
+            if sintaxis == SINTAXIS_COMPLETA and aleatorio.random() < 0.2:
+                campo_id += '|' + aleatorio.choice(('mayusculas', 'minusculas', 'titulo'))
+            piezas.extend(f"[[{campo_id}]]" for _ in range(aleatorio.choice((1, 1, 1, 2))))
+        elif opcion < 0.85:
+            campo_id = aleatorio.choice(_IDS_PRUEBA[:6])
+            condicion = aleatorio.choice(('', '=sí', '!=no', '=Ana'))
+            piezas.append(f"[[#si {campo_id}{condicion}]]" + aleatorio.choice(('', '\n')))
+            piezas.extend(_piezas_prueba(aleatorio, sintaxis, profundidad + 1, variable))
+            if aleatorio.random() < 0.4:
+                piezas.append('[[#sino]]')
+                piezas.extend(_piezas_prueba(aleatorio, sintaxis, profundidad + 1, variable))
+            piezas.append('[[/si]]' + aleatorio.choice(('', '\n')))
+        else:
+            nueva = aleatorio.choice(('o', 'item'))
+            piezas.append(f"\n[[#para {nueva} en lista]]\n")
+            piezas.extend(_piezas_prueba(aleatorio, sintaxis, profundidad + 1, nueva))
+            piezas.append('\n[[/para]]\n')
+    return piezas
+
+
+def generar_caso_prueba(aleatorio, sintaxis):
+    """(piezas del contenido, datos) aleatorios"""
+    datos = {campo_id: _valor_prueba(aleatorio) for campo_id in _IDS_PRUEBA if aleatorio.random() < 0.7}
+    if sintaxis == SINTAXIS_COMPLETA and aleatorio.random() < 0.7:
+        datos['lista'] = [{'a': _valor_prueba(aleatorio), 'b': _valor_prueba(aleatorio)}
+                          for _ in range(aleatorio.randint(0, 3))]
+    return _piezas_prueba(aleatorio, sintaxis), datos
+
+
+def _diferencia_motor(motor, contenido, datos):
+    """None si coincide con la referencia; si no, (explicación o None, esperado, obtenido)"""
+    try:
+        esperado = renderizar_contenido(contenido, datos)
+    except ErrorPlantilla:
+        return None
+    try:
+        obtenido = motor['funcion'](contenido, datos, ())
+    except Exception as e:
+        obtenido = f"<{type(e).__name__}: {e}>"
+    if obtenido == esperado:
+        return None
+    for descripcion, predicado in motor['diferencias']:
+        if predicado(contenido, datos):
+            return descripcion, esperado, obtenido
+    return None, esperado, obtenido
+
+
+def reducir_caso(motor, piezas, datos):
+    """Quita piezas y datos mientras la diferencia sin explicación se mantenga"""
+    def falla(piezas, datos):
+        diferencia = _diferencia_motor(motor, ''.join(piezas), datos)
+        return diferencia is not None and diferencia[0] is None
+
+    cambio = True
+    while cambio:
+        cambio = False
+        # Tramos de piezas de mayor a menor, para quitar bloques #si/#para enteros
+        tamano = len(piezas)
+        while tamano:
+            i = 0
+            while i + tamano <= len(piezas):
+                if falla(piezas[:i] + piezas[i + tamano:], datos):
+                    piezas = piezas[:i] + piezas[i + tamano:]
+                    cambio = True
+                else:
+                    i += 1
+            tamano //= 2
+        for clave in list(datos):
+            reducidos = {k: v for k, v in datos.items() if k != clave}
+            if falla(piezas, reducidos):
+                datos = reducidos
+                cambio = True
+    return ''.join(piezas), datos
+
+
+def _medir(funcion, casos, repeticiones):
+    inicio = time.perf_counter()
+    for _ in range(repeticiones):
+        for contenido, datos in casos:
+            funcion(contenido, datos, ())
+    return time.perf_counter() - inicio
+
+
+def contrastar_motores(casos=20000, semilla=None, nombres=None, repeticiones=3, informar=print):
+    """Contrasta los motores con la referencia; devuelve {motor: resumen}"""
+    semilla = semilla if semilla is not None else int(time.time())
+    informar(f"Semilla {semilla}; {casos} casos por motor")
+    resultados = {}
+    fallos_formatos = comprobar_formatos()
+    if fallos_formatos:
+        resultados['formatos'] = {'casos': len(CASOS_FORMATOS), 'explicadas': {},
+                                  'fallos': fallos_formatos, 'aceleracion': 0.0}
+        informar(f"formatos: {len(fallos_formatos)} de {len(CASOS_FORMATOS)} resultados conocidos no coinciden")
+        for fallo in fallos_formatos:
+            _informar_fallo(fallo, informar)
+    for nombre in nombres or sorted(MOTORES_RENDERIZADO):
+        motor = MOTORES_RENDERIZADO[nombre]
+        aleatorio = random.Random(f"{semilla}:{nombre}")
+        validos = []
+        explicadas = {}
+        fallos = []
+        for _ in range(casos):
+            piezas, datos = generar_caso_prueba(aleatorio, motor['sintaxis'])
+            contenido = ''.join(piezas)
+            try:
+                renderizar_contenido(contenido, datos)
+            except ErrorPlantilla:
+                continue
+            validos.append((contenido, datos))
+            diferencia = _diferencia_motor(motor, contenido, datos)
+            if diferencia is None:
+                continue
+            if diferencia[0] is not None:
+                explicadas[diferencia[0]] = explicadas.get(diferencia[0], 0) + 1
+            elif len(fallos) < 20:
+                minimo, datos_minimos = reducir_caso(motor, piezas, datos)
+                _, esperado, obtenido = _diferencia_motor(motor, minimo, datos_minimos)
+                fallos.append({'contenido': minimo, 'datos': datos_minimos,
+                               'esperado': esperado, 'obtenido': obtenido})
+
+        # Tiempos con la caché de compilación ya caliente para la referencia
+        tiempo_referencia = _medir(renderizar_contenido, validos, repeticiones)
+        tiempo_motor = _medir(motor['funcion'], validos, repeticiones)
+        resultados[nombre] = {'casos': len(validos), 'explicadas': explicadas, 'fallos': fallos,
+                              'aceleracion': tiempo_referencia / tiempo_motor if tiempo_motor else 0.0}
+        informar(f"{nombre}: {len(validos)} casos, {len(fallos)} diferencias sin explicar, "
+                 f"{sum(explicadas.values())} conocidas; "
+                 f"{resultados[nombre]['aceleracion']:.2f}x respecto de la referencia")
+        for descripcion, cantidad in sorted(explicadas.items()):
+            informar(f"  · {descripcion}: {cantidad}")
+        for fallo in fallos[:3]:
+            _informar_fallo(fallo, informar)
+    return resultados
+
+
+# ===== PRUEBA DE RENDERIZADO DE LA BIBLIOTECA =====
+#
+# Genera en memoria una minuta de cada plantilla con valores de prueba, para
+# detectar después de una migración o de un cambio de cláusula las plantillas
+# que fallan al compilar o al armar el Word y los marcadores sin campo.
+# Cada plantilla se prueba en un proceso de trabajo propio de la prueba: si
+# supera el límite (por ejemplo, una expresión regular que no termina, que
+# no se puede interrumpir desde Python) el proceso se mata y se reemplaza.
+
+LIMITE_PRUEBA = 10.0  # segundos por plantilla
+FECHA_PRUEBA = '15/03/2024'
+VALORES_PRUEBA = {
+    'numero': '1.500.000',
+    'entero': '42',
+    'cedula': '1.234.567',
+    'nit': '900123456-7',
+    'rfc': 'ABCD010203XY1',
+    'curp': 'GOMC800101HDFRRL09',
+    'correo': 'prueba@ejemplo.com',
+}
+COLUMNAS_INFORME_PRUEBA = ['plantilla', 'estado', 'ms', 'bytes', 'sin_dato', 'marcadores_sin_campo', 'error']
+
+
+def valor_de_prueba(campo):
+    """Valor sintético que respeta el tipo, la validación y el formato del campo"""
+    tipo_validacion = (campo.validacion or {}).get('tipo')
+    if campo.tipo == 'fecha' or 'larga' in campo.formato:
+        return FECHA_PRUEBA
+    if campo.tipo == 'seleccion' and campo.opciones:
+        return campo.opciones[0]
+    if tipo_validacion in VALORES_PRUEBA:
+        return VALORES_PRUEBA[tipo_validacion]
+    if 'letras' in campo.formato:
+        return VALORES_PRUEBA['numero']
+    if campo.tipo == 'textarea':
+        return f"{campo.nombre} de prueba\nsegunda línea"
+    return f"{campo.nombre} de prueba"
+
+
+def datos_de_prueba(plantilla, muestras=None):
+    """Valores para todos los campos; los de 'muestras' (campo_id -> valor) tienen prioridad"""
+    datos = {}
+    for campo in plantilla.campos:
+        if campo.tipo == 'grupo':
+            fila = {sub.id: valor_de_prueba(sub) for sub in subcampos_como_campos(campo)}
+            datos[campo.id] = [fila, dict(fila)]
+        else:
+            datos[campo.id] = valor_de_prueba(campo)
+    for campo_id, valor in (muestras or {}).items():
+        if campo_id in plantilla.campos_por_id:
+            datos[campo_id] = valor
+    return datos
+
+
+def _probar_plantilla(ruta, muestras, resultado):
+    with open(ruta, 'r', encoding='utf-8') as f:
+        datos_plantilla = json.load(f)
+    errores = validar_estructura_plantilla(datos_plantilla)
+    if errores:
+        raise ErrorPlantilla("; ".join(errores))
+    plantilla = Plantilla.desde_dict(datos_plantilla, Path(ruta).stem)
+    resultado['plantilla'] = plantilla.nombre
+    resultado['faltantes'] = sorted(plantilla.marcadores - plantilla.campos_por_id.keys())
+    datos = datos_de_prueba(plantilla, muestras)
+    contenido = renderizar_contenido(plantilla.contenido_base, datos, plantilla.formatos)
+    resultado['sin_dato'] = contenido.count(SIN_DATO)
+    memoria = io.BytesIO()
+    construir_documento_word(contenido, plantilla, datos).save(memoria)
+    resultado['bytes'] = memoria.tell()
+
+
+def _resultado_prueba(ruta, error='', segundos=0.0):
+    return {'ruta': ruta, 'plantilla': Path(ruta).stem, 'ms': round(segundos * 1000, 1), 'bytes': 0,
+            'sin_dato': 0, 'faltantes': [], 'error': error}
+
+
+def probar_archivo_plantilla(ruta, muestras=None):
+    """Resultado de generar una minuta de prueba; se ejecuta en procesos de trabajo"""
+    resultado = _resultado_prueba(ruta)
+    inicio = time.perf_counter()
+    try:
+        _probar_plantilla(ruta, muestras, resultado)
+    except Exception as e:  # Cualquier fallo de una plantilla es un resultado, no detiene la prueba
+        resultado['error'] = f"{type(e).__name__}: {e}"
+    resultado['ms'] = round((time.perf_counter() - inicio) * 1000, 1)
+    return resultado
+
+
+def _atender_pruebas(conexion, muestras):
+    # Bucle de un proceso de trabajo: avisa que arrancó con None, recibe rutas
+    # y devuelve resultados hasta recibir None
+    conexion.send(None)
+    while True:
+        ruta = conexion.recv()
+        if ruta is None:
+            return
+        conexion.send(probar_archivo_plantilla(ruta, muestras))
+
+
+class TrabajadorPrueba:
+    """Proceso de trabajo de la prueba, que se puede matar si una plantilla no termina"""
+    def __init__(self, contexto, muestras):
+        self.contexto = contexto
+        self.muestras = muestras
+        self.ruta = None     # plantilla en curso
+        self.inicio = 0.0
+        self._arrancar()
+
+    def _arrancar(self):
+        # El límite no corre mientras el proceso nuevo importa el programa
+        self.listo = False
+        self.conexion, extremo = self.contexto.Pipe()
+        self.proceso = self.contexto.Process(target=_atender_pruebas, args=(extremo, self.muestras), daemon=True)
+        self.proceso.start()
+        extremo.close()
+
+    def enviar(self, ruta):
+        self.ruta = ruta
+        self.inicio = time.monotonic()
+        self.conexion.send(ruta)
+
+    def recibir(self):
+        if not self.listo:
+            try:
+                self.conexion.recv()
+            except (EOFError, OSError):
+                raise RuntimeError("No se pudo iniciar un proceso de prueba") from None
+            self.listo = True
+            return None
+        ruta, self.ruta = self.ruta, None
+        try:
+            return self.conexion.recv()
+        except (EOFError, OSError):
+            # El proceso murió sin responder (por ejemplo, sin memoria): se reemplaza
+            self.reemplazar()
+            return _resultado_prueba(ruta, "el proceso de prueba terminó inesperadamente",
+                                     time.monotonic() - self.inicio)
+
+    def reemplazar(self):
+        self.ruta = None
+        self.proceso.kill()
+        self.proceso.join()
+        self.conexion.close()
+        self._arrancar()
+
+    def cerrar(self):
+        try:
+            self.conexion.send(None)
+        except OSError:
+            pass
+        self.proceso.join(1.0)
+        if self.proceso.is_alive():
+            self.proceso.kill()
+            self.proceso.join()
+        self.conexion.close()
+
+
+def probar_archivos(archivos, procesos=None, limite=LIMITE_PRUEBA, muestras=None):
+    """Resultados de probar cada archivo, en el mismo orden, con 'limite' segundos para cada uno"""
+    contexto = multiprocessing.get_context('spawn')
+    pendientes = deque(archivos)
+    cantidad = min(procesos or os.cpu_count() or 1, len(archivos))
+    trabajadores = [TrabajadorPrueba(contexto, muestras) for _ in range(cantidad)]
+    resultados = {}
+    try:
+        while pendientes or any(trabajador.ruta for trabajador in trabajadores):
+            for trabajador in trabajadores:
+                if trabajador.listo and trabajador.ruta is None and pendientes:
+                    trabajador.enviar(pendientes.popleft())
+            atentos = [trabajador for trabajador in trabajadores if trabajador.ruta or not trabajador.listo]
+            ocupados = [trabajador for trabajador in atentos if trabajador.ruta]
+            espera = None
+            if ocupados:
+                espera = max(0.0, min(trabajador.inicio for trabajador in ocupados) + limite - time.monotonic())
+            listos = multiprocessing.connection.wait([trabajador.conexion for trabajador in atentos], espera)
+            for trabajador in atentos:
+                if trabajador.conexion in listos:
+                    resultado = trabajador.recibir()
+                    if resultado is not None:
+                        resultados[resultado['ruta']] = resultado
+                elif trabajador.ruta and time.monotonic() - trabajador.inicio >= limite:
+                    resultados[trabajador.ruta] = _resultado_prueba(
+                        trabajador.ruta, f"tardó más de {limite:g} s", time.monotonic() - trabajador.inicio)
+                    trabajador.reemplazar()
+    finally:
+        for trabajador in trabajadores:
+            trabajador.cerrar()
+    return [resultados[ruta] for ruta in archivos]
+
+
+def csv_informe_prueba(resultados):
+    salida = io.StringIO()
+    escritor = csv.writer(salida)
+    escritor.writerow(COLUMNAS_INFORME_PRUEBA)
+    for resultado in resultados:
+        estado = 'error' if resultado['error'] else 'aviso' if resultado['faltantes'] or resultado['sin_dato'] else 'ok'
+        escritor.writerow([resultado['plantilla'], estado, resultado['ms'], resultado['bytes'],
+                           resultado['sin_dato'], ' '.join(resultado['faltantes']), resultado['error']])
+    return salida.getvalue().encode('utf-8-sig')
+
+
+def probar_biblioteca(carpeta_plantillas, procesos=None, limite=LIMITE_PRUEBA, muestras=None,
+                      informe=None, informar=print):
+    """Genera una minuta de prueba de cada plantilla; devuelve 1 si alguna falla"""
+    archivos = sorted(str(ruta) for ruta in Path(carpeta_plantillas).glob("*.json"))
+    fallos_formatos = comprobar_formatos()
+    for fallo in fallos_formatos:
+        _informar_fallo(fallo, informar)
+    inicio = time.perf_counter()
+    resultados = probar_archivos(archivos, procesos, limite, muestras)
+    duracion = time.perf_counter() - inicio
+
+    con_errores = con_avisos = 0
+    for resultado in resultados:
+        if resultado['error']:
+            con_errores += 1
+            informar(f"✖ {resultado['plantilla']}: {resultado['error']}")
+        elif resultado['faltantes'] or resultado['sin_dato']:
+            con_avisos += 1
+            sin_campo = ', '.join(resultado['faltantes']) or '-'
+            informar(f"· {resultado['plantilla']}: {resultado['sin_dato']} {SIN_DATO}; "
+                     f"marcadores sin campo: {sin_campo}")
+    if resultados:
+        tiempos = sorted(resultado['ms'] for resultado in resultados)
+        informar(f"Por plantilla: mediana {tiempos[len(tiempos) // 2]} ms, "
+                 f"p95 {tiempos[int(0.95 * (len(tiempos) - 1))]} ms, máximo {tiempos[-1]} ms")
+        for resultado in sorted(resultados, key=lambda r: r['ms'], reverse=True)[:5]:
+            informar(f"  {resultado['ms']:>9} ms  {resultado['plantilla']}")
+    if informe:
+        Path(informe).write_bytes(csv_informe_prueba(resultados))
+    informar(f"{len(archivos)} plantillas probadas en {duracion:.1f} s; "
+             f"{con_errores} con errores, {con_avisos} con marcadores sin dato")
+    return 1 if con_errores or fallos_formatos else 0
 
-import tkinter as tk
-from tkinter import ttk, filedialog, messagebox, scrolledtext, simpledialog
-from docx import Document
-from docx.shared import Inches, Pt
-from docx.enum.text import WD_ALIGN_PARAGRAPH
-import os
-import re
-from datetime import datetime
-import json
-from pathlib import Path
 
 class ScrollableFrame(ttk.Frame):
     """Frame scrollable vertical y horizontalmente"""
@@ -33,14 +4102,18 @@ class ScrollableFrame(ttk.Frame):
         
         # Frame interior que contendrá todos los widgets
         self.scrollable_frame = ttk.Frame(self.canvas)
-        self.scrollable_frame.bind(
-            "<Configure>",
-            lambda e: self.canvas.configure(scrollregion=self.canvas.bbox("all"))
-        )
         
         # Crear ventana en el canvas para el frame scrollable
         self.canvas_frame = self.canvas.create_window((0, 0), window=self.scrollable_frame, anchor="nw")
         
+        # Los <Configure> se acumulan y se atienden una sola vez por ciclo ocioso
+        self._region_pendiente = None
+        self._ancho_pendiente = None
+        self._ancho_canvas = None
+        self._suspendido = 0
+        self.eventos_configure = 0
+        self.actualizaciones_region = 0
+        
         # Configurar el cambio de tamaño
         self.scrollable_frame.bind("<Configure>", self._on_frame_configure)
         self.canvas.bind("<Configure>", self._on_canvas_configure)
@@ -51,12 +4124,244 @@ class ScrollableFrame(ttk.Frame):
         self.h_scrollbar.pack(side="bottom", fill="x")
         
     def _on_frame_configure(self, event=None):
-        """Actualizar scrollregion cuando cambia el tamaño del frame"""
+        """Programar la actualización de scrollregion cuando cambia el tamaño del frame"""
+        self.eventos_configure += 1
+        if self._suspendido or self._region_pendiente is not None:
+            return
+        self._region_pendiente = self.after_idle(self._actualizar_region)
+        
+    def _actualizar_region(self):
+        self._region_pendiente = None
+        if self._suspendido:
+            return
+        self.actualizaciones_region += 1
         self.canvas.configure(scrollregion=self.canvas.bbox("all"))
         
     def _on_canvas_configure(self, event):
-        """Ajustar el ancho del frame interior al canvas"""
-        self.canvas.itemconfig(self.canvas_frame, width=event.width)
+        """Ajustar el ancho del frame interior al canvas (solo el último ancho cuenta)"""
+        self.eventos_configure += 1
+        self._ancho_canvas = event.width
+        if self._ancho_pendiente is None:
+            self._ancho_pendiente = self.after_idle(self._aplicar_ancho)
+        
+    def _aplicar_ancho(self):
+        self._ancho_pendiente = None
+        self.canvas.itemconfig(self.canvas_frame, width=self._ancho_canvas)
+        
+    def suspender_actualizaciones(self):
+        """Dejar de recalcular scrollregion mientras se insertan muchos widgets.
+        Cada llamada debe cerrarse con reanudar_actualizaciones()."""
+        self._suspendido += 1
+        
+    def reanudar_actualizaciones(self):
+        """Volver a atender los cambios de tamaño con un único recálculo"""
+        self._suspendido = max(0, self._suspendido - 1)
+        if not self._suspendido:
+            self._on_frame_configure()
+        
+    def estadisticas_eventos(self, reiniciar=False):
+        """Eventos <Configure> recibidos frente a recálculos de scrollregion hechos"""
+        datos = (self.eventos_configure, self.actualizaciones_region)
+        if reiniciar:
+            self.eventos_configure = self.actualizaciones_region = 0
+        return datos
+    
+    def destroy(self):
+        for pendiente in (self._region_pendiente, self._ancho_pendiente):
+            if pendiente is not None:
+                self.after_cancel(pendiente)
+        super().destroy()
+
+class GrupoRepetible(ttk.Frame):
+    """Grupo de subcampos que el usuario puede repetir N veces (p. ej. otorgantes)"""
+    def __init__(self, container, subcampos, *args, **kwargs):
+        super().__init__(container, *args, **kwargs)
+        self.subcampos = subcampos
+        self.filas = []
+
+        self.frame_filas = ttk.Frame(self)
+        self.frame_filas.pack(fill="x")
+
+        ttk.Button(self,
+                  text="➕ Agregar",
+                  command=self.agregar_fila,
+                  width=12).pack(anchor="w", pady=(5, 0))
+
+        self.agregar_fila()
+
+    def agregar_fila(self):
+        frame_fila = ttk.Frame(self.frame_filas)
+        frame_fila.pack(fill="x", pady=2)
+
+        ttk.Label(frame_fila, text=f"{len(self.filas) + 1}.", width=3, font=("Arial", 9)).pack(side="left")
+
+        entradas = {}
+        for subcampo in self.subcampos:
+            ttk.Label(frame_fila, text=subcampo['nombre'], font=("Arial", 9)).pack(side="left", padx=(5, 2))
+            entrada = ttk.Entry(frame_fila, width=18, font=("Arial", 9))
+            entrada.pack(side="left")
+            entradas[subcampo['id']] = entrada
+
+        fila = {'frame': frame_fila, 'entradas': entradas}
+        ttk.Button(frame_fila, text="✖", width=3,
+                  command=lambda: self.eliminar_fila(fila)).pack(side="left", padx=(5, 0))
+        self.filas.append(fila)
+
+    def eliminar_fila(self, fila):
+        fila['frame'].destroy()
+        self.filas.remove(fila)
+
+    def obtener(self):
+        """Devuelve las filas con algún dato como lista de diccionarios"""
+        valores = []
+        for fila in self.filas:
+            registro = {sub_id: entrada.get() for sub_id, entrada in fila['entradas'].items()}
+            if any(v.strip() for v in registro.values()):
+                valores.append(registro)
+        return valores
+
+    def limpiar(self):
+        for fila in list(self.filas):
+            self.eliminar_fila(fila)
+        self.agregar_fila()
+
+    def establecer(self, valores):
+        for fila in list(self.filas):
+            self.eliminar_fila(fila)
+        for registro in valores or [{}]:
+            self.agregar_fila()
+            for sub_id, entrada in self.filas[-1]['entradas'].items():
+                entrada.insert(0, registro.get(sub_id, ''))
+
+class ListaVirtual(ttk.Frame):
+    """Lista que solo dibuja las filas visibles, con la interfaz básica de Listbox"""
+    def __init__(self, container, height=12, font=("Arial", 11), alto_fila=24, *args, **kwargs):
+        super().__init__(container, *args, **kwargs)
+        self.font = font
+        self.alto_fila = alto_fila
+        self.elementos = []
+        self.seleccion = set()
+        self.ancla = None
+        self.primera = 0
+        self.filas_dibujadas = []  # (rectángulo, texto) reutilizados al desplazarse
+
+        self.canvas = tk.Canvas(self, height=height * alto_fila, background="white",
+                                highlightthickness=1, highlightbackground="#cccccc", takefocus=1)
+        self.scrollbar = ttk.Scrollbar(self, orient="vertical", command=self._yview)
+        self.canvas.pack(side="left", fill="both", expand=True)
+        self.scrollbar.pack(side="right", fill="y")
+
+        self.canvas.bind("<Configure>", lambda e: self._redibujar())
+        self.canvas.bind("<Button-1>", self._click)
+        self.canvas.bind("<Control-Button-1>", lambda e: self._click(e, modo="alternar"))
+        self.canvas.bind("<Shift-Button-1>", lambda e: self._click(e, modo="rango"))
+        self.canvas.bind("<Double-Button-1>", lambda e: self.event_generate("<<ListaActivar>>"))
+        self.canvas.bind("<MouseWheel>", lambda e: self._desplazar(-1 if e.delta > 0 else 1, "units"))
+        self.canvas.bind("<Button-4>", lambda e: self._desplazar(-1, "units"))
+        self.canvas.bind("<Button-5>", lambda e: self._desplazar(1, "units"))
+        self.canvas.bind("<Up>", lambda e: self._mover_seleccion(-1))
+        self.canvas.bind("<Down>", lambda e: self._mover_seleccion(1))
+        self.canvas.bind("<Return>", lambda e: self.event_generate("<<ListaActivar>>"))
+
+    # --- interfaz compatible con Listbox ---
+    def curselection(self):
+        return tuple(sorted(self.seleccion))
+
+    def get(self, indice):
+        return self.elementos[indice]
+
+    def size(self):
+        return len(self.elementos)
+
+    def establecer_elementos(self, elementos):
+        seleccionados = {self.elementos[i] for i in self.seleccion if i < len(self.elementos)}
+        self.elementos = list(elementos)
+        self.seleccion = {i for i, nombre in enumerate(self.elementos) if nombre in seleccionados}
+        self.primera = 0
+        self._redibujar()
+
+    def seleccionar(self, indice):
+        self.seleccion = {indice} if 0 <= indice < len(self.elementos) else set()
+        self.ancla = indice
+        self._asegurar_visible(indice)
+        self._redibujar()
+        self.event_generate("<<ListboxSelect>>")
+
+    # --- dibujo ---
+    def _filas_visibles(self):
+        return max(1, self.canvas.winfo_height() // self.alto_fila + 1)
+
+    def _redibujar(self):
+        visibles = self._filas_visibles()
+        total = len(self.elementos)
+        self.primera = max(0, min(self.primera, total - visibles + 1))
+        ancho = self.canvas.winfo_width()
+
+        while len(self.filas_dibujadas) < visibles:
+            rect = self.canvas.create_rectangle(0, 0, 0, 0, width=0)
+            texto = self.canvas.create_text(8, 0, anchor="w", font=self.font)
+            self.filas_dibujadas.append((rect, texto))
+
+        for posicion, (rect, texto) in enumerate(self.filas_dibujadas):
+            indice = self.primera + posicion
+            y = posicion * self.alto_fila
+            if posicion < visibles and indice < total:
+                seleccionado = indice in self.seleccion
+                self.canvas.coords(rect, 0, y, ancho, y + self.alto_fila)
+                self.canvas.itemconfigure(rect, fill="#0078d7" if seleccionado else "white", state="normal")
+                self.canvas.coords(texto, 8, y + self.alto_fila // 2)
+                self.canvas.itemconfigure(texto, text=self.elementos[indice],
+                                          fill="white" if seleccionado else "black", state="normal")
+            else:
+                self.canvas.itemconfigure(rect, state="hidden")
+                self.canvas.itemconfigure(texto, state="hidden")
+
+        if total:
+            self.scrollbar.set(self.primera / total, min(1.0, (self.primera + visibles) / total))
+        else:
+            self.scrollbar.set(0, 1)
+
+    def _yview(self, accion, cantidad, unidad=None):
+        if accion == "moveto":
+            self.primera = int(float(cantidad) * len(self.elementos))
+            self._redibujar()
+        else:
+            self._desplazar(int(cantidad), unidad)
+
+    def _desplazar(self, cantidad, unidad):
+        paso = self._filas_visibles() - 1 if unidad == "pages" else 1
+        self.primera += cantidad * paso
+        self._redibujar()
+
+    def _asegurar_visible(self, indice):
+        visibles = self._filas_visibles() - 1
+        if indice < self.primera:
+            self.primera = indice
+        elif indice >= self.primera + visibles:
+            self.primera = indice - visibles + 1
+
+    # --- selección ---
+    def _click(self, event, modo="simple"):
+        self.canvas.focus_set()
+        indice = self.primera + event.y // self.alto_fila
+        if indice >= len(self.elementos):
+            return
+        if modo == "alternar":
+            self.seleccion ^= {indice}
+            self.ancla = indice
+        elif modo == "rango" and self.ancla is not None:
+            inicio, fin = sorted((self.ancla, indice))
+            self.seleccion = set(range(inicio, fin + 1))
+        else:
+            self.seleccion = {indice}
+            self.ancla = indice
+        self._redibujar()
+        self.event_generate("<<ListboxSelect>>")
+
+    def _mover_seleccion(self, delta):
+        if self.elementos:
+            actual = self.ancla if self.ancla is not None else -1
+            self.seleccionar(max(0, min(len(self.elementos) - 1, actual + delta)))
 
 class SistemaPlantillasPersonalizadas:
     def __init__(self):
@@ -71,14 +4376,35 @@ class SistemaPlantillasPersonalizadas:
         
         # Variables de estado
         self.plantillas_personalizadas = {}
+        self.firmas_plantillas = {}     # nombre -> firma del archivo al leerlo
         self.plantilla_activa = None
+        self.validadores_activos = ()
+        self.indice_busqueda = IndiceBusqueda()
+        self.indice_similitud = IndiceSimilitud()
+        self.configuracion = leer_configuracion()
+        self.auditoria = RegistroAuditoria() if self.configuracion['auditoria'] else None
+        self.autocompletado = HistorialValores() if self.configuracion['autocompletado'] else None
+        self.ventana_sugerencias = None
+        self.tooltip = None             # ventana de ayuda compartida, se crea al primer uso
+        self.label_tooltip = None
+        self.minuta_actual = None       # texto de la última minuta generada, para compararla
+        self.comparacion = None         # (párrafos anteriores, párrafos nuevos) de la última comparación
+        # (nombre de plantilla, ruta) de la última minuta guardada, para corregirla en el sitio.
+        # Se olvida al cambiar de plantilla, de caso o al limpiar el formulario
+        self.ultima_minuta = None
+        atexit.register(self.cerrar_auditoria)
         
         # Crear carpeta de plantillas
         self.carpeta_plantillas = Path("plantillas_personalizadas")
         self.carpeta_plantillas.mkdir(exist_ok=True)
         
         self.configurar_interfaz()
-        self.cargar_plantillas_guardadas()
+        if self.restaurar_sesion():
+            # Las plantillas que cambiaron desde la sesión se releen ya con la ventana a la vista
+            self.root.after_idle(lambda: self.cargar_plantillas_guardadas(solo_cambios=True))
+        else:
+            self.cargar_plantillas_guardadas()
+        self.root.protocol("WM_DELETE_WINDOW", self.cerrar_aplicacion)
     
     def setup_icon(self):
         # Manejo seguro de icono
@@ -165,6 +4491,40 @@ class SistemaPlantillasPersonalizadas:
                   text="🗑️ Eliminar", 
                   command=self.eliminar_plantilla_activa,
                   width=15).grid(row=1, column=3, padx=5, pady=5)
+
+        # Fila 3
+        ttk.Button(tools_grid,
+                  text="📚 Generar Lote (CSV)",
+                  command=self.generar_lote_csv,
+                  width=22).grid(row=2, column=0, padx=5, pady=5)
+
+        ttk.Button(tools_grid,
+                  text="🗄️ Lote desde Base de Datos",
+                  command=self.generar_lote_fuente,
+                  width=24).grid(row=2, column=1, columnspan=2, padx=5, pady=5)
+
+        self.auditoria_var = tk.BooleanVar(value=self.auditoria is not None)
+        ttk.Checkbutton(tools_grid,
+                       text="🧾 Registrar auditoría",
+                       variable=self.auditoria_var,
+                       command=self.cambiar_auditoria).grid(row=2, column=3, padx=5, pady=5, sticky="w")
+
+        # Fila 4
+        self.autocompletado_var = tk.BooleanVar(value=self.autocompletado is not None)
+        ttk.Checkbutton(tools_grid,
+                       text="💡 Recordar valores",
+                       variable=self.autocompletado_var,
+                       command=self.cambiar_autocompletado).grid(row=3, column=0, padx=5, pady=5, sticky="w")
+
+        ttk.Button(tools_grid,
+                  text="🧽 Olvidar valores",
+                  command=self.olvidar_valores,
+                  width=18).grid(row=3, column=1, padx=5, pady=5)
+
+        ttk.Button(tools_grid,
+                  text="✏️ Corregir última minuta",
+                  command=self.corregir_ultima_minuta,
+                  width=24).grid(row=3, column=2, columnspan=2, padx=5, pady=5)
         
         # Panel de control de plantillas
         control_frame = ttk.LabelFrame(main_content, text="Control de Plantillas Activas", padding="15")
@@ -240,10 +4600,10 @@ class SistemaPlantillasPersonalizadas:
     
     def configurar_tab_formulario(self):
         # Frame principal con scroll
-        form_scrollable = ScrollableFrame(self.tab_formulario)
-        form_scrollable.pack(fill="both", expand=True)
+        self.form_scrollable = ScrollableFrame(self.tab_formulario)
+        self.form_scrollable.pack(fill="both", expand=True)
         
-        form_content = ttk.Frame(form_scrollable.scrollable_frame)
+        form_content = ttk.Frame(self.form_scrollable.scrollable_frame)
         form_content.pack(fill="both", expand=True, padx=10, pady=10)
         
         # Información de la plantilla
@@ -261,6 +4621,17 @@ class SistemaPlantillasPersonalizadas:
         
         self.label_info_desc = ttk.Label(info_grid, text="Descripción: -", font=("Arial", 10))
         self.label_info_desc.grid(row=0, column=2, sticky="w", pady=5)
+
+        # Solo visible si la plantilla declara una fuente de datos
+        self.frame_caso = ttk.Frame(info_grid)
+        ttk.Label(self.frame_caso, text="Caso:", font=("Arial", 10)).pack(side="left")
+        self.entry_caso = ttk.Entry(self.frame_caso, width=20, font=("Arial", 10))
+        self.entry_caso.pack(side="left", padx=5)
+        self.entry_caso.bind("<Return>", lambda e: self.cargar_datos_caso())
+        ttk.Button(self.frame_caso,
+                  text="🗄️ Cargar datos del caso",
+                  command=self.cargar_datos_caso,
+                  width=24).pack(side="left")
         
         # Área de campos del formulario
         campos_frame = ttk.LabelFrame(form_content, text="Campos a Completar", padding="15")
@@ -297,6 +4668,18 @@ class SistemaPlantillasPersonalizadas:
                   command=self.generar_minuta,
                   width=20).pack(side="right")
         
+        self.boton_exportar_comparacion = ttk.Button(preview_controls,
+                                                     text="📝 Exportar comparación",
+                                                     command=self.exportar_comparacion,
+                                                     state="disabled",
+                                                     width=22)
+        self.boton_exportar_comparacion.pack(side="right", padx=5)
+        
+        ttk.Button(preview_controls,
+                  text="🔍 Comparar con...",
+                  command=self.comparar_minuta,
+                  width=18).pack(side="right")
+        
         # Área de texto para vista previa
         preview_frame = ttk.LabelFrame(main_preview_frame, text="Contenido de la Minuta", padding="10")
         preview_frame.pack(fill="both", expand=True)
@@ -310,6 +4693,8 @@ class SistemaPlantillasPersonalizadas:
         )
         self.texto_vista_previa.pack(fill="both", expand=True)
         self.texto_vista_previa.insert(tk.END, "Complete el formulario y genere la minuta para ver la vista previa aquí...")
+        self.texto_vista_previa.tag_configure("insertado", foreground="#1b5e20", background="#e8f5e9", underline=True)
+        self.texto_vista_previa.tag_configure("borrado", foreground="#b71c1c", background="#ffebee", overstrike=True)
     
     def configurar_tab_plantillas(self):
         # Frame principal
@@ -327,17 +4712,27 @@ class SistemaPlantillasPersonalizadas:
         ttk.Label(list_controls, 
                  text="Seleccione una plantilla para gestionar:", 
                  font=("Arial", 11)).pack(side="left")
+
+        # Búsqueda incremental y filtro por tipo
+        self.combo_filtro_tipo = ttk.Combobox(list_controls, width=15, state="readonly", font=("Arial", 10))
+        self.combo_filtro_tipo.pack(side="right")
+        self.combo_filtro_tipo.bind('<<ComboboxSelected>>', self.filtrar_plantillas)
+        ttk.Label(list_controls, text="Tipo:", font=("Arial", 10)).pack(side="right", padx=(15, 5))
+
+        self.busqueda_var = tk.StringVar()
+        self.busqueda_var.trace_add("write", self.filtrar_plantillas)
+        entry_busqueda = ttk.Entry(list_controls, textvariable=self.busqueda_var, width=30, font=("Arial", 10))
+        entry_busqueda.pack(side="right")
+        entry_busqueda.bind("<Return>", self.activar_primer_resultado)
+        ttk.Label(list_controls, text="🔎 Buscar:", font=("Arial", 10)).pack(side="right", padx=(15, 5))
+
+        self.label_resultados = ttk.Label(list_controls, text="", font=("Arial", 9), foreground="gray")
+        self.label_resultados.pack(side="left", padx=(15, 0))
         
-        # Frame para lista y scroll
-        list_container = ttk.Frame(lista_frame)
-        list_container.pack(fill="both", expand=True)
-        
-        self.lista_plantillas = tk.Listbox(list_container, height=12, font=("Arial", 11))
-        self.lista_plantillas.pack(side="left", fill="both", expand=True)
-        
-        scroll_lista = ttk.Scrollbar(list_container, orient="vertical", command=self.lista_plantillas.yview)
-        scroll_lista.pack(side="right", fill="y")
-        self.lista_plantillas.configure(yscrollcommand=scroll_lista.set)
+        # Lista virtual: solo dibuja las filas visibles
+        self.lista_plantillas = ListaVirtual(lista_frame, height=12, font=("Arial", 11))
+        self.lista_plantillas.pack(fill="both", expand=True)
+        self.lista_plantillas.bind("<<ListaActivar>>", lambda e: self.probar_plantilla())
         
         # Botones de gestión
         botones_frame = ttk.Frame(lista_frame)
@@ -356,7 +4751,22 @@ class SistemaPlantillasPersonalizadas:
         ttk.Button(botones_frame, 
                   text="📊 Probar Plantilla", 
                   command=self.probar_plantilla,
-                  width=15).pack(side="left")
+                  width=15).pack(side="left", padx=(0, 10))
+
+        ttk.Button(botones_frame,
+                  text="🧬 Duplicados",
+                  command=self.ver_plantillas_duplicadas,
+                  width=14).pack(side="left", padx=(0, 10))
+
+        ttk.Button(botones_frame,
+                  text="🕘 Historial",
+                  command=self.ver_historial_plantilla,
+                  width=12).pack(side="left", padx=(0, 10))
+
+        ttk.Button(botones_frame,
+                  text="📦 Exportar Paquete",
+                  command=self.exportar_paquete_plantillas,
+                  width=18).pack(side="left")
         
         # Panel de detalles
         detalles_frame = ttk.LabelFrame(main_management_frame, text="Detalles de la Plantilla Seleccionada", padding="15")
@@ -383,14 +4793,10 @@ class SistemaPlantillasPersonalizadas:
         
         if archivo:
             try:
-                doc = Document(archivo)
-                contenido = ""
+                contenido = extraer_texto_docx(archivo)
                 
-                for paragraph in doc.paragraphs:
-                    if paragraph.text.strip():
-                        contenido += paragraph.text + "\n\n"
-                
-                editor = EditorPlantillasDesdeMinuta(self.root, self.carpeta_plantillas, contenido, archivo)
+                editor = EditorPlantillasDesdeMinuta(self.root, self.carpeta_plantillas, contenido, archivo,
+                                                     buscar_similares=self.buscar_plantillas_similares)
                 self.root.wait_window(editor.ventana)
                 self.cargar_plantillas_guardadas()
                 
@@ -406,9 +4812,11 @@ class SistemaPlantillasPersonalizadas:
             if plantilla:
                 editor = EditorPlantillasDesdeMinuta(
                     self.root, self.carpeta_plantillas, 
-                    plantilla.get('contenido_base', ''), 
-                    plantilla.get('documento_origen', ''),
-                    plantilla_existente=plantilla
+                    plantilla.contenido_base,
+                    plantilla.documento_origen,
+                    plantilla_existente=plantilla.a_dict(),
+                    huella_original=plantilla.huella,
+                    buscar_similares=self.buscar_plantillas_similares
                 )
                 self.root.wait_window(editor.ventana)
                 self.cargar_plantillas_guardadas()
@@ -424,8 +4832,8 @@ class SistemaPlantillasPersonalizadas:
         errores = self.validar_formulario(datos)
         
         if errores:
-            messagebox.showwarning("Campos requeridos", 
-                                "Los siguientes campos son requeridos:\n\n• " + "\n• ".join(errores))
+            messagebox.showwarning("Campos con errores",
+                                "Revise los siguientes campos:\n\n• " + "\n• ".join(errores))
             return
         
         try:
@@ -433,8 +4841,11 @@ class SistemaPlantillasPersonalizadas:
             
             self.texto_vista_previa.delete("1.0", tk.END)
             self.texto_vista_previa.insert("1.0", minuta_generada)
+            self.minuta_actual = minuta_generada
             
-            self.generar_documento_word(minuta_generada)
+            self.generar_documento_word(minuta_generada, self.plantilla_activa, datos)
+            if self.autocompletado:
+                self.autocompletado.registrar(datos)
             
             self.notebook.select(1)
             self.status_var.set("✅ Minuta generada y guardada exitosamente!")
@@ -442,6 +4853,145 @@ class SistemaPlantillasPersonalizadas:
         except Exception as e:
             messagebox.showerror("Error", f"No se pudo generar la minuta: {str(e)}")
     
+    def comparar_minuta(self):
+        """Compara la minuta generada (o un .docx) con un borrador anterior o el documento origen"""
+        origen = self.plantilla_activa.documento_origen if self.plantilla_activa else ''
+        ruta_anterior = None
+        if origen and os.path.exists(origen):
+            respuesta = messagebox.askyesnocancel(
+                "Comparar minuta",
+                f"¿Comparar con el documento origen de la plantilla?\n\n{origen}\n\n"
+                "Responda 'No' para elegir otro borrador.")
+            if respuesta is None:
+                return
+            if respuesta:
+                ruta_anterior = origen
+        if not ruta_anterior:
+            ruta_anterior = filedialog.askopenfilename(title="Borrador anterior",
+                                                       filetypes=[("Documentos Word", "*.docx")])
+            if not ruta_anterior:
+                return
+        ruta_nueva = None
+        if self.minuta_actual is None:
+            ruta_nueva = filedialog.askopenfilename(title="Documento a comparar",
+                                                    filetypes=[("Documentos Word", "*.docx")])
+            if not ruta_nueva:
+                return
+
+        inicio = time.perf_counter()
+        try:
+            anteriores = list(parrafos_docx(ruta_anterior))
+            if ruta_nueva:
+                nuevos = list(parrafos_docx(ruta_nueva))
+            else:
+                nuevos = list(parrafos_de_texto(self.minuta_actual))
+        except (OSError, KeyError, zipfile.BadZipFile, ET.ParseError) as e:
+            messagebox.showerror("Error", f"No se pudo leer el documento: {e}")
+            return
+        resumen = self.mostrar_comparacion(comparar_parrafos(anteriores, nuevos))
+        self.comparacion = (anteriores, nuevos)
+        self.boton_exportar_comparacion.config(state="normal")
+        self.notebook.select(1)
+        self.status_var.set(
+            f"🔍 {resumen.get('cambiado', 0)} párrafos cambiados, {resumen.get('insertado', 0)} nuevos y "
+            f"{resumen.get('borrado', 0)} quitados · +{resumen.get('palabras_insertado', 0)} / "
+            f"-{resumen.get('palabras_borrado', 0)} palabras ({time.perf_counter() - inicio:.2f} s)")
+
+    def mostrar_comparacion(self, resultados):
+        """Escribe la comparación en la vista previa a medida que se produce; devuelve el resumen"""
+        texto = self.texto_vista_previa
+        texto.delete("1.0", tk.END)
+        resumen = {}
+        # Text.insert acepta varios pares (texto, etiquetas): se insertan por tandas
+        tanda = []
+        for tipo, contenido in contar_cambios(resultados, resumen):
+            segmentos = contenido if tipo == 'cambiado' else ((tipo, contenido),)
+            for subtipo, trozo in segmentos:
+                tanda.extend((trozo, () if subtipo == 'igual' else (subtipo,)))
+            tanda.extend(("\n", ()))
+            if len(tanda) >= 2000:
+                texto.insert(tk.END, *tanda)
+                tanda = []
+        if tanda:
+            texto.insert(tk.END, *tanda)
+        texto.see("1.0")
+        return resumen
+
+    def exportar_comparacion(self):
+        if not self.comparacion:
+            return
+        ruta = filedialog.asksaveasfilename(
+            title="Guardar comparación como...",
+            defaultextension=".docx",
+            filetypes=[("Documentos Word", "*.docx")],
+            initialfile=f"comparacion_{datetime.now().strftime('%Y%m%d_%H%M')}.docx")
+        if not ruta:
+            return
+        try:
+            documento_comparacion(comparar_parrafos(*self.comparacion)).save(ruta)
+        except OSError as e:
+            messagebox.showerror("Error", f"No se pudo guardar la comparación: {e}")
+            return
+        self.status_var.set(f"📝 Comparación guardada con control de cambios: {ruta}")
+        try:
+            os.startfile(ruta)
+        except Exception:
+            pass  # Evita crash si el SO no soporta startfile
+
+    def corregir_ultima_minuta(self):
+        """Reescribe en el sitio la última minuta guardada con los datos corregidos del formulario"""
+        if not self.plantilla_activa:
+            messagebox.showwarning("Advertencia", "No hay plantilla activa. Seleccione una plantilla primero.")
+            return
+        if not self.ultima_minuta or self.ultima_minuta[0] != self.plantilla_activa.nombre:
+            messagebox.showwarning("Advertencia", "No hay una minuta de esta plantilla generada con este formulario.")
+            return
+        ruta = self.ultima_minuta[1]
+        if not os.path.exists(ruta):
+            messagebox.showwarning("Advertencia", f"La minuta ya no existe:\n\n{ruta}")
+            self.ultima_minuta = None
+            return
+        datos = self.obtener_datos_formulario()
+        errores = self.validar_formulario(datos)
+        if errores:
+            messagebox.showwarning("Campos con errores",
+                                "Revise los siguientes campos:\n\n• " + "\n• ".join(errores))
+            return
+
+        inicio = time.perf_counter()
+        try:
+            contenido = self.aplicar_plantilla(self.plantilla_activa, datos)
+            reescritos = regenerar_minuta(ruta, self.plantilla_activa, datos)
+            if reescritos is None:
+                editados = parrafos_editados(ruta)
+                if editados and not messagebox.askyesno(
+                        "Minuta editada",
+                        "La minuta se modificó en Word (párrafos " + ", ".join(map(str, editados[:10]))
+                        + ("…" if len(editados) > 10 else "") + ").\n\n"
+                        "Para corregirla hay que regenerarla completa y esos cambios se perderán. ¿Continuar?"):
+                    return
+                # Se rehace el documento completo en memoria y se reemplaza de una vez
+                memoria = io.BytesIO()
+                self.construir_documento_word(contenido, self.plantilla_activa, datos).save(memoria)
+                _escribir_bytes_atomico(ruta, memoria.getvalue())
+        except PermissionError:
+            messagebox.showerror("Error", f"No se pudo actualizar {ruta}.\n\n¿Está abierta en Word?")
+            return
+        except Exception as e:
+            messagebox.showerror("Error", f"No se pudo corregir la minuta: {str(e)}")
+            return
+        self.texto_vista_previa.delete("1.0", tk.END)
+        self.texto_vista_previa.insert("1.0", contenido)
+        self.minuta_actual = contenido
+        self.notebook.select(1)
+        if reescritos is None:
+            self.status_var.set(f"✅ Minuta regenerada por completo: {ruta}")
+        elif reescritos:
+            self.status_var.set(f"✅ Minuta corregida: {reescritos} párrafo(s) reescrito(s) en {ruta}")
+        else:
+            self.status_var.set("La minuta ya estaba al día; no hubo cambios")
+        self.auditar(self.plantilla_activa, datos, ruta, time.perf_counter() - inicio, 'actualizacion')
+
     def obtener_datos_formulario(self):
         datos = {}
         if hasattr(self, 'campos_ui'):
@@ -453,34 +5003,338 @@ class SistemaPlantillasPersonalizadas:
                     datos[campo_id] = widget.get("1.0", tk.END).strip()
                 elif isinstance(widget, ttk.Combobox):
                     datos[campo_id] = widget.get()
+                elif isinstance(widget, GrupoRepetible):
+                    datos[campo_id] = widget.obtener()
         return datos
     
+    def establecer_datos_formulario(self, datos):
+        for campo_id, widget_info in getattr(self, 'campos_ui', {}).items():
+            if campo_id not in datos:
+                continue
+            widget = widget_info['widget']
+            valor = datos[campo_id]
+            if isinstance(widget, GrupoRepetible):
+                widget.establecer(valor if isinstance(valor, list) else [])
+            elif isinstance(widget, tk.Text):
+                widget.delete("1.0", tk.END)
+                widget.insert("1.0", valor)
+            elif isinstance(widget, ttk.Combobox):
+                widget.set(valor)
+            elif isinstance(widget, ttk.Entry):
+                widget.delete(0, tk.END)
+                widget.insert(0, valor)
+
+    def fuente_datos_activa(self):
+        if not self.plantilla_activa:
+            messagebox.showwarning("Advertencia", "No hay plantilla activa. Seleccione una plantilla primero.")
+            return None
+        if not self.plantilla_activa.fuente_datos:
+            messagebox.showwarning("Advertencia", "La plantilla activa no tiene una fuente de datos configurada.")
+            return None
+        return FuenteDatosSQLite(self.plantilla_activa.fuente_datos, self.carpeta_plantillas)
+
+    def cargar_datos_caso(self):
+        fuente = self.fuente_datos_activa()
+        caso = self.entry_caso.get().strip()
+        if not fuente or not caso:
+            return
+        try:
+            datos = fuente.registro(caso, self.plantilla_activa.campos)
+        except ErrorFuenteDatos as e:
+            messagebox.showerror("Error", str(e))
+            return
+        if datos is None:
+            messagebox.showwarning("Advertencia", f"No se encontró el caso '{caso}'.")
+            return
+        self.establecer_datos_formulario(datos)
+        self.ultima_minuta = None  # Otro caso: su minuta no es la última generada
+        self.status_var.set(f"Datos del caso {caso} cargados desde {fuente.ruta.name}")
+
     def validar_formulario(self, datos):
+        return [f"{nombre}: {mensaje}" for nombre, mensaje in validar_registro(self.validadores_activos, datos)]
+
+    def generar_lote_csv(self):
+        if not self.plantilla_activa:
+            messagebox.showwarning("Advertencia", "No hay plantilla activa. Seleccione una plantilla primero.")
+            return
+
+        archivo = filedialog.askopenfilename(
+            title="Seleccionar CSV con los registros del lote",
+            filetypes=[("Archivos CSV", "*.csv"), ("Todos los archivos", "*.*")]
+        )
+        if not archivo:
+            return
+
+        campos = self.plantilla_activa.campos
+        try:
+            registros = leer_registros_csv(archivo, campos)
+        except Exception as e:
+            messagebox.showerror("Error", f"No se pudo leer el CSV: {str(e)}")
+            return
+
+        if not registros:
+            messagebox.showwarning("Advertencia", "El CSV no contiene registros.")
+            return
+
+        # Validar el lote completo antes de generar cualquier documento
+        errores = validar_lote(self.plantilla_activa.validadores(), registros)
+        if errores:
+            self.mostrar_errores_lote(errores, len(registros))
+            return
+
+        salida = self.elegir_salida_lote()
+        if not salida:
+            return
+
+        try:
+            generadas = self.generar_documentos_lote(enumerate(registros, 1), salida, len(registros))
+            self.status_var.set(f"✅ Lote generado: {generadas} minutas en {salida.descripcion()}")
+            messagebox.showinfo("Éxito", f"Se generaron {generadas} minutas en:\n{salida.descripcion()}")
+        except Exception as e:
+            messagebox.showerror("Error", f"No se pudo generar el lote: {str(e)}")
+
+    def elegir_salida_lote(self):
+        """Pregunta dónde dejar el lote: en un ZIP (Sí) o en una carpeta (No)"""
+        respuesta = messagebox.askyesnocancel(
+            "Salida del lote",
+            "¿Empaquetar las minutas en un archivo ZIP?\n\n"
+            f"Sí: un ZIP (se parte cada {MAXIMO_DOCUMENTOS_POR_ZIP} minutas o "
+            f"{MAXIMO_BYTES_POR_ZIP // (1024 * 1024)} MB)\nNo: una carpeta con un .docx por minuta")
+        if respuesta is None:
+            return None
+        if respuesta:
+            ruta = filedialog.asksaveasfilename(
+                title="Guardar lote como...",
+                defaultextension=".zip",
+                filetypes=[("Archivos ZIP", "*.zip")],
+                initialfile=f"lote_{datetime.now().strftime('%Y%m%d_%H%M')}.zip"
+            )
+            if not ruta:
+                return None
+            return SalidaZip(ruta, self.plantilla_activa, MAXIMO_DOCUMENTOS_POR_ZIP, MAXIMO_BYTES_POR_ZIP)
+        carpeta_salida = filedialog.askdirectory(title="Carpeta donde guardar las minutas del lote")
+        return SalidaCarpeta(carpeta_salida, self.plantilla_activa) if carpeta_salida else None
+
+    def generar_documentos_lote(self, registros_numerados, salida, total):
+        """Genera una minuta por cada (número, datos); devuelve cuántas generó"""
+        with salida:
+            for numero, datos in registros_numerados:
+                inicio = time.perf_counter()
+                contenido = self.aplicar_plantilla(self.plantilla_activa, datos)
+                doc = self.construir_documento_word(contenido, self.plantilla_activa, datos)
+                ubicacion = salida.agregar(numero, f"minuta_{numero:04d}.docx", doc)
+                self.auditar(self.plantilla_activa, datos, ubicacion, time.perf_counter() - inicio,
+                             'lote', numero)
+                if salida.total % 10 == 0:
+                    self.status_var.set(f"Generando lote... {salida.total}/{total}")
+                    self.root.update_idletasks()
+        return salida.total
+
+    def generar_lote_fuente(self):
+        fuente = self.fuente_datos_activa()
+        if not fuente:
+            return
+        try:
+            total = fuente.contar_lote()
+        except ErrorFuenteDatos as e:
+            messagebox.showerror("Error", str(e))
+            return
+        if not total:
+            messagebox.showwarning("Advertencia", "La consulta del lote no devolvió registros.")
+            return
+        if not messagebox.askyesno("Confirmar", f"Se generarán hasta {total} minutas desde {fuente.ruta.name}. ¿Continuar?"):
+            return
+
+        salida = self.elegir_salida_lote()
+        if not salida:
+            return
+
+        # Los registros llegan por bloques; cada bloque se valida antes de
+        # generarlo y los registros con errores se omiten y se informan al final
+        validadores = self.plantilla_activa.validadores()
         errores = []
-        if hasattr(self, 'campos_ui'):
-            for campo_id, widget_info in self.campos_ui.items():
-                if widget_info.get('requerido', False) and not datos.get(campo_id):
-                    errores.append(widget_info['label'])
-        return errores
+
+        def registros_validos():
+            inicio = 0
+            for bloque in fuente.bloques_lote(self.plantilla_activa.campos):
+                errores_bloque = validar_lote(validadores, bloque)
+                filas_con_error = {fila for fila, _, _ in errores_bloque}
+                errores.extend((inicio + fila, nombre, mensaje) for fila, nombre, mensaje in errores_bloque)
+                for fila, datos in enumerate(bloque, 1):
+                    if fila not in filas_con_error:
+                        yield inicio + fila, datos
+                inicio += len(bloque)
+
+        try:
+            generadas = self.generar_documentos_lote(registros_validos(), salida, total)
+        except Exception as e:
+            messagebox.showerror("Error", f"No se pudo generar el lote: {str(e)}")
+            return
+
+        self.status_var.set(f"✅ Lote generado: {generadas} minutas en {salida.descripcion()}")
+        if errores:
+            self.mostrar_errores_lote(errores, total,
+                                      f"Se generaron {generadas} minutas; se omitieron los registros con errores.",
+                                      etiqueta="Registro", desplazamiento=0)
+        else:
+            messagebox.showinfo("Éxito", f"Se generaron {generadas} minutas en:\n{salida.descripcion()}")
+
+    def auditar(self, plantilla, datos, salida, duracion, modo='individual', registro=None):
+        if self.auditoria and plantilla is not None:
+            self.auditoria.registrar(plantilla, datos or {}, salida, duracion, modo, registro)
+
+    def cambiar_auditoria(self):
+        activar = self.auditoria_var.get()
+        if activar and not self.auditoria:
+            if not messagebox.askyesno(
+                    "Auditoría",
+                    "Se registrará cada minuta generada (fecha, plantilla y versión, huella de los datos, "
+                    f"archivo de salida y duración) en '{CARPETA_DATOS / CARPETA_AUDITORIA}'.\n"
+                    "Los valores de los campos no se guardan.\n\n¿Activar la auditoría?"):
+                self.auditoria_var.set(False)
+                return
+            self.auditoria = RegistroAuditoria()
+        elif not activar:
+            self.cerrar_auditoria()
+        self.configuracion['auditoria'] = activar
+        guardar_configuracion(self.configuracion)
+        self.status_var.set("Auditoría de minutas " + ("activada" if activar else "desactivada"))
+
+    def cambiar_autocompletado(self):
+        activar = self.autocompletado_var.get()
+        if activar and not self.autocompletado:
+            if not messagebox.askyesno(
+                    "Recordar valores",
+                    "Los valores escritos en los campos (nombres, direcciones, notarías...) se guardarán en "
+                    f"'{CARPETA_DATOS / ARCHIVO_AUTOCOMPLETADO}' para sugerirlos al escribir, y lo que quede "
+                    "en el formulario al cerrar se recuperará al volver a abrir.\n\n"
+                    "Esto guarda datos personales en este equipo. ¿Activar?"):
+                self.autocompletado_var.set(False)
+                return
+            self.autocompletado = HistorialValores()
+        elif not activar:
+            self.autocompletado = None
+            self.ocultar_sugerencias()
+            borrar_sesion()  # puede contener el borrador del formulario
+        self.configuracion['autocompletado'] = activar
+        guardar_configuracion(self.configuracion)
+        self.status_var.set("Sugerencias de valores " + ("activadas" if activar else "desactivadas"))
+
+    def olvidar_valores(self):
+        if not messagebox.askyesno("Olvidar valores",
+                                   "¿Borrar todos los valores recordados para autocompletar?"):
+            return
+        historial = self.autocompletado or HistorialValores()
+        borrados = historial.purgar()
+        borrar_sesion()
+        self.ocultar_sugerencias()
+        self.status_var.set(f"🧽 Se olvidaron {borrados} valores recordados")
+
+    def conectar_autocompletado(self, widget, campo_id):
+        widget.bind('<KeyRelease>', lambda evento: self.mostrar_sugerencias(evento, campo_id))
+        widget.bind('<Down>', lambda evento: self.entrar_sugerencias())
+        widget.bind('<Escape>', lambda evento: self.ocultar_sugerencias())
+        # Se oculta con retardo para que un clic en la lista alcance a elegir
+        widget.bind('<FocusOut>', lambda evento: self.root.after(150, self.ocultar_si_sin_foco))
+
+    def opciones_con_historial(self, widget, campo):
+        if self.autocompletado:
+            recordados = [valor for valor in self.autocompletado.sugerencias(campo.id, '', 20)
+                          if valor not in campo.opciones]
+            widget.configure(values=list(campo.opciones) + recordados)
+
+    def mostrar_sugerencias(self, evento, campo_id):
+        if not self.autocompletado or evento.keysym in ('Down', 'Up', 'Return', 'Escape', 'Tab'):
+            return
+        entrada = evento.widget
+        texto = entrada.get()
+        sugerencias = [valor for valor in self.autocompletado.sugerencias(campo_id, texto)
+                       if valor != texto] if texto.strip() else []
+        if not sugerencias:
+            self.ocultar_sugerencias()
+            return
+        if self.ventana_sugerencias is None:
+            # Una sola ventana emergente, reutilizada para todos los campos
+            self.ventana_sugerencias = tk.Toplevel(self.root)
+            self.ventana_sugerencias.wm_overrideredirect(True)
+            self.lista_sugerencias = tk.Listbox(self.ventana_sugerencias, font=("Arial", 9),
+                                                activestyle="dotbox", exportselection=False)
+            self.lista_sugerencias.pack(fill="both", expand=True)
+            self.lista_sugerencias.bind('<ButtonRelease-1>', lambda e: self.elegir_sugerencia())
+            self.lista_sugerencias.bind('<Return>', lambda e: self.elegir_sugerencia())
+            self.lista_sugerencias.bind('<Escape>', lambda e: self.ocultar_sugerencias(True))
+        self.entrada_sugerencias = entrada
+        self.lista_sugerencias.delete(0, tk.END)
+        for valor in sugerencias:
+            self.lista_sugerencias.insert(tk.END, valor)
+        self.lista_sugerencias.configure(height=len(sugerencias))
+        self.ventana_sugerencias.wm_geometry(
+            f"{entrada.winfo_width()}x{len(sugerencias) * 18 + 4}"
+            f"+{entrada.winfo_rootx()}+{entrada.winfo_rooty() + entrada.winfo_height()}")
+        self.ventana_sugerencias.deiconify()
+        self.ventana_sugerencias.lift()
+
+    def entrar_sugerencias(self):
+        if self.ventana_sugerencias is not None and self.ventana_sugerencias.winfo_viewable():
+            self.lista_sugerencias.focus_set()
+            self.lista_sugerencias.selection_clear(0, tk.END)
+            self.lista_sugerencias.selection_set(0)
+            self.lista_sugerencias.activate(0)
+
+    def elegir_sugerencia(self):
+        seleccion = self.lista_sugerencias.curselection()
+        if seleccion:
+            entrada = self.entrada_sugerencias
+            entrada.delete(0, tk.END)
+            entrada.insert(0, self.lista_sugerencias.get(seleccion[0]))
+            entrada.icursor(tk.END)
+        self.ocultar_sugerencias(True)
+
+    def ocultar_si_sin_foco(self):
+        if self.ventana_sugerencias is not None and self.root.focus_get() is not self.lista_sugerencias:
+            self.ocultar_sugerencias()
+
+    def ocultar_sugerencias(self, devolver_foco=False):
+        if self.ventana_sugerencias is not None:
+            self.ventana_sugerencias.withdraw()
+            if devolver_foco:
+                self.entrada_sugerencias.focus_set()
+
+    def cerrar_auditoria(self):
+        if self.auditoria:
+            self.auditoria.cerrar()
+            self.auditoria = None
+
+    def mostrar_errores_lote(self, errores, total_registros, resultado="No se generó ningún documento.",
+                             etiqueta="Fila", desplazamiento=1):
+        ventana = tk.Toplevel(self.root)
+        ventana.title("Errores de validación del lote")
+        ventana.geometry("700x500")
+        ventana.transient(self.root)
+
+        filas_con_error = len({fila for fila, _, _ in errores})
+        ttk.Label(ventana,
+                 text=f"{len(errores)} errores en {filas_con_error} de {total_registros} registros. {resultado}",
+                 font=("Arial", 11, "bold")).pack(anchor="w", padx=15, pady=10)
+
+        texto = scrolledtext.ScrolledText(ventana, wrap=tk.WORD, font=("Consolas", 10))
+        texto.pack(fill="both", expand=True, padx=15, pady=(0, 15))
+        # En el CSV se suma 1 porque la fila 1 es el encabezado
+        texto.insert("1.0", "\n".join(f"{etiqueta} {fila + desplazamiento} · {campo}: {mensaje}"
+                                       for fila, campo, mensaje in errores))
+        texto.config(state="disabled")
     
     def aplicar_plantilla(self, plantilla, datos):
-        contenido_base = plantilla.get('contenido_base', '')
-        
-        for campo_id, valor in datos.items():
-            marcador = f"[[{campo_id}]]"
-            contenido_base = contenido_base.replace(marcador, valor)
-        
-        contenido_base = re.sub(r'\[\[.*?\]\]', '[SIN DATO]', contenido_base)
-        return contenido_base
+        return renderizar_contenido(plantilla.contenido_base, datos, plantilla.formatos)
     
-    def generar_documento_word(self, contenido):
-        doc = Document()
-        self.aplicar_formato_apa(doc)
-        
-        for linea in contenido.split('\n'):
-            if linea.strip():
-                doc.add_paragraph(linea)
-        
+    def construir_documento_word(self, contenido, plantilla=None, datos=None):
+        return construir_documento_word(contenido, plantilla, datos)
+
+    def generar_documento_word(self, contenido, plantilla=None, datos=None):
+        inicio = time.perf_counter()
+        doc = self.construir_documento_word(contenido, plantilla, datos)
+        duracion = time.perf_counter() - inicio
+
         archivo_salida = filedialog.asksaveasfilename(
             title="Guardar minuta como...",
             defaultextension=".docx",
@@ -489,7 +5343,12 @@ class SistemaPlantillasPersonalizadas:
         )
         
         if archivo_salida:
+            inicio = time.perf_counter()
             doc.save(archivo_salida)
+            # El tiempo en el diálogo de guardado no cuenta como generación
+            self.auditar(plantilla, datos, archivo_salida, duracion + time.perf_counter() - inicio)
+            if plantilla is not None:
+                self.ultima_minuta = (plantilla.nombre, archivo_salida)
             try:
                 os.startfile(archivo_salida)
             except Exception:
@@ -497,55 +5356,151 @@ class SistemaPlantillasPersonalizadas:
             return True
         return False
     
-    def aplicar_formato_apa(self, doc):
-        sections = doc.sections
-        for section in sections:
-            section.top_margin = Inches(1)
-            section.bottom_margin = Inches(1)
-            section.left_margin = Inches(1)
-            section.right_margin = Inches(1)
-        
-        style = doc.styles['Normal']
-        font = style.font
-        font.name = 'Times New Roman'
-        font.size = Pt(12)
-        
-        paragraph_format = style.paragraph_format
-        paragraph_format.line_spacing = 2.0
-    
-    def cargar_plantillas_guardadas(self):
-        self.plantillas_personalizadas = {}
+    def cargar_plantillas_guardadas(self, solo_cambios=False):
+        """Lee la carpeta de plantillas; las que no cambiaron desde la última lectura se conservan"""
+        cambios = False
+        encontradas = set()
         for archivo in self.carpeta_plantillas.glob("*.json"):
+            nombre = archivo.stem
+            encontradas.add(nombre)
             try:
-                with open(archivo, 'r', encoding='utf-8') as f:
-                    plantilla = json.load(f)
-                self.plantillas_personalizadas[archivo.stem] = plantilla
+                firma = _firma_cache(archivo.stat())
+                if nombre in self.plantillas_personalizadas and self.firmas_plantillas.get(nombre) == firma:
+                    continue
+                anterior = self.plantillas_personalizadas.pop(nombre, None)
+                if anterior is not None:
+                    _POSICIONES_PRECALCULADAS.pop(anterior.contenido_base, None)
+                cambios = True
+                datos, huella = cargar_plantilla_con_cache(archivo)
+                plantilla = Plantilla.desde_dict(datos, nombre, huella)
+                self.plantillas_personalizadas[nombre] = plantilla
+                self.firmas_plantillas[nombre] = firma
             except Exception as e:
                 print(f"Error cargando plantilla {archivo}: {e}")
+        for nombre in [n for n in self.plantillas_personalizadas if n not in encontradas]:
+            _POSICIONES_PRECALCULADAS.pop(self.plantillas_personalizadas.pop(nombre).contenido_base, None)
+            self.firmas_plantillas.pop(nombre, None)
+            cambios = True
         
-        self.actualizar_listas_plantillas()
+        if cambios or not solo_cambios:
+            self.actualizar_listas_plantillas()
     
-    def actualizar_listas_plantillas(self):
-        plantillas = list(self.plantillas_personalizadas.keys())
-        self.combo_plantillas['values'] = plantillas
-        self.lista_plantillas.delete(0, tk.END)
-        
-        for nombre in plantillas:
-            self.lista_plantillas.insert(tk.END, nombre)
+    def actualizar_listas_plantillas(self, seleccionar=None):
+        self.indice_busqueda.sincronizar({nombre: plantilla.tipo
+                                          for nombre, plantilla in self.plantillas_personalizadas.items()})
+        self.combo_filtro_tipo['values'] = [''] + self.indice_busqueda.tipos_disponibles()
+        plantillas = self.filtrar_plantillas()
         
         if plantillas:
-            self.combo_plantillas.set(plantillas[0])
-            self.cambiar_plantilla()
+            actual = seleccionar or self.combo_plantillas.get()
+            nombre = actual if actual in self.plantillas_personalizadas else plantillas[0]
+            self.combo_plantillas.set(nombre)
+            # Si la plantilla activa sigue igual, se conserva lo escrito en el formulario
+            if self.plantillas_personalizadas[nombre] is not self.plantilla_activa:
+                self.cambiar_plantilla()
+
+    # ===== SESIÓN =====
+
+    def estado_sesion(self):
+        # Solo las firmas: cada plantilla se recupera de su caché binaria
+        firmas = {nombre: self.firmas_plantillas[nombre]
+                  for nombre in self.plantillas_personalizadas if nombre in self.firmas_plantillas}
+        sesion = {
+            'carpeta': str(self.carpeta_plantillas.resolve()),
+            'plantillas': firmas,
+            'indice_busqueda': self.indice_busqueda.estado(),
+            'activa': self.combo_plantillas.get(),
+            'busqueda': self.busqueda_var.get(),
+            'filtro_tipo': self.combo_filtro_tipo.get(),
+            'pestana': self.notebook.index(self.notebook.select()),
+            'geometria': self.root.geometry(),
+            'maximizada': self.root.state() == 'zoomed',
+        }
+        if self.autocompletado and self.plantilla_activa:
+            # Lo escrito en el formulario son datos personales: solo con "Recordar valores"
+            sesion['borrador'] = self.obtener_datos_formulario()
+        return sesion
+
+    def restaurar_sesion(self):
+        """Restablece la sesión anterior; devuelve False si no hay una utilizable"""
+        sesion = leer_sesion()
+        if not sesion or sesion.get('carpeta') != str(self.carpeta_plantillas.resolve()):
+            return False
+        try:
+            for nombre, firma in sesion['plantillas'].items():
+                # Sin caché vigente la plantilla queda fuera y se lee con la carpeta
+                desde_cache = leer_cache_plantilla(self.carpeta_plantillas / f"{nombre}.json", firma)
+                if desde_cache is not None:
+                    datos, huella = desde_cache
+                    self.plantillas_personalizadas[nombre] = Plantilla.desde_dict(datos, nombre, huella)
+                    self.firmas_plantillas[nombre] = firma
+            self.indice_busqueda = IndiceBusqueda.desde_estado(sesion['indice_busqueda'])
+        except (KeyError, TypeError, ValueError):
+            self.plantillas_personalizadas = {}
+            self.firmas_plantillas = {}
+            self.indice_busqueda = IndiceBusqueda()
+            return False
+
+        self.root.geometry(sesion.get('geometria') or "1400x900")
+        if sesion.get('maximizada'):
+            try:
+                self.root.state('zoomed')
+            except tk.TclError:
+                pass  # 'zoomed' no existe en todos los sistemas
+        self.busqueda_var.set(sesion.get('busqueda', ''))
+        self.combo_filtro_tipo.set(sesion.get('filtro_tipo', ''))
+        self.actualizar_listas_plantillas(sesion.get('activa'))
+        if sesion.get('borrador') and self.autocompletado:
+            self.establecer_datos_formulario(sesion['borrador'])
+        try:
+            self.notebook.select(sesion.get('pestana', 0))
+        except tk.TclError:
+            pass
+        self.status_var.set("✅ Sesión anterior restablecida")
+        return True
+
+    def cerrar_aplicacion(self):
+        try:
+            guardar_sesion(self.estado_sesion())
+        except Exception as e:
+            # Un error al guardar la sesión no debe impedir cerrar
+            print(f"No se pudo guardar la sesión: {e}")
+        self.root.destroy()
+
+    def filtrar_plantillas(self, *args):
+        """Aplica la búsqueda y el filtro de tipo a la lista y al selector"""
+        plantillas = self.indice_busqueda.buscar(self.busqueda_var.get(), self.combo_filtro_tipo.get())
+        self.lista_plantillas.establecer_elementos(plantillas)
+        self.combo_plantillas['values'] = plantillas[:LIMITE_SELECTOR_PLANTILLAS]
+        self.label_resultados.config(text=f"{len(plantillas)} de {len(self.plantillas_personalizadas)}")
+        return plantillas
+
+    def activar_primer_resultado(self, event=None):
+        if self.lista_plantillas.size():
+            self.lista_plantillas.seleccionar(0)
+            self.probar_plantilla()
     
     def cambiar_plantilla(self, event=None):
         nombre_plantilla = self.combo_plantillas.get()
         if nombre_plantilla in self.plantillas_personalizadas:
-            self.plantilla_activa = self.plantillas_personalizadas[nombre_plantilla]
+            plantilla = self.plantillas_personalizadas[nombre_plantilla]
+            try:
+                self.validadores_activos = plantilla.validadores()
+            except ErrorPlantilla as e:
+                messagebox.showerror("Error en la plantilla",
+                                     f"La plantilla '{nombre_plantilla}' no se puede usar:\n\n{e}\n\n"
+                                     "Corríjala con 'Editar Plantilla'.")
+                self.combo_plantillas.set(self.plantilla_activa.nombre if self.plantilla_activa else '')
+                return
+            self.plantilla_activa = plantilla
+            self.ultima_minuta = None
             self.cargar_formulario_plantilla()
             self.actualizar_info_plantilla()
             self.status_var.set(f"✅ Plantilla activa: {nombre_plantilla}")
     
     def cargar_formulario_plantilla(self):
+        # El tooltip compartido podría estar mostrando un campo que va a desaparecer
+        self.ocultar_tooltip()
         for widget in self.frame_campos.winfo_children():
             widget.destroy()
         
@@ -554,7 +5509,7 @@ class SistemaPlantillasPersonalizadas:
         if not self.plantilla_activa:
             return
         
-        campos = self.plantilla_activa.get('campos_personalizados', [])
+        campos = self.plantilla_activa.campos
         
         if not campos:
             self.label_form_vacio = ttk.Label(self.frame_campos, 
@@ -563,26 +5518,34 @@ class SistemaPlantillasPersonalizadas:
             self.label_form_vacio.pack(pady=50)
             return
         
-        for i, campo in enumerate(campos):
-            self.crear_campo_formulario(campo, i)
+        # Con formularios grandes cada inserción provocaría un recálculo de la región;
+        # se suspende y se hace uno solo al terminar
+        self.form_scrollable.suspender_actualizaciones()
+        self.form_scrollable.estadisticas_eventos(reiniciar=True)
+        try:
+            for i, campo in enumerate(campos):
+                self.crear_campo_formulario(campo, i)
+        finally:
+            self.form_scrollable.reanudar_actualizaciones()
     
     def crear_campo_formulario(self, campo, index):
         frame_campo = ttk.Frame(self.frame_campos)
         frame_campo.pack(fill="x", pady=8, padx=15)
         
-        label_text = campo['nombre']
-        if campo.get('requerido', False):
+        label_text = campo.nombre
+        if campo.requerido:
             label_text += " *"
         
         label = ttk.Label(frame_campo, text=label_text, width=25, anchor="w", font=("Arial", 10))
         label.pack(side="left", padx=(0, 15))
         
-        campo_id = campo['id']
-        if campo['tipo'] == 'texto':
+        campo_id = campo.id
+        if campo.tipo == 'texto':
             widget = ttk.Entry(frame_campo, width=50, font=("Arial", 9))
             widget.pack(side="left", fill="x", expand=True)
+            self.conectar_autocompletado(widget, campo_id)
             
-        elif campo['tipo'] == 'textarea':
+        elif campo.tipo == 'textarea':
             frame_text = ttk.Frame(frame_campo)
             frame_text.pack(side="left", fill="x", expand=True)
             
@@ -593,59 +5556,83 @@ class SistemaPlantillasPersonalizadas:
             widget.pack(side="left", fill="both", expand=True)
             scrollbar.pack(side="right", fill="y")
             
-        elif campo['tipo'] == 'seleccion':
-            widget = ttk.Combobox(frame_campo, width=48, values=campo.get('opciones', []), font=("Arial", 9))
+        elif campo.tipo == 'seleccion':
+            widget = ttk.Combobox(frame_campo, width=48, values=list(campo.opciones), font=("Arial", 9))
+            widget.configure(postcommand=lambda w=widget, c=campo: self.opciones_con_historial(w, c))
             widget.pack(side="left", fill="x", expand=True)
             
-        elif campo['tipo'] == 'fecha':
+        elif campo.tipo == 'fecha':
             widget = ttk.Entry(frame_campo, width=25, font=("Arial", 9))
             widget.pack(side="left")
             ttk.Label(frame_campo, text="(DD/MM/AAAA)", font=("Arial", 8), foreground="gray").pack(side="left", padx=(5, 0))
-        
-        if campo.get('descripcion'):
-            self.crear_tooltip(label, campo['descripcion'])
+
+        elif campo.tipo == 'grupo':
+            widget = GrupoRepetible(frame_campo, campo.subcampos)
+            widget.pack(side="left", fill="x", expand=True)
+
+        if campo.descripcion:
+            self.crear_tooltip(label, campo.descripcion)
+
+        if campo_id not in self.plantilla_activa.marcadores:
+            ttk.Label(frame_campo, text="(no se usa en el texto)", font=("Arial", 8),
+                      foreground="gray").pack(side="left", padx=(5, 0))
         
         self.campos_ui[campo_id] = {
             'widget': widget,
-            'label': campo['nombre'],
-            'requerido': campo.get('requerido', False)
+            'label': campo.nombre,
+            'requerido': campo.requerido
         }
     
     def crear_tooltip(self, widget, text):
+        # Una sola ventana de ayuda para toda la aplicación: se reutiliza en cada
+        # <Enter> en lugar de crear y destruir un Toplevel por pasada del ratón
         def on_enter(event):
-            tooltip = tk.Toplevel()
-            tooltip.wm_overrideredirect(True)
-            tooltip.wm_geometry(f"+{event.x_root+10}+{event.y_root+10}")
-            label = ttk.Label(tooltip, text=text, background="lightyellow", 
-                            relief="solid", borderwidth=1, padding=5, font=("Arial", 9))
-            label.pack()
-            widget.tooltip = tooltip
+            if self.tooltip is None:
+                self.tooltip = tk.Toplevel(self.root)
+                self.tooltip.wm_overrideredirect(True)
+                self.tooltip.withdraw()
+                self.label_tooltip = ttk.Label(self.tooltip, background="lightyellow",
+                                               relief="solid", borderwidth=1, padding=5,
+                                               font=("Arial", 9))
+                self.label_tooltip.pack()
+            self.label_tooltip.configure(text=text)
+            self.tooltip.wm_geometry(f"+{event.x_root+10}+{event.y_root+10}")
+            self.tooltip.deiconify()
+            self.tooltip.lift()
         
         def on_leave(event):
-            if hasattr(widget, 'tooltip'):
-                widget.tooltip.destroy()
+            self.ocultar_tooltip()
         
         widget.bind("<Enter>", on_enter)
         widget.bind("<Leave>", on_leave)
     
+    def ocultar_tooltip(self):
+        if self.tooltip is not None:
+            self.tooltip.withdraw()
+    
     def actualizar_info_plantilla(self):
         if self.plantilla_activa:
-            self.label_info_nombre.config(text=f"Nombre: {self.plantilla_activa.get('nombre', 'N/A')}")
-            self.label_info_desc.config(text=f"Descripción: {self.plantilla_activa.get('descripcion', 'N/A')}")
-            
-            campos = self.plantilla_activa.get('campos_personalizados', [])
-            campos_requeridos = sum(1 for c in campos if c.get('requerido', False))
-            self.label_info_campos.config(text=f"Campos: {len(campos)} (Requeridos: {campos_requeridos})")
-            
-            self.label_descripcion.config(text=self.plantilla_activa.get('descripcion', 'Sin descripción'))
+            plantilla = self.plantilla_activa
+            self.label_info_nombre.config(text=f"Nombre: {plantilla.nombre or 'N/A'}")
+            self.label_info_desc.config(text=f"Descripción: {plantilla.descripcion or 'N/A'}")
+            self.label_info_campos.config(text=f"Campos: {len(plantilla.campos)} (Requeridos: {len(plantilla.requeridos)})")
+            self.label_descripcion.config(text=plantilla.descripcion or 'Sin descripción')
+            if plantilla.fuente_datos:
+                self.frame_caso.grid(row=1, column=0, columnspan=3, sticky="w", pady=(5, 0))
+            else:
+                self.frame_caso.grid_remove()
     
     def importar_plantilla(self):
         archivo = filedialog.askopenfilename(
             title="Importar plantilla",
-            filetypes=[("Archivos de plantilla", "*.json")]
+            filetypes=[("Plantillas y paquetes", f"*.json *{EXTENSION_PAQUETE}"),
+                       ("Archivos de plantilla", "*.json"),
+                       ("Paquetes de plantillas", f"*{EXTENSION_PAQUETE}")]
         )
-        
-        if archivo:
+
+        if archivo and archivo.endswith(EXTENSION_PAQUETE):
+            self.importar_paquete_plantillas(archivo)
+        elif archivo:
             try:
                 with open(archivo, 'r', encoding='utf-8') as f:
                     plantilla = json.load(f)
@@ -659,8 +5646,7 @@ class SistemaPlantillasPersonalizadas:
                         return
                 
                 archivo_destino = self.carpeta_plantillas / f"{nombre}.json"
-                with open(archivo_destino, 'w', encoding='utf-8') as f:
-                    json.dump(plantilla, f, ensure_ascii=False, indent=2)
+                guardar_plantilla_segura(archivo_destino, plantilla, forzar=True)
                 
                 self.cargar_plantillas_guardadas()
                 messagebox.showinfo("Éxito", f"Plantilla '{nombre}' importada correctamente.")
@@ -668,6 +5654,98 @@ class SistemaPlantillasPersonalizadas:
             except Exception as e:
                 messagebox.showerror("Error", f"No se pudo importar la plantilla: {str(e)}")
     
+    def importar_paquete_plantillas(self, archivo):
+        try:
+            self.status_var.set("Validando paquete de plantillas...")
+            self.root.update_idletasks()
+            validas, errores, recursos = leer_paquete(archivo)
+        except Exception as e:
+            messagebox.showerror("Error", f"No se pudo leer el paquete: {str(e)}")
+            return
+
+        colisiones = [nombre for nombre, _ in validas if nombre in self.plantillas_personalizadas]
+        politica = 'sobrescribir'
+        if colisiones:
+            politica = self.preguntar_politica_colision(len(colisiones))
+            if not politica:
+                self.status_var.set("Importación cancelada")
+                return
+
+        try:
+            instaladas, omitidas = instalar_plantillas(self.carpeta_plantillas, validas, recursos,
+                                                       self.plantillas_personalizadas, politica)
+        except Exception as e:
+            messagebox.showerror("Error", f"No se pudo importar el paquete: {str(e)}")
+            return
+
+        self.cargar_plantillas_guardadas()
+        resumen = f"Plantillas importadas: {len(instaladas)}\nOmitidas: {len(omitidas)}\nCon errores: {len(errores)}"
+        if errores:
+            resumen += "\n\n" + "\n".join(f"• {nombre}: {error}" for nombre, error in errores[:15])
+            if len(errores) > 15:
+                resumen += f"\n... y {len(errores) - 15} más"
+        self.status_var.set(f"✅ Paquete importado: {len(instaladas)} plantillas")
+        messagebox.showinfo("Importación de paquete", resumen)
+
+    def preguntar_politica_colision(self, total_colisiones):
+        """Pregunta una sola vez qué hacer con las plantillas que ya existen"""
+        ventana = tk.Toplevel(self.root)
+        ventana.title("Plantillas existentes")
+        ventana.transient(self.root)
+        ventana.grab_set()
+        ventana.resizable(False, False)
+
+        frame = ttk.Frame(ventana, padding="20")
+        frame.pack(fill="both", expand=True)
+
+        ttk.Label(frame,
+                 text=f"{total_colisiones} plantillas del paquete ya existen.\n¿Qué desea hacer con ellas?",
+                 font=("Arial", 11)).pack(anchor="w", pady=(0, 10))
+
+        politica_var = tk.StringVar(value="omitir")
+        for valor, texto in (("omitir", "Omitirlas (conservar las actuales)"),
+                             ("sobrescribir", "Sobrescribir las actuales"),
+                             ("renombrar", "Importarlas con otro nombre")):
+            tk.Radiobutton(frame, text=texto, variable=politica_var, value=valor,
+                          font=("Arial", 10)).pack(anchor="w", pady=2)
+
+        resultado = {'politica': None}
+
+        def aceptar():
+            resultado['politica'] = politica_var.get()
+            ventana.destroy()
+
+        botones = ttk.Frame(frame)
+        botones.pack(fill="x", pady=(15, 0))
+        ttk.Button(botones, text="Aceptar", command=aceptar, width=12).pack(side="left", padx=(0, 10))
+        ttk.Button(botones, text="Cancelar", command=ventana.destroy, width=12).pack(side="left")
+
+        self.root.wait_window(ventana)
+        return resultado['politica']
+
+    def exportar_paquete_plantillas(self):
+        seleccion = self.lista_plantillas.curselection()
+        nombres = [self.lista_plantillas.get(i) for i in seleccion] or list(self.plantillas_personalizadas)
+        if not nombres:
+            messagebox.showwarning("Advertencia", "No hay plantillas para exportar.")
+            return
+
+        archivo = filedialog.asksaveasfilename(
+            title=f"Exportar {len(nombres)} plantillas como paquete...",
+            defaultextension=EXTENSION_PAQUETE,
+            filetypes=[("Paquetes de plantillas", f"*{EXTENSION_PAQUETE}")],
+            initialfile=f"plantillas_{datetime.now().strftime('%Y%m%d')}{EXTENSION_PAQUETE}"
+        )
+        if not archivo:
+            return
+
+        try:
+            total = exportar_paquete(archivo, {nombre: self.plantillas_personalizadas[nombre].a_dict()
+                                               for nombre in nombres})
+            messagebox.showinfo("Éxito", f"{total} plantillas exportadas a: {archivo}")
+        except Exception as e:
+            messagebox.showerror("Error", f"No se pudo exportar el paquete: {str(e)}")
+
     def exportar_plantilla(self):
         seleccion = self.lista_plantillas.curselection()
         if seleccion:
@@ -685,7 +5763,7 @@ class SistemaPlantillasPersonalizadas:
                 if archivo:
                     try:
                         with open(archivo, 'w', encoding='utf-8') as f:
-                            json.dump(plantilla, f, ensure_ascii=False, indent=2)
+                            json.dump(plantilla.a_dict(), f, ensure_ascii=False, indent=2)
                         messagebox.showinfo("Éxito", f"Plantilla exportada a: {archivo}")
                     except Exception as e:
                         messagebox.showerror("Error", f"No se pudo exportar: {str(e)}")
@@ -699,14 +5777,179 @@ class SistemaPlantillasPersonalizadas:
                                           f"¿Está seguro de eliminar la plantilla '{nombre_plantilla}'?")
             if respuesta:
                 archivo_plantilla = self.carpeta_plantillas / f"{nombre_plantilla}.json"
-                if archivo_plantilla.exists():
-                    archivo_plantilla.unlink()
+                huella = self.plantillas_personalizadas[nombre_plantilla].huella
+                try:
+                    eliminar_plantilla_segura(archivo_plantilla, huella)
+                except ConflictoPlantilla:
+                    if not messagebox.askyesno("Plantilla modificada",
+                                               f"Otro usuario modificó '{nombre_plantilla}' después de cargarla.\n"
+                                               "¿Eliminarla de todos modos?"):
+                        self.cargar_plantillas_guardadas()
+                        return
+                    eliminar_plantilla_segura(archivo_plantilla, forzar=True)
+                except ErrorBloqueo as e:
+                    messagebox.showerror("Error", str(e))
+                    return
                 
                 self.cargar_plantillas_guardadas()
                 messagebox.showinfo("Éxito", f"Plantilla '{nombre_plantilla}' eliminada.")
         else:
             messagebox.showwarning("Advertencia", "No hay plantilla seleccionada para eliminar.")
     
+    def ver_historial_plantilla(self):
+        seleccion = self.lista_plantillas.curselection()
+        if not seleccion:
+            messagebox.showwarning("Advertencia", "Seleccione una plantilla de la lista.")
+            return
+        nombre_plantilla = self.lista_plantillas.get(seleccion[0])
+        archivo_plantilla = self.carpeta_plantillas / f"{nombre_plantilla}.json"
+        versiones = leer_indice_historial(archivo_plantilla)
+        if not versiones:
+            messagebox.showinfo("Historial", f"La plantilla '{nombre_plantilla}' aún no tiene versiones registradas.")
+            return
+
+        ventana = tk.Toplevel(self.root)
+        ventana.title(f"Historial de '{nombre_plantilla}'")
+        ventana.geometry("900x600")
+        ventana.transient(self.root)
+
+        ttk.Label(ventana,
+                 text="Seleccione una versión para compararla con la anterior, o dos para compararlas entre sí.",
+                 font=("Arial", 10)).pack(anchor="w", padx=15, pady=10)
+
+        panel = ttk.Frame(ventana)
+        panel.pack(fill="both", expand=True, padx=15)
+
+        lista = tk.Listbox(panel, selectmode=tk.EXTENDED, width=42, font=("Consolas", 10), exportselection=False)
+        lista.pack(side="left", fill="y")
+        for entrada in reversed(versiones):
+            lista.insert(tk.END, f"v{entrada['version']:<4} {entrada['fecha'][:16].replace('T', ' '):<17} "
+                                 f"±{entrada['lineas_cambiadas']} líneas")
+
+        texto = scrolledtext.ScrolledText(panel, wrap=tk.NONE, font=("Consolas", 10))
+        texto.pack(side="left", fill="both", expand=True, padx=(10, 0))
+
+        def versiones_seleccionadas():
+            return sorted(versiones[len(versiones) - 1 - i]['version'] for i in lista.curselection())
+
+        def comparar(event=None):
+            elegidas = versiones_seleccionadas()
+            if not elegidas:
+                return
+            if len(elegidas) == 1:
+                anterior = [e['version'] for e in versiones if e['version'] < elegidas[0]]
+                if not anterior:
+                    diferencias = ["(primera versión registrada)"]
+                else:
+                    diferencias = diferencias_versiones(archivo_plantilla, anterior[-1], elegidas[0])
+            else:
+                diferencias = diferencias_versiones(archivo_plantilla, elegidas[0], elegidas[-1])
+            self.mostrar_diferencias(texto, diferencias)
+
+        def restaurar():
+            elegidas = versiones_seleccionadas()
+            if len(elegidas) != 1:
+                messagebox.showwarning("Advertencia", "Seleccione una sola versión para restaurar.", parent=ventana)
+                return
+            if not messagebox.askyesno("Confirmar",
+                                       f"¿Restaurar la versión {elegidas[0]}? Se guardará como una versión nueva.",
+                                       parent=ventana):
+                return
+            try:
+                plantilla = reconstruir_version(archivo_plantilla, elegidas[0])
+                guardar_plantilla_segura(archivo_plantilla, plantilla, forzar=True)
+            except Exception as e:
+                messagebox.showerror("Error", f"No se pudo restaurar la versión: {str(e)}", parent=ventana)
+                return
+            ventana.destroy()
+            self.cargar_plantillas_guardadas()
+            messagebox.showinfo("Éxito", f"Se restauró la versión {elegidas[0]} de '{nombre_plantilla}'.")
+
+        lista.bind("<<ListboxSelect>>", comparar)
+
+        botones = ttk.Frame(ventana)
+        botones.pack(fill="x", padx=15, pady=10)
+        ttk.Button(botones, text="↩️ Restaurar versión", command=restaurar, width=20).pack(side="left")
+        ttk.Button(botones, text="Cerrar", command=ventana.destroy, width=12).pack(side="right")
+
+    def mostrar_diferencias(self, texto, lineas):
+        texto.tag_configure("agregado", foreground="#27ae60")
+        texto.tag_configure("quitado", foreground="#c0392b")
+        texto.delete("1.0", tk.END)
+        for linea in lineas or ["(sin diferencias)"]:
+            etiqueta = "agregado" if linea[:1] == "+" else "quitado" if linea[:1] == "-" else ()
+            texto.insert(tk.END, linea + "\n", etiqueta)
+
+    def similitud_actualizada(self):
+        """Índice de similitud al día; las firmas se calculan solo al necesitarlas"""
+        self.indice_similitud.sincronizar(self.plantillas_personalizadas)
+        return self.indice_similitud
+
+    def buscar_plantillas_similares(self, contenido, excluir=None):
+        return self.similitud_actualizada().similares(contenido, UMBRAL_AVISO_DUPLICADO, excluir)
+
+    def ver_plantillas_duplicadas(self):
+        self.status_var.set("Buscando plantillas casi duplicadas...")
+        self.root.update_idletasks()
+        grupos = self.similitud_actualizada().grupos()
+        self.status_var.set(f"{len(grupos)} grupos de plantillas casi duplicadas")
+        if not grupos:
+            messagebox.showinfo("Duplicados", "No se encontraron plantillas casi duplicadas.")
+            return
+
+        ventana = tk.Toplevel(self.root)
+        ventana.title("Plantillas casi duplicadas")
+        ventana.geometry("1100x650")
+        ventana.transient(self.root)
+
+        ttk.Label(ventana,
+                 text=f"{len(grupos)} grupos. Seleccione un grupo y una o dos plantillas para ver sus diferencias.",
+                 font=("Arial", 10)).pack(anchor="w", padx=15, pady=10)
+
+        panel = ttk.Frame(ventana)
+        panel.pack(fill="both", expand=True, padx=15, pady=(0, 15))
+
+        lista_grupos = tk.Listbox(panel, width=30, font=("Arial", 10), exportselection=False)
+        lista_grupos.pack(side="left", fill="y")
+        for numero, grupo in enumerate(grupos, 1):
+            lista_grupos.insert(tk.END, f"Grupo {numero}: {len(grupo)} plantillas")
+
+        lista_miembros = tk.Listbox(panel, width=35, font=("Arial", 10), selectmode=tk.EXTENDED,
+                                    exportselection=False)
+        lista_miembros.pack(side="left", fill="y", padx=(10, 0))
+
+        texto = scrolledtext.ScrolledText(panel, wrap=tk.NONE, font=("Consolas", 10))
+        texto.pack(side="left", fill="both", expand=True, padx=(10, 0))
+
+        def elegir_grupo(event=None):
+            seleccion = lista_grupos.curselection()
+            if not seleccion:
+                return
+            lista_miembros.delete(0, tk.END)
+            for nombre in grupos[seleccion[0]]:
+                lista_miembros.insert(tk.END, nombre)
+            lista_miembros.selection_set(0, 1)
+            comparar()
+
+        def comparar(event=None):
+            elegidos = [lista_miembros.get(i) for i in lista_miembros.curselection()]
+            if not elegidos:
+                return
+            if len(elegidos) == 1:
+                elegidos.insert(0, lista_miembros.get(0))
+            a, b = (self.plantillas_personalizadas[nombre] for nombre in (elegidos[0], elegidos[-1]))
+            similitud = similitud_textos(a.contenido_base, b.contenido_base,
+                                         time.monotonic() + LIMITE_COMPARACION)
+            lineas = [f"Coincidencia de líneas: {similitud:.0%}"]
+            lineas += difflib.unified_diff(a.contenido_base.splitlines(), b.contenido_base.splitlines(),
+                                           a.nombre, b.nombre, lineterm='')
+            self.mostrar_diferencias(texto, lineas)
+
+        lista_grupos.bind("<<ListboxSelect>>", elegir_grupo)
+        lista_miembros.bind("<<ListboxSelect>>", comparar)
+        lista_grupos.selection_set(0)
+        elegir_grupo()
+
     def probar_plantilla(self):
         seleccion = self.lista_plantillas.curselection()
         if seleccion:
@@ -727,20 +5970,20 @@ class SistemaPlantillasPersonalizadas:
             if plantilla:
                 detalles = f"""INFORMACIÓN DETALLADA DE LA PLANTILLA
 
-Nombre: {plantilla.get('nombre', 'N/A')}
-Descripción: {plantilla.get('descripcion', 'N/A')}
-Tipo: {plantilla.get('tipo', 'N/A')}
-Fecha creación: {plantilla.get('fecha_creacion', 'N/A')}
-Documento origen: {plantilla.get('documento_origen', 'N/A')}
+Nombre: {plantilla.nombre or 'N/A'}
+Descripción: {plantilla.descripcion or 'N/A'}
+Tipo: {plantilla.tipo or 'N/A'}
+Fecha creación: {plantilla.fecha_creacion or 'N/A'}
+Versión: {plantilla.version or 'sin registrar'} ({plantilla.fecha_modificacion or 'N/A'})
+Documento origen: {plantilla.documento_origen or 'N/A'}
 
 CAMPOS PERSONALIZADOS:
 """
-                campos = plantilla.get('campos_personalizados', [])
-                for i, campo in enumerate(campos, 1):
-                    requerido = "SÍ" if campo.get('requerido') else "no"
-                    detalles += f"\n{i}. {campo['nombre']} ({campo['tipo']}) - Requerido: {requerido}"
-                    if campo.get('descripcion'):
-                        detalles += f"\n   Descripción: {campo['descripcion']}"
+                for i, campo in enumerate(plantilla.campos, 1):
+                    requerido = "SÍ" if campo.requerido else "no"
+                    detalles += f"\n{i}. {campo.nombre} ({campo.tipo}) - Requerido: {requerido}"
+                    if campo.descripcion:
+                        detalles += f"\n   Descripción: {campo.descripcion}"
                 
                 self.texto_detalles.delete("1.0", tk.END)
                 self.texto_detalles.insert("1.0", detalles)
@@ -755,19 +5998,25 @@ CAMPOS PERSONALIZADOS:
                     widget.delete(0, tk.END)
                 elif isinstance(widget, tk.Text):
                     widget.delete("1.0", tk.END)
-        
+                elif isinstance(widget, GrupoRepetible):
+                    widget.limpiar()
+
+        self.ultima_minuta = None
         self.texto_vista_previa.delete("1.0", tk.END)
         self.texto_vista_previa.insert(tk.END, "Formulario limpiado. Complete los campos y genere una nueva minuta.")
         self.status_var.set("Formulario limpiado - Listo para nuevo proceso")
 
 
 class EditorPlantillasDesdeMinuta:
-    def __init__(self, parent, carpeta_plantillas, contenido_minuta="", archivo_origen="", plantilla_existente=None):
+    def __init__(self, parent, carpeta_plantillas, contenido_minuta="", archivo_origen="", plantilla_existente=None,
+                 huella_original=None, buscar_similares=None):
         self.parent = parent
         self.carpeta_plantillas = carpeta_plantillas
         self.contenido_minuta = contenido_minuta
         self.archivo_origen = archivo_origen
         self.plantilla_existente = plantilla_existente
+        self.huella_original = huella_original
+        self.buscar_similares = buscar_similares
         
         self.ventana = tk.Toplevel(parent)
         self.ventana.title("Editor de Plantillas - Crear/Editar Plantilla")
@@ -779,8 +6028,10 @@ class EditorPlantillasDesdeMinuta:
         
         self.campos_personalizados = []
         self.mapeo_selecciones = {}
+        self.fuente_datos = None
         self.texto_seleccionado_actual = None
         self.posicion_seleccion_actual = None
+        self.historial = HistorialDeshacer()
         
         # Frame principal con scroll
         self.main_scrollable = ScrollableFrame(self.ventana)
@@ -790,6 +6041,12 @@ class EditorPlantillasDesdeMinuta:
         
         if plantilla_existente:
             self.cargar_plantilla_existente(plantilla_existente)
+
+        self.iniciar_diario()
+        self.ventana.protocol("WM_DELETE_WINDOW", self.cancelar)
+        self.ventana.bind("<Control-z>", lambda e: self.deshacer() or "break")
+        self.ventana.bind("<Control-y>", lambda e: self.rehacer() or "break")
+        self.ventana.bind("<Control-Z>", lambda e: self.rehacer() or "break")
     
     def configurar_interfaz(self):
         # Contenido principal dentro del frame scrollable
@@ -922,6 +6179,20 @@ class EditorPlantillasDesdeMinuta:
                   text="🗑️ Eliminar Campo Seleccionado", 
                   command=self.eliminar_campo,
                   width=20).pack(side="left")
+
+        self.boton_rehacer = ttk.Button(manage_buttons,
+                                        text="↷ Rehacer",
+                                        command=self.rehacer,
+                                        state="disabled",
+                                        width=10)
+        self.boton_rehacer.pack(side="right")
+
+        self.boton_deshacer = ttk.Button(manage_buttons,
+                                         text="↶ Deshacer",
+                                         command=self.deshacer,
+                                         state="disabled",
+                                         width=10)
+        self.boton_deshacer.pack(side="right", padx=(0, 5))
         
         # Botones finales
         final_buttons = ttk.Frame(main_content)
@@ -936,18 +6207,221 @@ class EditorPlantillasDesdeMinuta:
                   text="🔍 Vista Previa de Marcadores", 
                   command=self.mostrar_vista_previa,
                   width=22).pack(side="left", padx=(0, 15))
+
+        ttk.Button(final_buttons,
+                  text="🗄️ Fuente de Datos",
+                  command=self.configurar_fuente_datos,
+                  width=18).pack(side="left", padx=(0, 15))
         
         ttk.Button(final_buttons, 
                   text="❌ Cancelar y Salir", 
-                  command=self.ventana.destroy,
+                  command=self.cancelar,
                   width=16).pack(side="left")
 
+    # ===== AUTOGUARDADO =====
+
+    def clave_diario(self):
+        if self.plantilla_existente:
+            return f"plantilla:{self.plantilla_existente.get('nombre', '')}"
+        return f"minuta:{self.archivo_origen}"
+
+    def estado_editor(self):
+        return {
+            'texto': self.texto_minuta.get("1.0", "end-1c"),
+            'campos': self.campos_personalizados,
+            'mapeo': self.mapeo_selecciones,
+            'info': self.info_editor()
+        }
+
+    def info_editor(self):
+        return {'nombre': self.entry_nombre.get(),
+                'descripcion': self.entry_descripcion.get(),
+                'tipo': self.combo_tipo.get(),
+                'fuente_datos': self.fuente_datos}
+
+    def iniciar_diario(self):
+        ruta = DiarioEditor.ruta_para(self.carpeta_plantillas, self.clave_diario())
+        self.trabajo_recuperado = False
+        if ruta.exists():
+            estado = DiarioEditor.recuperar(ruta)
+            if estado and (estado['texto'] != self.texto_minuta.get("1.0", "end-1c")
+                           or estado['campos'] != self.campos_personalizados):
+                fecha = datetime.fromtimestamp(estado['fecha']).strftime('%d/%m/%Y %H:%M') if estado.get('fecha') else '-'
+                if messagebox.askyesno("Recuperar trabajo",
+                                       f"Se encontraron cambios sin guardar de esta plantilla ({fecha}).\n\n"
+                                       "¿Desea recuperarlos?", parent=self.ventana):
+                    self.restaurar_estado(estado)
+                    self.trabajo_recuperado = True
+
+        self.texto_diario = self.texto_minuta.get("1.0", "end-1c")
+        self.info_diario = self.info_editor()
+        self.diario_pendiente = None
+        self.diario = DiarioEditor(ruta, self.estado_editor())
+
+        self.texto_minuta.edit_modified(False)
+        self.texto_minuta.bind("<<Modified>>", self.al_modificar_texto)
+        for entrada in (self.entry_nombre, self.entry_descripcion, self.combo_tipo):
+            entrada.bind("<KeyRelease>", lambda e: self.programar_diario(), add="+")
+        self.combo_tipo.bind("<<ComboboxSelected>>", lambda e: self.programar_diario(), add="+")
+
+    def restaurar_estado(self, estado):
+        info = estado.get('info', {})
+        self.entry_nombre.delete(0, tk.END)
+        self.entry_nombre.insert(0, info.get('nombre', ''))
+        self.entry_descripcion.delete(0, tk.END)
+        self.entry_descripcion.insert(0, info.get('descripcion', ''))
+        self.combo_tipo.set(info.get('tipo', 'General'))
+        self.fuente_datos = info.get('fuente_datos')
+
+        self.texto_minuta.delete("1.0", tk.END)
+        self.texto_minuta.insert("1.0", estado['texto'])
+        self.campos_personalizados = estado['campos']
+        self.mapeo_selecciones = estado.get('mapeo', {})
+        self.historial.limpiar()
+        self.actualizar_lista_campos()
+        self.resaltar_marcadores()
+
+    def al_modificar_texto(self, event=None):
+        if self.texto_minuta.edit_modified():
+            self.texto_minuta.edit_modified(False)
+            self.programar_diario()
+
+    def programar_diario(self):
+        if self.diario_pendiente is None:
+            self.diario_pendiente = self.ventana.after(RETARDO_DIARIO_MS, self.registrar_cambios_diario)
+
+    def registrar_cambios_diario(self, deshacible=True):
+        """Registra en el diario lo que cambió en el texto y en la información básica.
+
+        Con 'deshacible', lo escrito a mano desde el último registro queda
+        además como un paso de deshacer."""
+        if self.diario_pendiente is not None:
+            self.ventana.after_cancel(self.diario_pendiente)
+            self.diario_pendiente = None
+
+        texto = self.texto_minuta.get("1.0", "end-1c")
+        operacion = diferencia_texto(self.texto_diario, texto)
+        if operacion:
+            self.diario.registrar(operacion)
+            if deshacible:
+                self.historial.registrar("Escritura", [(operacion['i'], self.texto_diario[operacion['i']:operacion['f']],
+                                                        operacion['t'])])
+                self.actualizar_botones_deshacer()
+            self.texto_diario = texto
+
+        info = self.info_editor()
+        if info != self.info_diario:
+            self.diario.registrar({'op': 'info', 'info': info})
+            self.info_diario = info
+
+    def registrar_operacion_campo(self, operacion):
+        # Primero el texto, para que el diario conserve el orden real. Ese
+        # texto ya es parte del paso de deshacer del campo.
+        self.registrar_cambios_diario(deshacible=False)
+        self.diario.registrar(operacion)
+
+    # ===== DESHACER =====
+
+    def posicion_texto(self, indice):
+        """Índice de Tk -> cantidad de caracteres desde el inicio"""
+        return (self.texto_minuta.count("1.0", indice, "chars") or (0,))[0]
+
+    def reemplazar_tramo(self, posicion, anterior, nuevo):
+        inicio = f"1.0 + {posicion} chars"
+        fin = f"{inicio} + {len(anterior)} chars"
+        if self.texto_minuta.get(inicio, fin) != anterior:
+            raise ValueError("El texto no coincide con el historial")
+        self.texto_minuta.delete(inicio, fin)
+        self.texto_minuta.insert(inicio, nuevo)
+        if nuevo.startswith('[[') and nuevo.endswith(']]'):
+            self.texto_minuta.tag_add("seleccionado", inicio, f"{inicio} + {len(nuevo)} chars")
+
+    def aplicar_cambio_campo(self, indice, actual, nuevo, mapeo):
+        """Lleva la lista de campos de 'actual' a 'nuevo' y lo anota en el diario"""
+        if actual is None:
+            self.campos_personalizados.insert(indice, nuevo)
+            if mapeo:
+                self.mapeo_selecciones[nuevo['id']] = mapeo
+            self.diario.registrar({'op': 'campo_nuevo', 'indice': indice, 'campo': nuevo,
+                                   'texto_original': mapeo['texto_original'] if mapeo else None})
+        elif nuevo is None:
+            self.campos_personalizados.pop(indice)
+            self.mapeo_selecciones.pop(actual['id'], None)
+            self.diario.registrar({'op': 'campo_eliminado', 'indice': indice})
+        else:
+            self.campos_personalizados[indice] = nuevo
+            self.diario.registrar({'op': 'campo_editado', 'indice': indice, 'campo': nuevo})
+
+    def registrar_paso(self, descripcion, tramos=(), campos=()):
+        self.historial.registrar(descripcion, tramos, campos)
+        self.actualizar_botones_deshacer()
+
+    def deshacer(self):
+        # Lo escrito y aún no registrado pasa a ser el último paso
+        self.registrar_cambios_diario()
+        cambio = self.historial.deshacer()
+        if cambio:
+            _, tramos, campos = cambio
+            try:
+                for posicion, anterior, nuevo in reversed(tramos):
+                    self.reemplazar_tramo(posicion, nuevo, anterior)
+            except ValueError:
+                self.historial.limpiar()
+                messagebox.showwarning("Deshacer", "El texto cambió y ya no se puede deshacer este paso.",
+                                       parent=self.ventana)
+            else:
+                for indice, antes, despues, mapeo_antes, _ in reversed(campos):
+                    self.aplicar_cambio_campo(indice, despues, antes, mapeo_antes)
+                self.finalizar_cambio()
+
+    def rehacer(self):
+        # Escribir después de deshacer descarta lo que se podía rehacer
+        self.registrar_cambios_diario()
+        cambio = self.historial.rehacer()
+        if cambio:
+            _, tramos, campos = cambio
+            try:
+                for posicion, anterior, nuevo in tramos:
+                    self.reemplazar_tramo(posicion, anterior, nuevo)
+            except ValueError:
+                self.historial.limpiar()
+                messagebox.showwarning("Rehacer", "El texto cambió y ya no se puede rehacer este paso.",
+                                       parent=self.ventana)
+            else:
+                for indice, antes, despues, _, mapeo_despues in campos:
+                    self.aplicar_cambio_campo(indice, antes, despues, mapeo_despues)
+                self.finalizar_cambio()
+
+    def finalizar_cambio(self):
+        self.registrar_cambios_diario(deshacible=False)
+        self.actualizar_lista_campos()
+        self.actualizar_botones_deshacer()
+
+    def actualizar_botones_deshacer(self):
+        self.boton_deshacer.configure(state="normal" if self.historial.pasos else "disabled")
+        self.boton_rehacer.configure(state="normal" if self.historial.deshechos else "disabled")
+
+    def cancelar(self):
+        self.registrar_cambios_diario()
+        hay_cambios = self.diario.operaciones_registradas or self.trabajo_recuperado
+        if hay_cambios:
+            if not messagebox.askyesno("Salir sin guardar",
+                                       "Hay cambios sin guardar en esta plantilla.\n"
+                                       "Podrá recuperarlos la próxima vez que la abra.\n\n"
+                                       "¿Desea salir del editor?", parent=self.ventana):
+                return
+        # Sin cambios el diario no sirve para nada: no se deja en el disco
+        self.diario.cerrar(descartar=not hay_cambios)
+        self.ventana.destroy()
+
     # Los métodos de funcionalidad se mantienen igual...
     def guardar_seleccion_actual(self, event=None):
         try:
             if self.texto_minuta.tag_ranges(tk.SEL):
                 self.texto_seleccionado_actual = self.texto_minuta.get(tk.SEL_FIRST, tk.SEL_LAST)
-                self.posicion_seleccion_actual = (tk.SEL_FIRST, tk.SEL_LAST)
+                # Índices fijos: el diálogo del campo puede quitar la selección
+                self.posicion_seleccion_actual = (self.texto_minuta.index(tk.SEL_FIRST),
+                                                  self.texto_minuta.index(tk.SEL_LAST))
         except:
             self.texto_seleccionado_actual = None
             self.posicion_seleccion_actual = None
@@ -963,22 +6437,26 @@ class EditorPlantillasDesdeMinuta:
         
         if dialogo.campo_creado:
             campo = dialogo.campo_creado
+            self.registrar_cambios_diario()
+            indice = len(self.campos_personalizados)
             self.campos_personalizados.append(campo)
+            marcador = f"[[{campo['id']}]]"
+            tramos = []
             
             if self.posicion_seleccion_actual:
                 inicio, fin = self.posicion_seleccion_actual
-                marcador = f"[[{campo['id']}]]"
-                
-                self.texto_minuta.delete(inicio, fin)
-                self.texto_minuta.insert(inicio, marcador)
-                
-                nuevo_fin = self.texto_minuta.index(f"{inicio} + {len(marcador)}c")
-                self.texto_minuta.tag_add("seleccionado", inicio, nuevo_fin)
+                tramo = (self.posicion_texto(inicio), self.texto_minuta.get(inicio, fin), marcador)
+                self.reemplazar_tramo(*tramo)
+                tramos.append(tramo)
             
-            self.mapeo_selecciones[campo['id']] = {
+            mapeo = {
                 'texto_original': texto_seleccionado,
                 'marcador': marcador
             }
+            self.mapeo_selecciones[campo['id']] = mapeo
+            self.registrar_operacion_campo({'op': 'campo_nuevo', 'campo': campo,
+                                            'texto_original': texto_seleccionado})
+            self.registrar_paso("Crear campo", tramos, [(indice, None, campo, None, mapeo)])
             
             self.actualizar_lista_campos()
             messagebox.showinfo("Éxito", f"Campo '{campo['nombre']}' creado correctamente.")
@@ -992,6 +6470,9 @@ class EditorPlantillasDesdeMinuta:
         
         if dialogo.campo_creado:
             self.campos_personalizados.append(dialogo.campo_creado)
+            self.registrar_operacion_campo({'op': 'campo_nuevo', 'campo': dialogo.campo_creado})
+            self.registrar_paso("Agregar campo", (), [(len(self.campos_personalizados) - 1, None,
+                                                       dialogo.campo_creado, None, None)])
             self.actualizar_lista_campos()
             messagebox.showinfo("Éxito", f"Campo '{dialogo.campo_creado['nombre']}' agregado manualmente.")
     
@@ -1009,6 +6490,8 @@ class EditorPlantillasDesdeMinuta:
         
         if dialogo.campo_creado:
             self.campos_personalizados[index] = dialogo.campo_creado
+            self.registrar_operacion_campo({'op': 'campo_editado', 'indice': index, 'campo': dialogo.campo_creado})
+            self.registrar_paso("Editar campo", (), [(index, campo_existente, dialogo.campo_creado, None, None)])
             self.actualizar_lista_campos()
             messagebox.showinfo("Éxito", f"Campo '{dialogo.campo_creado['nombre']}' actualizado.")
     
@@ -1024,18 +6507,23 @@ class EditorPlantillasDesdeMinuta:
         respuesta = messagebox.askyesno("Confirmar", 
                                       f"¿Está seguro de eliminar el campo '{campo['nombre']}'?")
         if respuesta:
-            if campo['id'] in self.mapeo_selecciones:
-                contenido_actual = self.texto_minuta.get("1.0", tk.END)
+            self.registrar_cambios_diario()
+            mapeo = self.mapeo_selecciones.pop(campo['id'], None)
+            tramos = []
+            if mapeo:
+                # Se reemplaza cada marcador en su sitio, de atrás hacia
+                # adelante para que las posiciones anteriores sigan valiendo
                 marcador = f"[[{campo['id']}]]"
-                texto_original = self.mapeo_selecciones[campo['id']]['texto_original']
-                nuevo_contenido = contenido_actual.replace(marcador, texto_original)
-                
-                self.texto_minuta.delete("1.0", tk.END)
-                self.texto_minuta.insert("1.0", nuevo_contenido)
-                
-                del self.mapeo_selecciones[campo['id']]
+                contenido_actual = self.texto_minuta.get("1.0", "end-1c")
+                posiciones = [m.start() for m in re.finditer(re.escape(marcador), contenido_actual)]
+                for posicion in reversed(posiciones):
+                    tramo = (posicion, marcador, mapeo['texto_original'])
+                    self.reemplazar_tramo(*tramo)
+                    tramos.append(tramo)
             
             self.campos_personalizados.pop(index)
+            self.registrar_operacion_campo({'op': 'campo_eliminado', 'indice': index})
+            self.registrar_paso("Eliminar campo", tramos, [(index, campo, None, mapeo, None)])
             self.actualizar_lista_campos()
             messagebox.showinfo("Éxito", f"Campo '{campo['nombre']}' eliminado.")
     
@@ -1058,6 +6546,7 @@ class EditorPlantillasDesdeMinuta:
         self.texto_minuta.insert("1.0", plantilla.get('contenido_base', ''))
         
         self.campos_personalizados = plantilla.get('campos_personalizados', [])
+        self.fuente_datos = plantilla.get('fuente_datos')
         self.actualizar_lista_campos()
         
         self.resaltar_marcadores()
@@ -1079,10 +6568,18 @@ class EditorPlantillasDesdeMinuta:
             messagebox.showinfo("Marcadores", "No hay campos creados todavía.")
             return
         
-        marcadores = "\n".join([f"[[{campo['id']}]] - {campo['nombre']} ({campo['tipo']})" 
+        marcadores = "\n".join([f"[[{campo['id']}]] - {campo['nombre']} ({campo['tipo']})"
                               for campo in self.campos_personalizados])
-        messagebox.showinfo("Marcadores Disponibles", 
-                          f"Puede usar estos marcadores en el contenido:\n\n{marcadores}")
+        bloques = ("Secciones condicionales y repeticiones:\n"
+                   "[[#si campo]] ... [[#sino]] ... [[/si]]\n"
+                   "[[#si campo=valor]] ... [[/si]]\n"
+                   "[[#para item en grupo]] [[item.subcampo]] [[/para]]\n\n"
+                   "Con [[#enriquecido]] en la primera línea:\n"
+                   "**negrita**  *cursiva*  ++subrayado++\n"
+                   "# Título  ## Subtítulo  >> centrado  --- salto de página\n\n"
+                   "Formatos: [[campo|" + "]], [[campo|".join(FORMATEADORES) + "]]")
+        messagebox.showinfo("Marcadores Disponibles",
+                          f"Puede usar estos marcadores en el contenido:\n\n{marcadores}\n\n{bloques}")
     
     def guardar_plantilla(self):
         nombre = self.entry_nombre.get().strip()
@@ -1097,29 +6594,204 @@ class EditorPlantillasDesdeMinuta:
         if not self.campos_personalizados:
             messagebox.showwarning("Advertencia", "Debe crear al menos un campo para la plantilla.")
             return
+
+        try:
+            compilar_contenido(contenido, formatos_de_campos(self.campos_personalizados))
+        except ErrorPlantilla as e:
+            messagebox.showwarning("Advertencia", f"Revise las secciones de la plantilla: {str(e)}")
+            return
         
+        misma_plantilla = bool(self.plantilla_existente) and self.plantilla_existente.get('nombre') == nombre
+        fecha_creacion = datetime.now().isoformat()
+        if misma_plantilla:
+            fecha_creacion = self.plantilla_existente.get('fecha_creacion') or fecha_creacion
+
         plantilla = {
             'nombre': nombre,
             'descripcion': descripcion,
             'tipo': tipo,
-            'fecha_creacion': datetime.now().isoformat(),
+            'fecha_creacion': fecha_creacion,
             'campos_personalizados': self.campos_personalizados,
             'contenido_base': contenido,
             'documento_origen': self.archivo_origen
         }
+        if self.fuente_datos:
+            plantilla['fuente_datos'] = self.fuente_datos
+        plantilla['indice_marcadores'] = calcular_indice_marcadores(contenido)
+
+        problemas = revisar_plantilla(plantilla, plantilla['indice_marcadores'])
+        if problemas:
+            lista = "\n".join(("❌ " if grave else "⚠️ ") + mensaje for grave, mensaje in problemas[:15])
+            if len(problemas) > 15:
+                lista += f"\n... y {len(problemas) - 15} más"
+            if not messagebox.askyesno("Revisión de la plantilla",
+                                       f"Se encontraron estos problemas:\n\n{lista}\n\n¿Guardarla de todos modos?",
+                                       parent=self.ventana):
+                return
         
+        if self.buscar_similares:
+            excluir = self.plantilla_existente.get('nombre') if self.plantilla_existente else None
+            similares = self.buscar_similares(contenido, excluir)
+            if similares:
+                otra, similitud = similares[0]
+                if not messagebox.askyesno("Plantilla casi duplicada",
+                                           f"El texto coincide en un {similitud:.0%} con la plantilla '{otra}'.\n"
+                                           "¿Guardarla de todos modos?"):
+                    return
+
         archivo_plantilla = self.carpeta_plantillas / f"{nombre}.json"
+        huella_esperada = self.huella_original if misma_plantilla else None
         
         try:
-            with open(archivo_plantilla, 'w', encoding='utf-8') as f:
-                json.dump(plantilla, f, ensure_ascii=False, indent=2)
+            try:
+                guardar_plantilla_segura(archivo_plantilla, plantilla, huella_esperada)
+            except ConflictoPlantilla as conflicto:
+                plantilla = self.resolver_conflicto(conflicto, plantilla, misma_plantilla)
+                if plantilla is None:
+                    return
+                guardar_plantilla_segura(archivo_plantilla, plantilla, conflicto.huella_actual)
             
+            self.diario.cerrar(descartar=True)
             messagebox.showinfo("Éxito", f"Plantilla '{nombre}' guardada correctamente!")
             self.ventana.destroy()
             
         except Exception as e:
             messagebox.showerror("Error", f"No se pudo guardar la plantilla: {str(e)}")
 
+    def configurar_fuente_datos(self):
+        fuente = self.fuente_datos or {}
+        ventana = tk.Toplevel(self.ventana)
+        ventana.title("Fuente de datos de la plantilla")
+        ventana.geometry("700x620")
+        ventana.transient(self.ventana)
+        ventana.grab_set()
+
+        contenido = ttk.Frame(ventana, padding="15")
+        contenido.pack(fill="both", expand=True)
+        contenido.columnconfigure(1, weight=1)
+
+        ttk.Label(contenido, text="Base SQLite:").grid(row=0, column=0, sticky="w", pady=5)
+        entry_base = ttk.Entry(contenido)
+        entry_base.insert(0, fuente.get('base', ''))
+        entry_base.grid(row=0, column=1, sticky="ew", pady=5, padx=(10, 5))
+
+        def elegir_base():
+            ruta = filedialog.askopenfilename(parent=ventana, title="Seleccionar base de datos",
+                                              filetypes=[("Bases SQLite", "*.sqlite *.sqlite3 *.db"),
+                                                         ("Todos los archivos", "*.*")])
+            if ruta:
+                entry_base.delete(0, tk.END)
+                entry_base.insert(0, ruta)
+
+        ttk.Button(contenido, text="...", width=3, command=elegir_base).grid(row=0, column=2, pady=5)
+
+        ttk.Label(contenido, text="Consulta de un caso:").grid(row=1, column=0, sticky="nw", pady=5)
+        texto_consulta = tk.Text(contenido, height=4, font=("Consolas", 10))
+        texto_consulta.insert("1.0", fuente.get('consulta', "SELECT * FROM casos WHERE id = :caso"))
+        texto_consulta.grid(row=1, column=1, columnspan=2, sticky="ew", pady=5, padx=(10, 0))
+
+        ttk.Label(contenido, text="Parámetro:").grid(row=2, column=0, sticky="w", pady=5)
+        entry_parametro = ttk.Entry(contenido, width=20)
+        entry_parametro.insert(0, fuente.get('parametro', 'caso'))
+        entry_parametro.grid(row=2, column=1, sticky="w", pady=5, padx=(10, 0))
+
+        ttk.Label(contenido, text="Consulta del lote:").grid(row=3, column=0, sticky="nw", pady=5)
+        texto_lote = tk.Text(contenido, height=4, font=("Consolas", 10))
+        texto_lote.insert("1.0", fuente.get('consulta_lote', ''))
+        texto_lote.grid(row=3, column=1, columnspan=2, sticky="ew", pady=5, padx=(10, 0))
+
+        ttk.Label(contenido, text="Mapeo\n(columna = campo):").grid(row=4, column=0, sticky="nw", pady=5)
+        texto_mapeo = tk.Text(contenido, height=8, font=("Consolas", 10))
+        texto_mapeo.insert("1.0", "\n".join(f"{columna} = {campo}"
+                                            for columna, campo in fuente.get('mapeo', {}).items()))
+        texto_mapeo.grid(row=4, column=1, columnspan=2, sticky="nsew", pady=5, padx=(10, 0))
+        ttk.Label(contenido, text="Las columnas con el mismo nombre que un campo no necesitan mapeo.",
+                 font=("Arial", 9), foreground="gray").grid(row=5, column=1, columnspan=2, sticky="w", padx=(10, 0))
+
+        def leer_configuracion():
+            mapeo = {}
+            for linea in texto_mapeo.get("1.0", tk.END).splitlines():
+                columna, separador, campo = linea.partition('=')
+                if separador and columna.strip() and campo.strip():
+                    mapeo[columna.strip()] = campo.strip()
+            return {'base': entry_base.get().strip(),
+                    'consulta': texto_consulta.get("1.0", tk.END).strip(),
+                    'parametro': entry_parametro.get().strip() or 'caso',
+                    'consulta_lote': texto_lote.get("1.0", tk.END).strip(),
+                    'mapeo': mapeo}
+
+        def probar():
+            caso = simpledialog.askstring("Probar consulta", "Caso a consultar:", parent=ventana)
+            if not caso:
+                return
+            campos = [Campo.desde_dict(campo) for campo in self.campos_personalizados]
+            try:
+                datos = FuenteDatosSQLite(leer_configuracion(), self.carpeta_plantillas).registro(caso, campos)
+            except ErrorFuenteDatos as e:
+                messagebox.showerror("Error", str(e), parent=ventana)
+                return
+            if datos is None:
+                messagebox.showinfo("Resultado", f"No se encontró el caso '{caso}'.", parent=ventana)
+                return
+            ids = {campo.id for campo in campos}
+            lineas = [f"{'✔' if clave in ids else '·'} {clave}: {valor}" for clave, valor in datos.items()]
+            faltantes = sorted(ids - set(datos))
+            if faltantes:
+                lineas.append(f"\nCampos sin columna: {', '.join(faltantes)}")
+            messagebox.showinfo("Resultado", "\n".join(lineas), parent=ventana)
+
+        def aceptar():
+            configuracion = leer_configuracion()
+            if not configuracion['base']:
+                self.fuente_datos = None
+            elif not configuracion['consulta'] and not configuracion['consulta_lote']:
+                messagebox.showwarning("Advertencia", "Indique al menos una consulta.", parent=ventana)
+                return
+            else:
+                self.fuente_datos = configuracion
+            self.programar_diario()
+            ventana.destroy()
+
+        botones = ttk.Frame(contenido)
+        botones.grid(row=6, column=0, columnspan=3, pady=(15, 0))
+        ttk.Button(botones, text="Probar", command=probar, width=12).pack(side="left", padx=(0, 10))
+        ttk.Button(botones, text="Aceptar", command=aceptar, width=12).pack(side="left", padx=(0, 10))
+        ttk.Button(botones, text="Cancelar", command=ventana.destroy, width=12).pack(side="left")
+        contenido.rowconfigure(4, weight=1)
+
+    def resolver_conflicto(self, conflicto, plantilla, misma_plantilla):
+        """Pregunta cómo resolver un guardado concurrente; None si se cancela"""
+        nombre = plantilla['nombre']
+        if conflicto.huella_actual is None:
+            # La plantilla fue eliminada por otro usuario mientras se editaba
+            if messagebox.askyesno("Plantilla eliminada",
+                                   f"Otro usuario eliminó '{nombre}'. ¿Volver a crearla?"):
+                return plantilla
+            return None
+
+        if not misma_plantilla:
+            if messagebox.askyesno("Confirmar", f"Ya existe una plantilla '{nombre}'. ¿Sobrescribirla?"):
+                return plantilla
+            return None
+
+        respuesta = messagebox.askyesnocancel(
+            "Plantilla modificada",
+            f"Otro usuario guardó '{nombre}' mientras usted la editaba.\n\n"
+            "Sí: combinar ambos cambios\nNo: sobrescribir con su versión\nCancelar: no guardar")
+        if respuesta is None:
+            return None
+        if not respuesta:
+            return plantilla
+
+        with open(conflicto.ruta, 'r', encoding='utf-8') as f:
+            ajena = json.load(f)
+        fusion, conflicto_contenido = fusionar_plantillas(self.plantilla_existente, plantilla, ajena)
+        if conflicto_contenido:
+            messagebox.showwarning("Advertencia",
+                                   "Ambos modificaron el texto de la plantilla; se conservó su versión "
+                                   "del texto y se combinaron los campos.")
+        return fusion
+
 
 class DialogoCampoDesdeSeleccion:
     def __init__(self, parent, texto_seleccionado="", campo_existente=None):
@@ -1200,6 +6872,8 @@ class DialogoCampoDesdeSeleccion:
                       font=("Arial", 10)).pack(anchor="w", pady=2)
         tk.Radiobutton(tipo_frame, text="Fecha", variable=self.tipo_var, value="fecha", 
                       font=("Arial", 10)).pack(anchor="w", pady=2)
+        tk.Radiobutton(tipo_frame, text="Grupo repetible", variable=self.tipo_var, value="grupo",
+                      font=("Arial", 10)).pack(anchor="w", pady=2)
         
         # Opciones para selección
         self.frame_opciones = ttk.LabelFrame(config_frame, text="Opciones de Selección", padding="10")
@@ -1208,19 +6882,44 @@ class DialogoCampoDesdeSeleccion:
         ttk.Label(self.frame_opciones, text="Una opción por línea:", font=("Arial", 9)).pack(anchor="w")
         self.texto_opciones = tk.Text(self.frame_opciones, height=6, width=50, font=("Arial", 9))
         self.texto_opciones.pack(fill="x", pady=5)
+
+        # Subcampos para grupo repetible
+        self.frame_subcampos = ttk.LabelFrame(config_frame, text="Subcampos del Grupo Repetible", padding="10")
+        self.frame_subcampos.grid(row=4, column=0, columnspan=3, sticky="we", pady=10)
+
+        ttk.Label(self.frame_subcampos, text="Un subcampo por línea (id: Nombre visible):", font=("Arial", 9)).pack(anchor="w")
+        self.texto_subcampos = tk.Text(self.frame_subcampos, height=4, width=50, font=("Arial", 9))
+        self.texto_subcampos.pack(fill="x", pady=5)
         
         # Descripción
-        ttk.Label(config_frame, text="Descripción/tooltip:", font=("Arial", 10)).grid(row=4, column=0, sticky="w", pady=8)
+        ttk.Label(config_frame, text="Descripción/tooltip:", font=("Arial", 10)).grid(row=5, column=0, sticky="w", pady=8)
         self.entry_descripcion = ttk.Entry(config_frame, width=30, font=("Arial", 10))
-        self.entry_descripcion.grid(row=4, column=1, columnspan=2, sticky="we", pady=8, padx=(10, 0))
+        self.entry_descripcion.grid(row=5, column=1, columnspan=2, sticky="we", pady=8, padx=(10, 0))
         
         # Campo requerido
         requerido_frame = ttk.Frame(config_frame)
-        requerido_frame.grid(row=5, column=0, columnspan=3, sticky="w", pady=15)
+        requerido_frame.grid(row=6, column=0, columnspan=3, sticky="w", pady=15)
         
         self.requerido_var = tk.BooleanVar(value=True)
         tk.Checkbutton(requerido_frame, text="Campo requerido", 
                       variable=self.requerido_var, font=("Arial", 10)).pack(anchor="w")
+
+        # Validación
+        ttk.Label(config_frame, text="Validación:", font=("Arial", 10)).grid(row=7, column=0, sticky="w", pady=8)
+        self.combo_validacion = ttk.Combobox(config_frame, width=27, state="readonly",
+                                            values=TIPOS_VALIDACION, font=("Arial", 10))
+        self.combo_validacion.grid(row=7, column=1, sticky="w", pady=8, padx=(10, 0))
+        ttk.Label(config_frame, text="(fecha y selección se validan siempre)", font=("Arial", 9), foreground="gray").grid(row=7, column=2, sticky="w", pady=8, padx=(5, 0))
+
+        ttk.Label(config_frame, text="Patrón (regex):", font=("Arial", 10)).grid(row=8, column=0, sticky="w", pady=8)
+        self.entry_patron = ttk.Entry(config_frame, width=30, font=("Arial", 10))
+        self.entry_patron.grid(row=8, column=1, columnspan=2, sticky="we", pady=8, padx=(10, 0))
+
+        # Formato del valor en la minuta
+        ttk.Label(config_frame, text="Formato en la minuta:", font=("Arial", 10)).grid(row=9, column=0, sticky="w", pady=8)
+        self.combo_formato = ttk.Combobox(config_frame, width=27, state="readonly",
+                                         values=[''] + list(FORMATEADORES), font=("Arial", 10))
+        self.combo_formato.grid(row=9, column=1, sticky="w", pady=8, padx=(10, 0))
         
         # Botones
         botones_frame = ttk.Frame(main_content)
@@ -1244,9 +6943,18 @@ class DialogoCampoDesdeSeleccion:
         self.tipo_var.set(campo.get('tipo', 'texto'))
         self.entry_descripcion.insert(0, campo.get('descripcion', ''))
         self.requerido_var.set(campo.get('requerido', False))
+
+        validacion = campo.get('validacion') or {}
+        self.combo_validacion.set(validacion.get('tipo', ''))
+        self.entry_patron.insert(0, validacion.get('patron', ''))
+        self.combo_formato.set(campo.get('formato', ''))
         
         if campo.get('tipo') == 'seleccion' and 'opciones' in campo:
             self.texto_opciones.insert("1.0", "\n".join(campo['opciones']))
+
+        if campo.get('tipo') == 'grupo' and 'subcampos' in campo:
+            self.texto_subcampos.insert("1.0", "\n".join(f"{sub['id']}: {sub['nombre']}"
+                                                         for sub in campo['subcampos']))
     
     def guardar_campo(self):
         campo_id = self.entry_id.get().strip()
@@ -1282,6 +6990,39 @@ class DialogoCampoDesdeSeleccion:
             else:
                 messagebox.showwarning("Advertencia", "Debe proporcionar opciones para el campo de selección.")
                 return
+
+        if self.combo_formato.get():
+            campo['formato'] = self.combo_formato.get()
+
+        tipo_validacion = self.combo_validacion.get()
+        if tipo_validacion:
+            validacion = {'tipo': tipo_validacion}
+            if tipo_validacion == 'regex':
+                patron = self.entry_patron.get().strip()
+                try:
+                    re.compile(patron)
+                except re.error as e:
+                    messagebox.showwarning("Advertencia", f"El patrón de validación no es válido: {str(e)}")
+                    return
+                if not patron:
+                    messagebox.showwarning("Advertencia", "Debe indicar el patrón para la validación 'regex'.")
+                    return
+                validacion['patron'] = patron
+            campo['validacion'] = validacion
+
+        if tipo == 'grupo':
+            subcampos = []
+            for linea in self.texto_subcampos.get("1.0", tk.END).split('\n'):
+                if not linea.strip():
+                    continue
+                sub_id, separador, sub_nombre = linea.partition(':')
+                sub_nombre = sub_nombre.strip() if separador else sub_id.strip()
+                sub_id = re.sub(r'[^a-zA-Z0-9_]', '_', sub_id.strip().lower())
+                subcampos.append({'id': sub_id, 'nombre': sub_nombre})
+            if not subcampos:
+                messagebox.showwarning("Advertencia", "Debe definir al menos un subcampo para el grupo repetible.")
+                return
+            campo['subcampos'] = subcampos
         
         self.campo_creado = campo
         self.ventana.destroy()
@@ -1302,7 +7043,160 @@ def verificar_dependencias():
         """)
         return False
 
+def ejecutar_linea_comandos(argumentos):
+    """Tareas sin interfaz gráfica: python "Minutas V1.py" <comando> ..."""
+    parser = argparse.ArgumentParser(prog="Minutas V1.py",
+                                     description="Tareas por lotes de MinuDoc sin interfaz gráfica")
+    comandos = parser.add_subparsers(dest="comando", required=True)
+
+    convertir = comandos.add_parser("convertir", help="Convierte una carpeta de minutas DOCX en borradores de plantilla")
+    convertir.add_argument("carpeta", help="Carpeta con las minutas (se recorre con subcarpetas)")
+    convertir.add_argument("--plantillas", default="plantillas_personalizadas",
+                           help="Carpeta de plantillas; los borradores van a su subcarpeta 'borradores'")
+    convertir.add_argument("--procesos", type=int, default=None, help="Procesos de trabajo (por defecto, uno por núcleo)")
+    convertir.add_argument("--minimo-grupo", type=int, default=1,
+                           help="Solo crear borradores para grupos con al menos N minutas")
+    convertir.add_argument("--reiniciar", action="store_true", help="Ignorar el punto de control y analizar todo de nuevo")
+
+    auditoria = comandos.add_parser("auditoria", help="Consulta el registro de auditoría de minutas generadas")
+    auditoria.add_argument("--plantilla", help="Solo las minutas de esta plantilla")
+    auditoria.add_argument("--desde", help="Fecha inicial, completa o parcial (2026-10, 2026-10-01)")
+    auditoria.add_argument("--hasta", help="Fecha final, completa o parcial")
+    auditoria.add_argument("--mes", help="Atajo para --desde y --hasta del mismo mes (2026-10)")
+    auditoria.add_argument("--csv", action="store_true", help="Salida en CSV")
+    auditoria.add_argument("--carpeta", default=str(CARPETA_DATOS / CARPETA_AUDITORIA),
+                           help="Carpeta del registro de auditoría")
+
+    contrastar = comandos.add_parser("contrastar",
+                                     help="Compara los motores de renderizado con la referencia usando casos aleatorios")
+    contrastar.add_argument("--casos", type=int, default=20000, help="Casos aleatorios por motor")
+    contrastar.add_argument("--semilla", type=int, default=None, help="Semilla para repetir una ejecución")
+    contrastar.add_argument("--motor", action="append", choices=sorted(MOTORES_RENDERIZADO),
+                            help="Motor a contrastar (se puede repetir; por defecto, todos)")
+    contrastar.add_argument("--fallos", help="Guardar en este JSON los casos mínimos que fallan")
+
+    revisar = comandos.add_parser("revisar", help="Revisa marcadores y campos de todas las plantillas")
+    revisar.add_argument("--plantillas", default="plantillas_personalizadas", help="Carpeta de plantillas")
+    revisar.add_argument("--procesos", type=int, default=None, help="Procesos de trabajo (por defecto, uno por núcleo)")
+    revisar.add_argument("--avisos", action="store_true", help="Mostrar también los avisos, no solo los errores")
+
+    probar = comandos.add_parser("probar", help="Genera en memoria una minuta de prueba de cada plantilla")
+    probar.add_argument("--plantillas", default="plantillas_personalizadas", help="Carpeta de plantillas")
+    probar.add_argument("--procesos", type=int, default=None, help="Procesos de trabajo (por defecto, uno por núcleo)")
+    probar.add_argument("--limite", type=float, default=LIMITE_PRUEBA, help="Segundos como máximo por plantilla")
+    probar.add_argument("--muestras", help="JSON con valores de muestra por id de campo (reemplazan a los sintéticos)")
+    probar.add_argument("--informe", help="Guardar en este CSV el resultado y el tiempo de cada plantilla")
+
+    comparar = comandos.add_parser("comparar", help="Compara dos minutas DOCX párrafo por párrafo y palabra por palabra")
+    comparar.add_argument("anterior", help="Borrador anterior (.docx)")
+    comparar.add_argument("nuevo", help="Minuta nueva (.docx)")
+    comparar.add_argument("--salida", help="Guardar un .docx con los cambios como control de cambios")
+
+    concurrencia = comandos.add_parser("concurrencia",
+                                       help="Guarda una plantilla desde varios procesos a la vez y verifica el resultado")
+    concurrencia.add_argument("--carpeta", default=tempfile.gettempdir(),
+                              help="Carpeta donde probar (por ejemplo, la carpeta compartida de red)")
+    concurrencia.add_argument("--procesos", type=int, default=4, help="Procesos que guardan a la vez")
+    concurrencia.add_argument("--guardados", type=int, default=50, help="Guardados por proceso")
+
+    valores = comandos.add_parser("valores", help="Valores recordados para autocompletar campos")
+    valores.add_argument("--purgar", action="store_true", help="Borrar los valores recordados")
+    valores.add_argument("--campo", help="Limitar a este id de campo")
+    valores.add_argument("--carpeta", default=str(CARPETA_DATOS), help="Carpeta de datos locales")
+
+    opciones = parser.parse_args(argumentos)
+    if opciones.comando == "contrastar":
+        resultados = contrastar_motores(opciones.casos, opciones.semilla, opciones.motor)
+        fallos = {nombre: resultado['fallos'] for nombre, resultado in resultados.items() if resultado['fallos']}
+        if opciones.fallos:
+            escribir_json_atomico(opciones.fallos, fallos)
+        return 1 if fallos else 0
+    if opciones.comando == "revisar":
+        if not Path(opciones.plantillas).is_dir():
+            parser.error(f"La carpeta '{opciones.plantillas}' no existe")
+        return revisar_biblioteca(opciones.plantillas, opciones.procesos, opciones.avisos)
+    if opciones.comando == "probar":
+        if not Path(opciones.plantillas).is_dir():
+            parser.error(f"La carpeta '{opciones.plantillas}' no existe")
+        muestras = None
+        if opciones.muestras:
+            try:
+                with open(opciones.muestras, 'r', encoding='utf-8') as f:
+                    muestras = json.load(f)
+            except (OSError, ValueError) as e:
+                parser.error(f"No se pudo leer '{opciones.muestras}': {e}")
+            if not isinstance(muestras, dict):
+                parser.error("El archivo de muestras debe ser un objeto JSON {id_campo: valor}")
+        return probar_biblioteca(opciones.plantillas, opciones.procesos, opciones.limite,
+                                 muestras, opciones.informe)
+    if opciones.comando == "comparar":
+        inicio = time.perf_counter()
+        try:
+            anteriores = list(parrafos_docx(opciones.anterior))
+            nuevos = list(parrafos_docx(opciones.nuevo))
+        except (OSError, KeyError, zipfile.BadZipFile, ET.ParseError) as e:
+            parser.error(f"No se pudo leer el documento: {e}")
+        resumen = {}
+        resultados = contar_cambios(comparar_parrafos(anteriores, nuevos), resumen)
+        if opciones.salida:
+            documento_comparacion(resultados).save(opciones.salida)
+        else:
+            for tipo, contenido in resultados:
+                if tipo == 'cambiado':
+                    print("~ " + "".join(trozo if subtipo == 'igual' else
+                                         f"[-{trozo}-]" if subtipo == 'borrado' else f"{{+{trozo}+}}"
+                                         for subtipo, trozo in contenido))
+                elif tipo != 'igual':
+                    print(f"{'+' if tipo == 'insertado' else '-'} {contenido}")
+        print(f"{resumen.get('igual', 0)} párrafos iguales, {resumen.get('cambiado', 0)} cambiados, "
+              f"{resumen.get('insertado', 0)} nuevos, {resumen.get('borrado', 0)} quitados; "
+              f"+{resumen.get('palabras_insertado', 0)} / -{resumen.get('palabras_borrado', 0)} palabras "
+              f"en {time.perf_counter() - inicio:.2f} s")
+        # Como diff: 1 si los documentos difieren
+        return 1 if any(tipo != 'igual' for tipo in resumen) else 0
+    if opciones.comando == "concurrencia":
+        if not Path(opciones.carpeta).is_dir():
+            parser.error(f"La carpeta '{opciones.carpeta}' no existe")
+        return probar_concurrencia(opciones.carpeta, opciones.procesos, opciones.guardados)
+    if opciones.comando == "valores":
+        historial = HistorialValores(opciones.carpeta)
+        if opciones.purgar:
+            print(f"{historial.purgar(opciones.campo)} valores borrados")
+            return 0
+        for campo_id in sorted(historial.indices):
+            if not opciones.campo or campo_id == opciones.campo:
+                print(f"{campo_id}: {len(historial.indices[campo_id])} valores")
+        print(f"{len(historial)} valores en total (máximo {historial.maximo})")
+        return 0
+    if opciones.comando == "auditoria":
+        desde = opciones.mes or opciones.desde
+        hasta = opciones.mes or opciones.hasta
+        eventos = consultar_auditoria(opciones.carpeta, opciones.plantilla, desde, hasta)
+        columnas = ['ts', 'plantilla', 'version', 'huella', 'datos', 'salida', 'ms', 'modo', 'registro']
+        if opciones.csv:
+            escritor = csv.DictWriter(sys.stdout, columnas, extrasaction='ignore')
+            escritor.writeheader()
+            escritor.writerows(eventos)
+            return 0
+        total = 0
+        for evento in eventos:
+            total += 1
+            print(f"{evento['ts']}  {evento['plantilla']} v{evento['version'] or '-'}  "
+                  f"{evento['ms']:>7} ms  {evento['salida']}")
+        print(f"{total} minutas")
+        return 0
+    if opciones.comando == "convertir":
+        if not Path(opciones.carpeta).is_dir():
+            parser.error(f"La carpeta '{opciones.carpeta}' no existe")
+        convertir_carpeta_minutas(opciones.carpeta, opciones.plantillas, opciones.procesos,
+                                  opciones.reiniciar, opciones.minimo_grupo)
+    return 0
+
+
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    if len(sys.argv) > 1:
+        sys.exit(ejecutar_linea_comandos(sys.argv[1:]) if verificar_dependencias() else 1)
     if verificar_dependencias():
         app = SistemaPlantillasPersonalizadas()
         app.root.mainloop()
\ No newline at end of file